@@ -4,8 +4,19 @@ from django.contrib import admin
 
 from django.contrib import admin
 
-from .models import Device, Peripheral, Parameter
+from .models import Device, Peripheral, Parameter, Scene, SceneTarget
+
+
+class SceneTargetInline(admin.TabularInline):
+    model = SceneTarget
+    extra = 1
+
+
+class SceneAdmin(admin.ModelAdmin):
+    inlines = [SceneTargetInline]
+
 
 admin.site.register(Device)
 admin.site.register(Peripheral)
-admin.site.register(Parameter)
\ No newline at end of file
+admin.site.register(Parameter)
+admin.site.register(Scene, SceneAdmin)
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class CommandcontrolConfig(AppConfig):
     name = 'CommandControl'
+
+    def ready(self):
+        from .registry import connect_signals
+        connect_signals()
@@ -0,0 +1,106 @@
+
+import io
+import time
+import contextlib
+
+import numpy as np
+from django.db import connection
+from channels.db import database_sync_to_async
+
+from . import command_api
+
+
+def latency_summary(samples):
+    """ p50/p95/p99/max & mean of latencies in seconds - returned in milliseconds """
+    if len(samples) == 0:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0, "mean": 0.0}
+    ms = np.asarray(samples, dtype=np.float64) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {"p50": p50, "p95": p95, "p99": p99, "max": ms.max(), "mean": ms.mean()}
+
+
+def format_table(headers: list, rows: list):
+    """ plain text table - floats to 2 decimal places """
+    cells = [[f"{c:.2f}" if isinstance(c, float) else str(c) for c in row] for row in rows]
+    widths = [max([len(h)] + [len(r[i]) for r in cells]) for i, h in enumerate(headers)]
+    lines = ["  ".join(h.rjust(w) for h, w in zip(headers, widths))]
+    lines.append("  ".join("-" * w for w in widths))
+    lines += ["  ".join(c.rjust(w) for c, w in zip(row, widths)) for row in cells]
+    return "\n".join(lines)
+
+
+@contextlib.contextmanager
+def bench_database():
+    """ run against a throwaway test database, as the test runner does """
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+@contextlib.contextmanager
+def quiet():
+    """ silence debug_print & the print logging on the command path while measuring """
+    debug = command_api.DEBUG
+    command_api.DEBUG = 0
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        command_api.DEBUG = debug
+
+
+def reset_state():
+    """ forget cached devices, health & GET results between runs """
+    from .registry import registry
+    from .device_health import device_health
+    from .get_cache import get_cache
+
+    registry.invalidate()
+    device_health.devices = {}
+    get_cache.clear()
+
+
+async def close_services():
+    """ stop the background writers & close the device client - as the shutdown hooks do """
+    from .device_client import close_device_client
+    from .write_behind import close_write_behind
+    from .history import close_history
+
+    await close_write_behind()
+    await close_history()
+    await close_device_client()
+
+
+#######################
+##  class QueryCounter
+#   \brief  - counts the sql statements (& the time spent in them) on the connection
+#             used by database_sync_to_async - install & remove from the event loop
+class QueryCounter():
+
+    def __init__(self):
+        self.count = 0
+        self.elapsed = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.elapsed += time.perf_counter() - start
+            self.count += 1
+
+    def reset(self):
+        self.count = 0
+        self.elapsed = 0.0
+
+    ## connection is per thread - only look it up in the database thread
+    @database_sync_to_async
+    def install(self):
+        connection.execute_wrappers.append(self)
+
+    @database_sync_to_async
+    def remove(self):
+        connection.execute_wrappers.remove(self)
@@ -0,0 +1,387 @@
+
+import os
+import json
+import uuid
+import base64
+import struct
+import asyncio
+
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+
+from .command_api import debug_print
+from .worker_lock import WorkerLock, worker_path
+
+
+## frames on the socket are a 4 byte length then the json
+LAYER_FRAME_HEADER = struct.Struct("!I")
+## bytes queued for one connection before messages to it are dropped
+LAYER_MAX_BUFFER = 4 * 1024 * 1024
+## seconds between reconnect attempts after losing the hub, doubling to the max
+LAYER_RECONNECT_DELAY = 0.1
+LAYER_RECONNECT_DELAY_MAX = 2.0
+## seconds to wait for the hub to answer a query
+LAYER_QUERY_TIMEOUT = 1.0
+
+
+def json_default(o):
+    if isinstance(o, (bytes, bytearray)):
+        return {"__bytes__": base64.b64encode(o).decode()}
+    raise TypeError(f"{type(o).__name__} can't be sent over the channel layer")
+
+
+def json_object_hook(d):
+    if len(d) == 1 and "__bytes__" in d:
+        return base64.b64decode(d["__bytes__"])
+    return d
+
+
+def encode_frame(frame: dict):
+    data = json.dumps(frame, default=json_default, separators=(",", ":")).encode()
+    return LAYER_FRAME_HEADER.pack(len(data)) + data
+
+
+async def read_frame(reader):
+    header = await reader.readexactly(LAYER_FRAME_HEADER.size)
+    data = await reader.readexactly(LAYER_FRAME_HEADER.unpack(header)[0])
+    return json.loads(data, object_hook=json_object_hook)
+
+
+def write_frame(writer, frame: dict, max_buffer: int = LAYER_MAX_BUFFER):
+    """ queue a frame without waiting - returns false (& drops it) if the peer is too far behind """
+    if writer.transport.is_closing() or writer.transport.get_write_buffer_size() > max_buffer:
+        return False
+    writer.write(encode_frame(frame))
+    return True
+
+
+def channel_process(channel: str):
+    """ the process id in a process specific channel name ("prefix.<process>!<id>"), else None """
+    if "!" not in channel:
+        return None
+    return channel.split("!", 1)[0].rsplit(".", 1)[-1]
+
+
+#######################
+##  class LayerHub
+#   \brief  - relays messages between the worker processes' channel layers
+#             runs inside whichever worker won the election for the socket
+#             tracks how many channels each process has in each group, so group
+#             messages only go to processes with members
+#             frames from a worker:
+#               {"op": "hello", "proc": p, "receive": bool} - receive false for send only connections
+#               {"op": "members", "group": g, "count": n}
+#               {"op": "send", "proc": p, "channel": c, "message": m}
+#               {"op": "group_send", "group": g, "message": m}
+#               {"op": "size", "id": i, "group": g}
+class LayerHub():
+
+    def __init__(self, path: str):
+        self.path = path
+        self.server = None
+        ''' receiving connections - process id -> writer '''
+        self.writers = {}
+        ''' every open connection, including ones not yet said hello & send only ones '''
+        self.connections = set()
+        ''' group -> {process id: channel count} '''
+        self.members = {}
+
+    async def start(self):
+        self.server = await asyncio.start_unix_server(self.handle, path=self.path)
+        os.chmod(self.path, 0o600)
+        print(f"Channel layer hub listening on {self.path}")
+
+    async def handle(self, reader, writer):
+        proc = None
+        self.connections.add(writer)
+        try:
+            while True:
+                frame = await read_frame(reader)
+                op = frame.get("op")
+                if op == "hello":
+                    proc = frame["proc"]
+                    if frame.get("receive", True):
+                        self.writers[proc] = writer
+                elif op == "members":
+                    self.set_members(frame["group"], proc, frame["count"])
+                elif op == "send":
+                    target = self.writers.get(frame["proc"])
+                    if target is not None:
+                        write_frame(target, {"op": "deliver", "channel": frame["channel"], "message": frame["message"]})
+                elif op == "group_send":
+                    ## the sender has already delivered to its own members
+                    out = {"op": "group", "group": frame["group"], "message": frame["message"]}
+                    for p in self.members.get(frame["group"], {}):
+                        target = self.writers.get(p)
+                        if p != proc and target is not None:
+                            write_frame(target, out)
+                elif op == "size":
+                    size = sum(self.members.get(frame["group"], {}).values())
+                    write_frame(writer, {"op": "size", "id": frame["id"], "size": size})
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, KeyError):
+            pass
+        except asyncio.CancelledError:
+            ## the hub's loop is shutting down
+            pass
+        finally:
+            if proc is not None and self.writers.get(proc) is writer:
+                del self.writers[proc]
+                for group in list(self.members):
+                    self.set_members(group, proc, 0)
+            self.connections.discard(writer)
+            writer.close()
+
+    def set_members(self, group: str, proc: str, count: int):
+        counts = self.members.setdefault(group, {})
+        if count > 0:
+            counts[proc] = count
+        else:
+            counts.pop(proc, None)
+        if len(counts) == 0:
+            del self.members[group]
+
+    ''' stop listening & drop every worker's connection, so they elect a new hub '''
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            for writer in list(self.connections):
+                writer.close()
+            await self.server.wait_closed()
+            self.server = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+#######################
+##  class UnixSocketChannelLayer
+#   \brief  - channel layer for several worker processes on one box, no broker needed
+#             each process keeps its channels & groups in memory (InMemoryChannelLayer)
+#             and relays sends to other processes' channels & group messages through a
+#             hub on a unix socket. The first worker to find no hub becomes the hub -
+#             if it exits the others reconnect & elect a new one
+#             delivery is at most once - messages sent while the hub is changing are dropped
+#             only process specific channels (new_channel) cross processes, plain named
+#             channels stay local
+class UnixSocketChannelLayer(InMemoryChannelLayer):
+
+    def __init__(self, path: str = None, max_buffer: int = LAYER_MAX_BUFFER, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path if path is not None else worker_path("layer.sock")
+        self.max_buffer = max_buffer
+        self.proc_id = uuid.uuid4().hex[:12]
+        self.hub = None
+        self.writer = None
+        self.loop = None
+        self.connect_lock = None
+        self.reader_task = None
+        self.reconnect_task = None
+        self.queries = {}
+        self.query_id = 0
+        self.closed = False
+
+    async def new_channel(self, prefix="specific."):
+        return f"{prefix}.{self.proc_id}!{uuid.uuid4().hex[:12]}"
+
+    def is_local(self, channel: str):
+        proc = channel_process(channel)
+        return proc is None or proc == self.proc_id
+
+    ## connection to the hub
+
+    ''' connect to the hub, starting one in this process if there is none '''
+    async def open_hub(self):
+        try:
+            return await asyncio.open_unix_connection(self.path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            pass
+
+        ## the election lock stops two workers binding the socket at once
+        election = WorkerLock("layer-election")
+        while not election.try_acquire():
+            await asyncio.sleep(0.05)
+        try:
+            try:
+                return await asyncio.open_unix_connection(self.path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                pass
+            ## nobody is listening - any socket file left is stale
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            self.hub = LayerHub(self.path)
+            await self.hub.start()
+        finally:
+            election.release()
+        return await asyncio.open_unix_connection(self.path)
+
+    async def connect(self):
+        reader, writer = await self.open_hub()
+        write_frame(writer, {"op": "hello", "proc": self.proc_id, "receive": True})
+        ## the hub may be new - tell it which groups we're in
+        for group, channels in self.groups.items():
+            write_frame(writer, {"op": "members", "group": group, "count": len(channels)})
+        self.writer = writer
+        self.reader_task = asyncio.ensure_future(self.read_hub(reader, writer))
+        debug_print(f"Channel layer {self.proc_id} connected to {self.path}")
+
+    ''' the hub connection for this loop, connecting on first use
+        None while reconnecting, or when called from another event loop
+    '''
+    async def connection(self):
+        loop = asyncio.get_event_loop()
+        if self.loop is None or self.loop.is_closed():
+            self.loop = loop
+            self.connect_lock = asyncio.Lock()
+            self.writer = None
+            self.reconnect_task = None
+        if loop is not self.loop or self.closed:
+            return None
+        if self.writer is None and (self.reconnect_task is None or self.reconnect_task.done()):
+            async with self.connect_lock:
+                if self.writer is None:
+                    try:
+                        await self.connect()
+                    except OSError as e:
+                        print(f"Channel layer can't reach the hub: {e}")
+                        self.start_reconnect()
+        return self.writer
+
+    def start_reconnect(self):
+        if not self.closed and (self.reconnect_task is None or self.reconnect_task.done()):
+            self.reconnect_task = asyncio.ensure_future(self.reconnect())
+
+    async def reconnect(self):
+        delay = LAYER_RECONNECT_DELAY
+        while not self.closed and self.writer is None:
+            await asyncio.sleep(delay)
+            try:
+                async with self.connect_lock:
+                    if self.writer is None:
+                        await self.connect()
+            except OSError as e:
+                debug_print(f"Channel layer reconnect failed: {e}")
+                delay = min(LAYER_RECONNECT_DELAY_MAX, delay * 2)
+
+    async def read_hub(self, reader, writer):
+        try:
+            while True:
+                frame = await read_frame(reader)
+                op = frame.get("op")
+                if op == "deliver":
+                    try:
+                        await InMemoryChannelLayer.send(self, frame["channel"], frame["message"])
+                    except ChannelFull:
+                        pass
+                elif op == "group":
+                    await InMemoryChannelLayer.group_send(self, frame["group"], frame["message"])
+                elif op == "size":
+                    future = self.queries.pop(frame["id"], None)
+                    if future is not None and not future.done():
+                        future.set_result(frame["size"])
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            print("Channel layer lost the hub")
+        finally:
+            writer.close()
+            if self.writer is writer:
+                self.writer = None
+                self.start_reconnect()
+
+    ''' send a frame to the hub - from another event loop a one off connection is used '''
+    async def post(self, frame: dict):
+        writer = await self.connection()
+        if writer is not None:
+            if not write_frame(writer, frame, self.max_buffer):
+                debug_print(f"Channel layer dropped a {frame['op']} frame")
+            return
+        if self.closed or asyncio.get_event_loop() is self.loop:
+            return
+        try:
+            reader, writer = await asyncio.open_unix_connection(self.path)
+        except OSError:
+            return
+        write_frame(writer, {"op": "hello", "proc": self.proc_id, "receive": False})
+        write_frame(writer, frame)
+        await writer.drain()
+        writer.close()
+
+    ## channel layer api
+
+    async def send(self, channel, message):
+        if self.is_local(channel):
+            await super().send(channel, message)
+        else:
+            assert isinstance(message, dict), "message is not a dict"
+            self.require_valid_channel_name(channel)
+            await self.post({"op": "send", "proc": channel_process(channel), "channel": channel, "message": message})
+
+    async def group_add(self, group, channel):
+        await super().group_add(group, channel)
+        await self.post_members(group)
+
+    async def group_discard(self, group, channel):
+        await super().group_discard(group, channel)
+        await self.post_members(group)
+
+    async def post_members(self, group):
+        await self.post({"op": "members", "group": group, "count": len(self.groups.get(group, {}))})
+
+    async def group_send(self, group, message):
+        await super().group_send(group, message)
+        await self.post({"op": "group_send", "group": group, "message": message})
+
+    ''' channels in the group across every process - the local count if the hub can't be asked '''
+    async def group_size(self, group):
+        local = len(self.groups.get(group, {}))
+        writer = await self.connection()
+        if writer is None:
+            return local
+        self.query_id += 1
+        query_id = self.query_id
+        future = asyncio.get_event_loop().create_future()
+        self.queries[query_id] = future
+        write_frame(writer, {"op": "size", "id": query_id, "group": group})
+        try:
+            return await asyncio.wait_for(future, LAYER_QUERY_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.queries.pop(query_id, None)
+            return local
+
+    async def flush(self):
+        for group in list(self.groups):
+            self.groups[group] = {}
+            await self.post_members(group)
+        await super().flush()
+
+    async def close(self):
+        self.closed = True
+        for task in (self.reader_task, self.reconnect_task):
+            if task is not None and not task.done():
+                task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.hub is not None:
+            await self.hub.close()
+            self.hub = None
+
+
+def shares_workers(layer):
+    """ true if the layer relays between worker processes, so work owned by one worker needs a WorkerLock """
+    return isinstance(layer, UnixSocketChannelLayer)
+
+
+async def group_size(layer, group: str):
+    """ channels in a group across every worker - for layers without group_size, the local count """
+    if hasattr(layer, "group_size"):
+        return await layer.group_size(group)
+    return len(getattr(layer, "groups", {}).get(group, {}))
+
+
+async def close_channel_layer():
+    """ shutdown hook - hands the hub over to the other workers straight away """
+    layer = get_channel_layer()
+    if layer is not None:
+        await layer.close()
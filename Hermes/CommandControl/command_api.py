@@ -1,6 +1,5 @@
 
 import json
-import aiohttp
 
 ## Error codes 
 # client side errors
@@ -18,6 +17,8 @@ ERR_CODE_INVALID_DATA_VALUE     = 0x17
 # http errors
 ERR_CODE_INVALID_URL            = 0x22
 ERR_CODE_HTTP_TIMEOUT           = 0x23
+ERR_CODE_DEVICE_UNREACHABLE     = 0x24
+ERR_CODE_DEVICE_DOWN            = 0x25
 # response errors
 ERR_CODE_INVALID_RSP_JSON       = 0x30
 ERR_CODE_INVALID_RSP_LEN        = 0x31
@@ -90,6 +91,13 @@ API_WEBSOCKET_RATES = [
     API_WEBSOCKET_RATE_10HZ,
 ]
 
+## frames per second for each rate
+API_WEBSOCKET_RATE_HZ = {
+    API_WEBSOCKET_RATE_1HZ: 1,
+    API_WEBSOCKET_RATE_5HZ: 5,
+    API_WEBSOCKET_RATE_10HZ: 10,
+}
+
 API_WEBSOCKET_DELIMITER_CHAR = 0x7C
 
 base_keys = ["dev_id", "periph_id"]
@@ -108,15 +116,19 @@ err_keys = ["error_code", "msg"]
 error_messages = {
     ERR_CODE_INVALID_RSP_JSON: "Invalid JSON in device response",
     ERR_CODE_HTTP_TIMEOUT: "Device response timed out",
+    ERR_CODE_DEVICE_UNREACHABLE: "Device is unreachable",
+    ERR_CODE_DEVICE_DOWN: "Device is down - request not sent",
     ERR_CODE_INVALID_URL: "Device URL is invalid",
     ERR_CODE_INVALID_RSP_LEN: "Response length is invalid",
     ERR_CODE_INVALID_JSON: "Invalid json in request",
     ERR_CODE_MISSING_FIELD: "Missing field in request",
     ERR_CODE_INVALID_CMD_PARAMS: "Invalid command parameters",
+    ERR_CODE_INVALID_DATA_TYPE: "Invalid data type",
     ERR_CODE_INVALID_DEV_ID: "Invalid device ID",
     ERR_CODE_INVALID_PERIPH_ID: "Invalid peripheral ID",
     ERR_CODE_INVALID_PARAM_ID: "Invalid parameter ID",
     ERR_CODE_INVALID_REQUEST: "Invalid request type",
+    ERR_CODE_INVALID_DATA_VALUE: "Invalid data value",
     ERR_CODE_ERROR_RESPONSE: "Device returned an error",
 }
 
@@ -144,15 +156,15 @@ def debug_print(msg):
 #   \param_id       - the parameter id
 class RequestPacket():
 
-    ''' a dict holding the json k/v pairs '''
-    fields = {}
     response_status = HTTP_RSP_NOT_AQUIRED
-    response = {}
     expected_rsp_t = 0xFF
     expected_rsp_keys = []
 
     ''' set the provided cmd type & url '''
     def __init__(self, url, cmd_type, periph_id, param_id):
+        ''' a dict holding the json k/v pairs - per instance so packets can be sent concurrently '''
+        self.fields = {}
+        self.response = {}
         self.fields["cmd_type"] = int(cmd_type)
         self.fields["param_id"] = int(param_id)
         self.fields["periph_id"] = int(periph_id)
@@ -166,29 +178,16 @@ class RequestPacket():
     def pkt_dict(self):
         return self.fields
 
-    ''' send the json fields to the url & return response/status '''
-    async def send_request(self):
+    ''' send the json fields to the url & return response/status
+        tracked=False leaves device health & per-device metrics alone
+    '''
+    async def send_request(self, timeout=None, tracked=True):
+        from .device_client import get_device_client
 
-        result = 0
-        response_data = {}
-        debug_print(f"posting data to {self.url}")
-        try:
-            async with aiohttp.ClientSession() as s:
-                async with s.post(self.url, json=self.fields) as rsp:
-                    response_data = await rsp.json()
-                    debug_print("sent")
-                    debug_print(self.dump_string())
-                    debug_print(f"Got response: (status: {rsp.status})")
-                    debug_print(response_data)
-                    result = HTTP_RSP_AQUIRED
-                    self.response_status = result
-                    self.response.update(response_data)
-        except json.JSONDecodeError:
-            result = ERR_CODE_INVALID_RSP_JSON
-        except aiohttp.ServerTimeoutError:
-            result = ERR_CODE_HTTP_TIMEOUT
-        except aiohttp.InvalidURL:
-            result = ERR_CODE_INVALID_URL
+        result, response_data = await get_device_client().post_json(self.url, self.fields, timeout=timeout, tracked=tracked)
+        if result == HTTP_RSP_AQUIRED:
+            self.response_status = result
+            self.response.update(response_data)
 
         return result, response_data
 
@@ -307,6 +306,8 @@ class ParamGetPacket(RequestPacket):
 class ParamSetPacket(RequestPacket):
 
     def __init__(self, url, periph_id, param_id, data, data_t):
+        self.expected_rsp_keys = ok_rsp_keys
+        super().__init__(url, CMD_TYPE_SET, periph_id, param_id)
         self.fields["data_type"] = int(data_t)
         if data_t == PARAMTYPE_BOOL:
             self.fields["data"] = True if data else False
@@ -316,8 +317,6 @@ class ParamSetPacket(RequestPacket):
             self.fields["data"] = float(data)
         else:
             self.fields["data"] = int(data)
-        self.expected_rsp_keys = ok_rsp_keys
-        super().__init__(url, CMD_TYPE_SET, periph_id, param_id)
 
             
 
@@ -329,6 +328,21 @@ class ParamActionPacket(RequestPacket):
 
 
 
+### 
+# utility - assemble url from device info
+#
+def assemble_url(target, port, ext):
+    url = "http://"
+    url += target
+    url += ":"
+    url += str(port)
+    if not ext.startswith("/"):
+        url += "/"
+    url += ext
+
+    return url
+
+
 def CommandTypeToInteger(cmd):
     retval = 0xFF
     
@@ -1,27 +1,43 @@
 
 
 import json
+import math
+import time
 import aiohttp
 import asyncio
-import struct
-from aiohttp.http_websocket import WSMsgType
 
 from asgiref.sync import sync_to_async
-from asyncio.futures import CancelledError
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.generic.http import AsyncHttpConsumer
 from channels.db import database_sync_to_async
 from asyncio.queues import Queue, QueueEmpty, QueueFull
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction, DatabaseError
+from django.conf import settings
 
 from datetime import datetime
 
 from .command_api import *
+from .device_client import get_device_client, API_EXT_HTTP_RQ_TIMEOUT
+from .enumeration import DeviceEnumerator, SubnetSweeper
+from .registry import registry
+from .write_behind import write_behind
+from .device_health import device_health
+from .get_cache import get_cache, get_cache_key, request_max_age
+from .led_dispatch import led_dispatcher
+from .scenes import apply_scene
+from .history import history
+from .stream_decoder import get_frame_layout
+from .stream_sessions import stream_key, join_stream, leave_stream
+from .ring_buffer import streaming_config
+from .decimation import StreamDecimator, DECIMATION_METHODS
+from .stream_encoder import FrameCoalescer, PROTOCOL_BINARY, STREAM_PROTOCOLS
+from .metrics import ERROR_RESPONSES, db_hop, err_code_name
+from .tracing import traced, span, set_trace_attr
 from . import models
 
 DEBUG = 1
 
-API_EXT_HTTP_RQ_TIMEOUT = 10
 API_MAX_HTTP_DATA_LEN = 1024
 
 API_WEBSOCKET_INCOMMING_STREAM_EXTENSION = "/stream"
@@ -37,6 +53,7 @@ def error_response(err_code: int, msg=None):
         msg = "unknown error!"
     elif msg == None:
         msg = error_messages[err_code]
+    ERROR_RESPONSES.labels(err_code_name(err_code)).inc()
     
     error_response = { 
          "rsp_type": RSP_TYPE_ERR,
@@ -72,41 +89,8 @@ def check_json_errors(data: dict, keys: list):
 #   @return status & dictionary of results
 ########################
 async def ext_http_post(url: str, data: dict):
+    return await get_device_client().post_json(url, data)
 
-    result = 0
-    response_data = {}
-    debug_print(f"posting data to {url}")
-    try:
-        async with aiohttp.ClientSession() as s:
-            async with s.post(url, json=data) as rsp:
-                response_data = await rsp.json()
-                debug_print("sent")
-                debug_print(data)
-                debug_print(f"Got response: (status: {rsp.status})")
-                debug_print(response_data)
-                result = HTTP_RSP_AQUIRED
-    except json.JSONDecodeError:
-        result = ERR_CODE_INVALID_RSP_JSON
-    except aiohttp.ClientTimeout:
-        result = ERR_CODE_HTTP_TIMEOUT
-    except aiohttp.InvalidURL:
-        result = ERR_CODE_INVALID_URL
-
-    return result, response_data
-
-### 
-# utility - assemble url from device info
-#
-def assemble_url(target, port, ext):
-    url = "http://"
-    url += target
-    url += ":"
-    url += str(port)
-    if(ext[0] != "/"):
-        url+="/"
-    url += ext
-
-    return url
 
 
 ##
@@ -114,8 +98,7 @@ def assemble_url(target, port, ext):
 #   @data  dictionary data from a set request
 #   @param_object parameter model
 ###
-@database_sync_to_async
-def update_parameter(data, param_object):
+async def update_parameter(data, param_object):
     if type(data) == str and param_object.data_type != PARAMTYPE_STRING:
         try:
             d = int(data)
@@ -126,13 +109,16 @@ def update_parameter(data, param_object):
                 print("Error in converting value type: " + type(d))
     else:
         d = data
+    ## every numeric reading goes to the history, changed or not
+    if param_object != None and param_object.data_type != PARAMTYPE_STRING and isinstance(d, (int, float)):
+        history.record(param_object.pk, time.time(), d)
     try:
         if param_object != None and param_object.last_value != d:
             if param_object.data_type == PARAMTYPE_STRING:
                 param_object.last_value_string = str(d)
             else:
                 param_object.last_value = d
-            param_object.save()
+            write_behind.record(param_object)
             print("param value updated")
         else:
             print("Not updating")
@@ -142,174 +128,117 @@ def update_parameter(data, param_object):
 
 
 ## returns a parameter object
-@database_sync_to_async
-def get_param_object(dev_id, periph_id, param_id):
-    try:
-        param = models.Parameter.objects.filter(peripheral__periph_id=periph_id).filter(peripheral__device__dev_id=dev_id).get(param_id=param_id)
-        return param
-    except ObjectDoesNotExist:
+async def get_param_object(dev_id, periph_id, param_id):
+    await registry.ensure_loaded()
+    param = registry.get_parameter(dev_id, periph_id, param_id)
+    if param is None:
         print("Invalid id")
-        return None
+    return param
 
 
 ## returns a device object
-@database_sync_to_async
-def get_device_object(dev_id):
-    try:
-        dev = models.Device.objects.get(dev_id=dev_id)
-        return dev
-    except ObjectDoesNotExist:
+async def get_device_object(dev_id):
+    await registry.ensure_loaded()
+    dev = registry.get_device(dev_id)
+    if dev is None:
         print("Invalid id")
-        return None
+    return dev
 
 
 ## checks invalid device
-@database_sync_to_async
-def is_invalid_dev(dev_id):
-    try:
-        obj = models.Device.objects.get(dev_id=dev_id)
-        return False
-    except ObjectDoesNotExist:
-        return True
+async def is_invalid_dev(dev_id):
+    await registry.ensure_loaded()
+    return registry.get_device(dev_id) is None
 
 
 ## checks if invalid peripheral
-@database_sync_to_async
-def is_invalid_periph(dev_id, p_id):
-    try:
-        obj = models.Peripheral.objects.filter(device__dev_id=dev_id).get(periph_id=p_id)
-        return False
-    except ObjectDoesNotExist:
-        return True
+async def is_invalid_periph(dev_id, p_id):
+    await registry.ensure_loaded()
+    return registry.get_peripheral(dev_id, p_id) is None
 
 
 ## checks if invalid parameter
-@database_sync_to_async
-def is_invalid_param(d_id, p_id, prm_id):
-    try:
-        obj = models.Parameter.objects.filter(peripheral__periph_id=p_id).filter(peripheral__device__dev_id=d_id).get(param_id=prm_id)
-        return False
-    except ObjectDoesNotExist:
-        return True
+async def is_invalid_param(d_id, p_id, prm_id):
+    await registry.ensure_loaded()
+    return registry.get_parameter(d_id, p_id, prm_id) is None
 
 
 ## Checks if is an existing device
-@database_sync_to_async
-def is_existing_device(d_id: int):
-    exists = False
-    try:
-        D = models.Device.objects.get(dev_id=d_id)
-        exists = True
-    except:
-        exists = False
-    return exists
+async def is_existing_device(d_id: int):
+    await registry.ensure_loaded()
+    return registry.get_device(d_id) is not None
+
+
+## parameter method flags from the api methods bitfield
+def param_method_flags(methods):
+    if methods is None:
+        methods = 0
+    return {
+        "is_getable": (methods & API_GET_MASK) > 0,
+        "is_setable": (methods & API_SET_MASK) > 0,
+        "is_action": (methods & API_ACT_MASK) > 0,
+        "is_streamable": (methods & API_STREAM_MASK) > 0,
+    }
 
 
-## create a new device database entry 
-@database_sync_to_async
-def build_new_device(d_info: dict):
-    success = True
+##
+#   @brief stores an enumerated device tree in a single transaction
+#          the device, its peripherals & their parameters are each written with
+#          one statement - if any part fails nothing is stored
+#   @d_info nested device dictionary from the DeviceEnumerator
+#   @return success, (device count, peripheral count, parameter count)
+###
+@db_hop("build_device_tree")
+def build_device_tree(d_info: dict):
     try:
-        D = models.Device(
-            name=d_info['name'],
-            dev_id=d_info['dev_id'],
-            last_polled=d_info['last_polled'],
-            ip_address=d_info['ip_addr'],
-            api_port=d_info['api_port'],
-            cmd_url=d_info['cmd_url'],
-            num_peripherals=d_info['periph_num'],
-            sleep_state=d_info['sleep_state'],
-            is_powered=d_info['is_powered'],
-            setup_date=d_info['setup_date'],
-        )
-    except KeyError:
-        print("Key Error!")
-        raise
-        success = False
-    except:
-        raise
-
-    if success:
-        try:
+        with transaction.atomic():
+            D = models.Device(
+                name=d_info['name'],
+                dev_id=d_info['dev_id'],
+                last_polled=d_info['last_polled'],
+                ip_address=d_info['ip_addr'],
+                api_port=d_info['api_port'],
+                cmd_url=d_info['cmd_url'],
+                num_peripherals=d_info['periph_num'],
+                sleep_state=d_info['sleep_state'],
+                is_powered=d_info['is_powered'],
+                setup_date=d_info['setup_date'],
+            )
             D.save()
-        except:
-            success = False
-    return success
-
-
-## create a new periph database entry 
-@database_sync_to_async
-def build_new_peripheral(p_info: dict):
-    success = True
 
-    try:
-        D = models.Device.objects.get(dev_id=p_info['device'])
-
-        P = models.Peripheral(
-            periph_id=p_info['periph_id'],
-            periph_type=p_info['periph_type'],
-            device=D,
-            name=p_info['name'],
-            num_params=p_info['param_num'],
-            sleep_state=0,
-            is_powered=1,
-        )
-
-    except KeyError:
-        print("Key Error!")
-        success = False
-        raise
-    except ObjectDoesNotExist:
-        print("Parent Object does not exist!")
-        success = False
-
-
-    if success:
-        try:
-            P.save()
-        except:
-            success = False
-            raise
-    return success
-
-
-## create a new param database entry 
-@database_sync_to_async
-def build_new_parameter(prm_info: dict, dev_id: int):
-    success = True
-
-    try:
-        Per = models.Peripheral.objects.filter(device__dev_id=dev_id).get(periph_id=prm_info['periph_id'])
-
-        P = models.Parameter(
-            param_id=prm_info['param_id'],
-            peripheral=Per,
-            name=prm_info['name'],
-            max_value=prm_info['max_value'],
-            data_type=prm_info['data_type'],
-            is_getable=prm_info['is_gettable'],
-            is_setable=prm_info['is_settable'],
-            is_action=prm_info['is_action'],
-            is_streamable=prm_info['is_streamable']
-        )
-
-    except KeyError:
-        print("Key Error!")
-        success = False
-        raise
-    except ObjectDoesNotExist:
-        print("Parent Object does not exist!")
-        success = False
-    except:
-        raise
-
-    if success:
-        try:
-            P.save()
-        except:
-            success = False
-            raise
-    return success
+            periphs = models.Peripheral.objects.bulk_create([
+                models.Peripheral(
+                    periph_id=p_info['periph_id'],
+                    periph_type=p_info['periph_type'],
+                    device=D,
+                    name=p_info['name'],
+                    num_params=p_info['param_num'],
+                    sleep_state=0,
+                    is_powered=1,
+                ) for p_info in d_info['peripherals']
+            ])
+
+            ## not all backends set the pk from bulk_create (sqlite on older django)
+            if any(P.pk is None for P in periphs):
+                periphs = list(models.Peripheral.objects.filter(device=D))
+            periph_map = {P.periph_id: P for P in periphs}
+
+            params = models.Parameter.objects.bulk_create([
+                models.Parameter(
+                    param_id=prm_info['param_id'],
+                    peripheral=periph_map[p_info['periph_id']],
+                    name=prm_info['name'],
+                    max_value=prm_info['max_value'],
+                    data_type=prm_info['data_type'],
+                    **param_method_flags(prm_info['methods'])
+                ) for p_info in d_info['peripherals'] for prm_info in p_info['parameters']
+            ])
+    except (KeyError, TypeError, DatabaseError) as e:
+        print(f"Error storing device tree: {e}")
+        return False, (0, 0, 0)
+
+    registry.invalidate()
+    return True, (1, len(periphs), len(params))
 
 
 ########################
@@ -355,7 +284,7 @@ async def build_request(data):
             if fail:
                 response = error_response(ERR_CODE_INVALID_PERIPH_ID)
         elif "param_id" in data.keys():
-            fail = is_invalid_param(data['dev_id'], data['periph_id'], data['param_id'])
+            fail = await is_invalid_param(data['dev_id'], data['periph_id'], data['param_id'])
             if fail:
                 response = error_response(ERR_CODE_INVALID_PARAM_ID)
 
@@ -403,19 +332,20 @@ async def build_request(data):
 
         device_object = await get_device_object(data['dev_id'])
 
-        if cmd_type != CMD_TYPE_STREAM:
-            url = "http://"
-        else:
-            url = "ws://"
-        url += device_object.ip_address
-        url += ":"
-        url += str(device_object.api_port)
-        if not device_object.cmd_url.startswith("/"):
-            url += "/"
-        if cmd_type != CMD_TYPE_STREAM:
-            url += device_object.cmd_url
-        else:
-            url += "stream" ### TODO: This better!
+        with span("url"):
+            if cmd_type != CMD_TYPE_STREAM:
+                url = "http://"
+            else:
+                url = "ws://"
+            url += device_object.ip_address
+            url += ":"
+            url += str(device_object.api_port)
+            if not device_object.cmd_url.startswith("/"):
+                url += "/"
+            if cmd_type != CMD_TYPE_STREAM:
+                url += device_object.cmd_url
+            else:
+                url += "stream" ### TODO: This better!
 
     ret = (fail, response, url)
     debug_print(f"build request returning Fail={fail} response={response} url={url}")
@@ -424,67 +354,261 @@ async def build_request(data):
 
 
 
+########################
+#   send_command(rq, url, dev_id, max_age)
+#   sends a built request to the device & updates
+#   the stored parameter value from data responses
+#   GETs are served from the GET cache when fresh (max_age overrides
+#   the parameter's ttl), SETs & ACTs invalidate the cached GET
+#   a GET answered after a SET/ACT to the parameter started is returned
+#   but not stored, as it may hold the value from before the write
+#   returns the response or error response dict
+########################
+async def send_command(rq: dict, url: str, dev_id, max_age: float = None):
+    cmd_type = rq.get('cmd_type')
+    key = get_cache_key(dev_id, rq.get('periph_id'), rq.get('param_id'))
+    param = None
+    generation = None
+    if key is not None and cmd_type == CMD_TYPE_GET:
+        generation = get_cache.generation(key)
+        param = await get_param_object(dev_id, rq['periph_id'], rq['param_id'])
+        if param != None:
+            cached = get_cache.get(key, get_cache.ttl_for(param), max_age)
+            if cached is not None:
+                debug_print(f"GET served from cache {key}")
+                set_trace_attr("cache", "hit")
+                return cached
+    elif key is not None and cmd_type in (CMD_TYPE_SET, CMD_TYPE_ACTION):
+        get_cache.invalidate(key)
+
+    with span("http"):
+        result, response = await ext_http_post(url, rq)
+    if result != HTTP_RSP_AQUIRED:
+        set_trace_attr("error", err_code_name(result))
+        response = error_response(result)
+    elif response.get('rsp_type') == RSP_TYPE_DATA:
+        if param is None:
+            param = await get_param_object(dev_id, response['periph_id'], response['param_id'])
+        if generation is not None and generation != get_cache.generation(key):
+            debug_print(f"GET of {key} overtaken by a write - not stored")
+        elif param != None:
+            debug_print("updating")
+            with span("update_parameter"):
+                await update_parameter(response['data'], param)
+            if generation is not None:
+                get_cache.put(key, response, generation)
+
+    ## a GET which finished after this SET/ACT started may have cached the old value
+    if key is not None and cmd_type in (CMD_TYPE_SET, CMD_TYPE_ACTION):
+        get_cache.invalidate(key)
+    return response
+
+
+## batch commands - command types allowed in a batch & limits
+BATCH_CMD_TYPES = [CMD_TYPE_GET, CMD_TYPE_SET, CMD_TYPE_ACTION]
+BATCH_DEFAULTS = {
+    "MAX_COMMANDS": 100,
+    "DEVICE_CONCURRENCY": 2,
+}
+
+
+def batch_config():
+    config = dict(BATCH_DEFAULTS)
+    config.update(getattr(settings, "COMMAND_BATCH", {}))
+    return config
+
+
 ##
 #   Command consumer - websocket consumer for direct device commands
 #
+#   single command:
+#       {"cmd_type": "GET", "dev_id": 1, "periph_id": 1, "param_id": 2, ...}
+#   batch of commands - results are sent back as each completes, tagged with the corr_id:
+#       {"cmd_type": "BATCH", "batch_id": "b1", "commands": [{"corr_id": "c1", "cmd_type": "GET", ...}, ...]}
+#   apply a scene (by name, or by primary key with "scene_id") - every SET is sent at once, one report
+#   comes back when all are done:
+#       {"cmd_type": "SCENE", "scene": "evening", "force": false}
+#
 class CommandConsumer(AsyncWebsocketConsumer):
 
     def __init__(self, **kwargs):
         super().__init__()
-        
+        self.batch_tasks = set()
+
 
     async def receive(self, text_data):
-        data = json.loads(text_data)
-        
-        fail, rq, url = await build_request(data)
-        
-        ## if fail, return error message ##
-        if fail == True:
-            await self.send(json.dumps(rq))
-        else:
-            ## send the external http request ##
-            print("sending")
-            print(rq)
-            result, response = await ext_http_post(url, rq)
-            if result != HTTP_RSP_AQUIRED:
-                response = error_response(result)
+        try:
+            data = json.loads(text_data)
+        except json.JSONDecodeError:
+            await self.send(json.dumps(error_response(ERR_CODE_INVALID_JSON)))
+            return
+
+        cmd_type = str(data.get('cmd_type', "")).upper()
+        if cmd_type in ("BATCH", "SCENE"):
+            ## run the batch/scene in the background so we can keep receiving ##
+            run = self.run_batch if cmd_type == "BATCH" else self.run_scene
+            task = asyncio.ensure_future(self.run_traced(cmd_type.lower(), run, data))
+            self.batch_tasks.add(task)
+            task.add_done_callback(self.batch_tasks.discard)
+            return
+
+        with traced("command", cmd_type=cmd_type, dev_id=data.get('dev_id'), periph_id=data.get('periph_id'), param_id=data.get('param_id')):
+            with span("build_request"):
+                fail, rq, url = await build_request(data)
+
+            ## if fail, return error message ##
+            if fail == True:
+                set_trace_attr("error", err_code_name(rq.get('err_code')))
+                response = rq
             else:
-                if response['rsp_type'] == RSP_TYPE_DATA:
-                    param = await get_param_object(data['dev_id'], response['periph_id'], response['param_id'])
-                    if param != None:
-                        print("updating")
-                        await update_parameter(response['data'], param)
-            
-            await self.send(json.dumps(response))
+                ## send the external http request ##
+                debug_print(f"sending {rq}")
+                response = await send_command(rq, url, data['dev_id'], request_max_age(data))
+
+            with span("serialize"):
+                packet = json.dumps(response)
+            with span("send"):
+                await self.send(packet)
+
+
+    async def disconnect(self, code):
+        for task in list(self.batch_tasks):
+            task.cancel()
+
+
+    ''' run a batch/scene as a single trace '''
+    async def run_traced(self, name, run, data):
+        with traced(name, ref=data.get('batch_id', data.get('scene_id', data.get('scene')))):
+            await run(data)
+
+
+    async def send_batch_result(self, batch_id, corr_id, response: dict):
+        result = dict(response)
+        result['packet_type'] = "batch_result"
+        result['batch_id'] = batch_id
+        result['corr_id'] = corr_id
+        with span("serialize"):
+            packet = json.dumps(result)
+        with span("send"):
+            await self.send(packet)
+
+
+    async def validate_batch_command(self, command):
+        """ checks a single batch command & builds the request
+            returns fail, request/error response, url
+        """
+        if type(command) is not dict:
+            return True, error_response(ERR_CODE_INVALID_JSON), ""
+        if CommandTypeToInteger(str(command.get('cmd_type', ""))) not in BATCH_CMD_TYPES:
+            return True, error_response(ERR_CODE_INVALID_REQUEST), ""
+        try:
+            return await build_request(command)
+        except KeyError as e:
+            return True, error_response(ERR_CODE_MISSING_FIELD, f"Missing field {e}"), ""
+        except (TypeError, ValueError):
+            return True, error_response(ERR_CODE_INVALID_DATA_TYPE, "Invalid data type in request"), ""
+
+
+    async def run_batch(self, data):
+        """ validate every command in the batch up front, then dispatch the valid ones
+            concurrently with a cap on in-flight requests per device
+        """
+        config = batch_config()
+        batch_id = data.get('batch_id')
+        commands = data.get('commands')
+
+        if type(commands) is not list or len(commands) == 0:
+            await self.send_batch_result(batch_id, None, error_response(ERR_CODE_MISSING_FIELD, "Batch has no commands"))
+            return
+        if len(commands) > config["MAX_COMMANDS"]:
+            await self.send_batch_result(batch_id, None, error_response(ERR_CODE_INVALID_REQUEST, f"Batch exceeds {config['MAX_COMMANDS']} commands"))
+            return
+
+        corr_ids = [c.get('corr_id', i) if type(c) is dict else i for i, c in enumerate(commands)]
+        with span("build_request"):
+            built = [await self.validate_batch_command(c) for c in commands]
+
+        failed = 0
+        dispatch = []
+        device_locks = {}
+        for corr_id, command, (fail, rq, url) in zip(corr_ids, commands, built):
+            if fail:
+                failed += 1
+                await self.send_batch_result(batch_id, corr_id, rq)
+            else:
+                dev_key = str(command['dev_id'])
+                if dev_key not in device_locks:
+                    device_locks[dev_key] = asyncio.Semaphore(config["DEVICE_CONCURRENCY"])
+                dispatch.append((corr_id, command, rq, url, device_locks[dev_key]))
+
+        async def dispatch_one(corr_id, command, rq, url, lock):
+            ## one failing command is reported as its own result, not the end of the batch
+            try:
+                async with lock:
+                    response = await send_command(rq, url, command['dev_id'], request_max_age(command))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Batch {batch_id} command {corr_id} failed: {e!r}")
+                response = error_response(ERR_CODE_DEVICE_UNREACHABLE, f"Command failed: {type(e).__name__}")
+            return corr_id, response
+
+        try:
+            for done in asyncio.as_completed([dispatch_one(*d) for d in dispatch]):
+                corr_id, response = await done
+                if response.get('rsp_type') == RSP_TYPE_ERR:
+                    failed += 1
+                await self.send_batch_result(batch_id, corr_id, response)
+        finally:
+            await self.send(json.dumps({
+                "packet_type": "batch_done",
+                "batch_id": batch_id,
+                "count": len(commands),
+                "failed": failed,
+            }))
+
+
+    async def run_scene(self, data):
+        """ apply a scene & send back the per-target report """
+        scene_id = data.get('scene_id')
+        name = data.get('scene')
+        if (scene_id is None) == (name is None):
+            await self.send(json.dumps(error_response(ERR_CODE_MISSING_FIELD, "Give one of 'scene_id' or 'scene'")))
+            return
+        if scene_id is not None:
+            try:
+                scene_id = int(scene_id)
+            except (TypeError, ValueError):
+                await self.send(json.dumps(error_response(ERR_CODE_INVALID_DATA_TYPE, "scene_id must be an integer")))
+                return
+        else:
+            name = str(name)
+        report = await apply_scene(scene_id, name, bool(data.get('force', False)), batch_config()["DEVICE_CONCURRENCY"])
+        if report is None:
+            await self.send(json.dumps(error_response(ERR_CODE_INVALID_REQUEST, f"No scene {scene_id if scene_id is not None else name}")))
+            return
+        report['packet_type'] = "scene_result"
+        await self.send(json.dumps(report))
 
 
 ##
 #   LedControl - websocket consumer for the led control page
+#   colours are handed to the led dispatcher, which sends to every selected strip
+#   concurrently & drops colours superseded before they were sent
 #
 class LedCtrlConsumer(AsyncWebsocketConsumer):
 
     async def websocket_receive(self, msg):
-        print(msg)
         d = msg["text"]
-        data = json.loads(d)
-        print(data)
         try:
+            data = json.loads(d)
             led_ids = data["led_ids"]
             col = data["rgb_col"]
 
             led_devices = [(x.split("_")[0], x.split("_")[1]) for x in led_ids]
             
             for pair in led_devices:
-                dev = await get_device_object(pair[1])
-                url = assemble_url(dev.ip_address, dev.api_port, dev.cmd_url)
-
-                Request = ParamSetPacket(url, pair[0], 3, col, PARAMTYPE_UINT32)
-                res, rsp = await Request.send_request()
-                if res != HTTP_RSP_AQUIRED:
-                    print("Error in request!")
-                else:
-                    p = await get_param_object(pair[1], pair[0], 3)
-                    await update_parameter(col, p)
+                led_dispatcher.submit(pair[1], pair[0], col)
         except Exception as e:
             print("Error occured")
             print(e)
@@ -495,21 +619,16 @@ class LedCtrlConsumer(AsyncWebsocketConsumer):
 #
 class Discoverer(AsyncWebsocketConsumer):
 
-    def build_url(self, target, port, ext):
-        url = "http://"
-        url += target
-        url += ":"
-        url += str(port)
-        if(ext[0] != "/"):
-            url+="/"
-        url += ext
-
-        return url
-
     ## Websocket receive ##
     async def receive(self, text_data):
         
         data = json.loads(text_data)
+
+        ## sweep mode - probe a whole network ##
+        if "cidr" in data.keys():
+            await self.sweep_network(data)
+            return
+
         try:
             target = data['ip_addr']
             ext = data['extension']
@@ -521,90 +640,83 @@ class Discoverer(AsyncWebsocketConsumer):
 
         await self.send(json.dumps({"data": f"> Enumerating device at [{target}]", "code": 1}))
 
-        await self.enumerate_device(target, port, ext)
+        with traced("enumerate", target=target, port=port):
+            await self.enumerate_device(target, port, ext)
 
 
+    ## send a progress message to the discover console
+    async def report(self, msg: str, code: int):
+        await self.send(json.dumps({"data": msg, "code": code}))
+
+    ## Sweep a network for devices, optionally enumerating the new ones
+    async def sweep_network(self, data):
+        """
+            Probe every address/port in the cidr range concurrently
+            Report responders as they are found
+            Queue new devices for enumeration if requested - enumerations run one at a time
+        """
+        ext = data.get('extension', "")
+        queue_enumeration = bool(data.get('enumerate', False))
+        queue = asyncio.Queue()
+
+        async def found(device):
+            known = await is_existing_device(device['dev_id'])
+            device['known'] = known
+            await self.send(json.dumps({
+                "data": f"+ Found {device['name']} [id: {hex(device['dev_id'])}] at {device['ip_addr']}:{device['port']}" + (" (known)" if known else ""),
+                "code": 201,
+                "found": device,
+            }))
+            if queue_enumeration and not known:
+                queue.put_nowait(device)
+
+        async def enumerate_worker():
+            while True:
+                device = await queue.get()
+                try:
+                    with traced("enumerate", target=device['ip_addr'], port=device['port']):
+                        await self.enumerate_device(device['ip_addr'], device['port'], device['extension'])
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    ## report & move on - a dead worker would leave queue.join() waiting forever
+                    print(f"Error enumerating {device['ip_addr']}:{device['port']}: {e!r}")
+                    await self.send(json.dumps({"data": f"Error enumerating {device['ip_addr']}:{device['port']} - {type(e).__name__}", "code": 506}))
+                finally:
+                    queue.task_done()
+
+        try:
+            sweeper = SubnetSweeper(data['cidr'], data.get('ports', [80]), ext, found)
+        except (ValueError, TypeError) as e:
+            await self.send(json.dumps({"data": f"Error: {e}", "code": 506}))
+            return
+
+        await self.send(json.dumps({"data": f"> Sweeping {sweeper.network} on ports {sweeper.ports}", "code": 1}))
+
+        worker = asyncio.ensure_future(enumerate_worker())
+        try:
+            responders = await sweeper.sweep()
+            await self.send(json.dumps({"data": f"Sweep complete - found {len(responders)} devices", "code": 200}))
+            await queue.join()
+        finally:
+            worker.cancel()
+
     ## Enumerate the device at target:port/extension
     async def enumerate_device(self, target, port, ext):
         """ 
-            Send sequential/recursive info requests
+            Send concurrent info requests for peripherals & parameters
             Create a nested data structure from responses
             Store the new device in database
         """
         fail = False
-        url = self.build_url(target, port, ext)
+        url = assemble_url(target, port, ext)
 
         await self.send(json.dumps({"data": "Starting........****", "code": 200 }))
         await self.send(json.dumps({"data": f"Enumerating Device at {url}", "code": 200 }))
 
-        # use the new packet class! # 
-        devInfo = DevInfoPacket(url)
-        res_d, rsp_d = await devInfo.send_request()
-        
-        ## Do safety dance
-        if res_d != HTTP_RSP_AQUIRED:
-            await self.send(json.dumps(error_response(res_d)))
-            fail = True
-        else:
-            device_data = {
-                "name": devInfo.get_response_value("name"),
-                "periph_num": devInfo.get_response_value("periph_num"),
-                "dev_id": devInfo.get_response_value("dev_id"),
-                "last_polled": datetime.now(),
-                "ip_addr": target,
-                "api_port": int(port),
-                "cmd_url": ext,
-                "sleep_state": 0,
-                "is_powered": True,
-                "setup_date": datetime.now(),
-                "peripherals": [],
-            }
-            await self.send(json.dumps({"data": f"> Device {device_data['name']} [id: {hex(device_data['dev_id'])}]", "code": 200 }))
-
-            ## recusively get info about peripherals
-            for p in devInfo.get_periph_ids():
-                periphInfo = PeriphInfoPacket(url, p)
-                res_p, rsp_p = await periphInfo.send_request()
-                ## Do safety dance
-                if res_p != HTTP_RSP_AQUIRED:
-                    await self.send(json.dumps(error_response(res_p)))
-                    fail = True
-                else:
-                    periph_data = {
-                        "device": device_data["dev_id"],
-                        "periph_id": periphInfo.get_response_value("periph_id"),
-                        "name": periphInfo.get_response_value("name"),
-                        "param_num": periphInfo.get_response_value("param_num"),
-                        "param_ids": periphInfo.get_param_ids(),
-                        "periph_type": periphInfo.get_response_value("periph_type"),
-                        "sleep_state": 0,
-                        "parameters": [],
-                    }
-                    await self.send(json.dumps({"data": f">> Peripheral {periph_data['name']} [id: {hex(periph_data['periph_id'])}]", "code": 200 }))
-
-                    ## recusively get info about parameters
-                    for prm in periphInfo.get_param_ids():
-                        paramInfo = ParamInfoPacket(url, p, prm)
-                        res_prm, rsp_prm = await periphInfo.send_request()
-                        ## Da da Da da DaDa Da Da Da Safety Dance
-                        if res_prm != HTTP_RSP_AQUIRED:
-                            await self.send(json.dumps(error_response(res_prm)))
-                            fail = True
-                        else: 
-                            param_data = {
-                                "name": paramInfo.get_response_value("param_name"),
-                                "periph_id": periph_data["periph_id"],
-                                "param_id": paramInfo.get_response_value("param_id"),
-                                "param_type": 0,
-                                "methods": paramInfo.get_response_value("methods"),
-                                "max_value": paramInfo.get_response_value("param_max"),
-                                "data_type": paramInfo.get_response_value("data_type"),
-                            }
-                            print(param_data)
-                            await self.send(json.dumps({"data": f">>> Parameter {param_data['name']} [id: {hex(param_data['param_id'])}]", "code": 200 }))
-                            periph_data["parameters"].append(param_data)
-
-                    device_data["peripherals"].append(periph_data)
+        enumerator = DeviceEnumerator(url, target, port, ext, report=self.report)
+        with span("network"):
+            fail, device_data = await enumerator.enumerate()
 
         if not fail:
             await self.send(json.dumps({"data": " Device succesfully enumerated", "code": 200 }))
@@ -614,36 +726,15 @@ class Discoverer(AsyncWebsocketConsumer):
 
         # store the items
         if not fail:
-
-            result = await build_new_device(device_data)
+            with span("database"):
+                result, counts = await build_device_tree(device_data)
             if not result:
-                await self.send(json.dumps({"data": "- - - failed when creating new Device", "code": 506}))
+                await self.send(json.dumps({"data": "- - - failed when storing the Device, nothing was saved", "code": 506}))
                 fail = True
             else:
-                await self.send(json.dumps({"data": "- - - Created new Device [id]", "code": 201}))
-                
-            if not fail:
-
-                for periph in device_data["peripherals"]:
-                    result = await build_new_peripheral(periph)
-                    if not result:
-                        await self.send(json.dumps({"data": "- - - failed when creating new peripheral", "code": 506}))
-                        fail = True
-                    else:
-                        await self.send(json.dumps({"data": "- - - Created new Peripheral [id]", "code": 201}))
-                
-                    for param in periph["parameters"]:
-                        param['is_gettable']    = ((param['methods'] & API_GET_MASK) > 0) if param['methods'] is not None else 0
-                        param['is_settable']    = ((param['methods'] & API_SET_MASK) > 0) if param['methods'] is not None else 0
-                        param['is_action']      = ((param['methods'] & API_ACT_MASK) > 0) if param['methods'] is not None else 0
-                        param['is_streamable']  = ((param['methods'] & API_STREAM_MASK) > 0) if param['methods'] is not None else 0
-
-                        result = await build_new_parameter(param, periph["device"])
-                        if not result:
-                            await self.send(json.dumps({"data": "- - - failed when creating new parameter", "code": 506}))
-                            fail = True
-                        else:
-                            await self.send(json.dumps({"data": "- - - Created new Parameter [id]", "code": 201}))
+                await self.send(json.dumps({"data": f"- - - Created new Device [id: {hex(device_data['dev_id'])}]", "code": 201}))
+                await self.send(json.dumps({"data": f"- - - Created {counts[1]} Peripherals", "code": 201}))
+                await self.send(json.dumps({"data": f"- - - Created {counts[2]} Parameters", "code": 201}))
 
         if not fail:
             await self.send(json.dumps({"data": "Succesfully enumerated Device!", "code": 201}))
@@ -654,12 +745,18 @@ class Discoverer(AsyncWebsocketConsumer):
 
 
 class DeviceStream(AsyncWebsocketConsumer):
-    """ this consumer hosts the websocket for the device to connect to
+    """ this consumer streams device data to a browser client
+        clients streaming the same device/peripheral/parameters share a single
+        upstream connection to the device (see stream_sessions.py)
+        a client can ask for decimated data by adding "decimation" ("minmax" or "lttb")
+        and either "points_per_second" or "resolution" (points per "window" seconds)
+        to the start request - it is then sent ws_series packets every
+        DECIMATION_INTERVAL instead of a ws_data packet per frame
+        a client can ask for binary frames with "protocol": "binary" & an optional
+        "window_ms" - samples are then coalesced into one binary frame per window
+        (see stream_encoder.py), after a ws_stream_info packet naming the columns
     """
 
-    established = False
-    middleman_task = None
-
     start_tags = {
         "dev_id": int, 
         "periph_id": int, 
@@ -668,6 +765,13 @@ class DeviceStream(AsyncWebsocketConsumer):
         "type": int
     }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = None
+        self.decimator = None
+        self.coalescer = None
+        self.flush_task = None
+
 
     def check_valid_tags(self, data, tags):
         err = 0
@@ -681,190 +785,207 @@ class DeviceStream(AsyncWebsocketConsumer):
         return True if not err else False
 
 
-    async def websocket_connect(self, message):
-        await super().websocket_connect(message)
-        await self.channel_layer.group_add("stream", self.channel_name)
-
+    async def disconnect(self, code):
+        await self.leave()
 
-    async def websocket_disconnect(self, message):
-        if self.established and self.middleman_task != None:
-            print("Trying to cancel middle-man task...")
-            self.middleman_task.cancel()
-            try:
-                await self.middleman_task
-            except asyncio.CancelledError:
-                print("Task succesfully cancelled")
-        return super().websocket_disconnect(message)
 
+    ''' unsubscribe from the current stream '''
+    async def leave(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        self.decimator = None
+        self.coalescer = None
+        if self.session is not None:
+            await leave_stream(self.session, self.channel_name)
+            self.session = None
 
 
-    async def websocket_receive(self, message):
+    def build_decimator(self, start_data):
+        """ returns fail, a StreamDecimator for the start request (None if not asked for) """
+        method = start_data.get('decimation')
+        if method is None:
+            return False, None
+        if method not in DECIMATION_METHODS:
+            return True, f"Unknown decimation method {method}"
 
-        if not self.established:
-            start_data = json.loads(message['text'])
-            print(start_data)
-            if not self.check_valid_tags(start_data, self.start_tags):
-                print("Invalid stream request")
+        try:
+            if 'points_per_second' in start_data:
+                rate = float(start_data['points_per_second'])
+            elif 'resolution' in start_data:
+                window = float(start_data.get('window', streaming_config()["BACKFILL_SECONDS"]))
+                rate = float(start_data['resolution']) / window
             else:
-                (fail, req, url) = await build_request(start_data)
-                if(fail):
-                    print("Error whilst building the request")
-                else:
-                    ## need to get the expected packet structure here
-                    fail, format_details = await self.format_string_from_param_list(start_data)
-                    if fail:
-                        print("Error building packet details")
-                    else:
-                        print("Succesfully built packet - start the middle-man task...")
-                        self.middleman_task = asyncio.create_task(self.websocket_bridge(url, req, format_details))
+                return True, "Decimation needs points_per_second or resolution"
+        except (TypeError, ValueError, ZeroDivisionError):
+            return True, "Invalid decimation rate"
+        if rate <= 0:
+            return True, "Invalid decimation rate"
+        return False, StreamDecimator(method, rate)
+
+
+    def build_coalescer(self, start_data):
+        """ returns fail, (FrameCoalescer, window seconds) for the start request (None if not asked for) """
+        protocol = start_data.get('protocol', "json")
+        if protocol not in STREAM_PROTOCOLS:
+            return True, f"Unknown stream protocol {protocol}"
+        if protocol != PROTOCOL_BINARY:
+            return False, None
+        if 'decimation' in start_data:
+            return True, "Decimation is not supported with the binary protocol"
+
+        try:
+            window = float(start_data.get('window_ms', streaming_config()["BINARY_WINDOW_MS"])) / 1000
+        except (TypeError, ValueError):
+            return True, "Invalid window_ms"
+        if window <= 0:
+            return True, "Invalid window_ms"
+        return False, (FrameCoalescer(), window)
+
+
+    def parse_backfill(self, start_data):
+        """ returns fail, the seconds of backfill asked for, clamped to what the buffer holds (None for the default) """
+        if start_data.get('backfill') is None:
+            return False, None
+        try:
+            seconds = float(start_data['backfill'])
+        except (TypeError, ValueError):
+            return True, "Invalid backfill"
+        if not math.isfinite(seconds) or seconds < 0:
+            return True, "Invalid backfill"
+        return False, min(seconds, streaming_config()["BUFFER_SECONDS"])
+
+
+    ''' call flush every interval until cancelled '''
+    async def flush_loop(self, interval, flush):
+        while True:
+            await asyncio.sleep(interval)
+            await flush(interval)
+
+
+    ''' send the decimated samples queued since the last flush '''
+    async def flush_decimated(self, interval):
+        series = self.decimator.flush(interval)
+        if series is not None:
+            await self.send(json.dumps({
+                "packet_type": "ws_series",
+                "series": series,
+            }))
+
+
+    ''' send the samples queued since the last flush as one binary frame '''
+    async def flush_binary(self, interval):
+        frame = self.coalescer.flush()
+        if frame is not None:
+            await self.send(bytes_data=frame)
+
+
+    async def receive(self, text_data=None, bytes_data=None):
+        start_data = json.loads(text_data)
+        print(start_data)
+        if not self.check_valid_tags(start_data, self.start_tags):
+            print("Invalid stream request")
+            await self.send(json.dumps(error_response(ERR_CODE_MISSING_FIELD, "Invalid stream request")))
+            return
+
+        (fail, req, url) = await build_request(start_data)
+        if(fail):
+            print("Error whilst building the request")
+            await self.send(json.dumps(req))
+            return
+
+        if device_health.is_down(url):
+            await self.send(json.dumps(error_response(ERR_CODE_DEVICE_DOWN)))
+            return
+
+        ## need to get the expected packet structure here
+        fail, layout = await self.format_string_from_param_list(start_data)
+        if fail:
+            print("Error building packet details")
+            return
+
+        fail, decimator = self.build_decimator(start_data)
+        if fail:
+            await self.send(json.dumps(error_response(ERR_CODE_INVALID_CMD_PARAMS, decimator)))
+            return
+
+        fail, coalescer = self.build_coalescer(start_data)
+        if fail:
+            await self.send(json.dumps(error_response(ERR_CODE_INVALID_CMD_PARAMS, coalescer)))
+            return
+
+        fail, backfill = self.parse_backfill(start_data)
+        if fail:
+            await self.send(json.dumps(error_response(ERR_CODE_INVALID_CMD_PARAMS, backfill)))
+            return
+
+        ## a new start request replaces the current stream ##
+        await self.leave()
+        if decimator is not None:
+            self.decimator = decimator
+            interval = streaming_config()["DECIMATION_INTERVAL"]
+            self.flush_task = asyncio.ensure_future(self.flush_loop(interval, self.flush_decimated))
+        elif coalescer is not None:
+            self.coalescer, window = coalescer
+            self.flush_task = asyncio.ensure_future(self.flush_loop(window, self.flush_binary))
+            await self.send(json.dumps({
+                "packet_type": "ws_stream_info",
+                "protocol": PROTOCOL_BINARY,
+                "names": layout.names,
+            }))
+        key = stream_key(start_data['dev_id'], start_data['periph_id'], start_data['param_ids'])
+        self.session = await join_stream(key, url, req, layout, self.channel_name, backfill)
+        print(f"Joined stream {self.session.group} ({len(self.session.subscribers)} subscribers)")
 
 
     async def format_string_from_param_list(self, rq_data):
-        fail = False
-        packet_structure = {}
-        param_list = rq_data['param_ids']
-        fstring = "<"
-        names = []
-        pkt_len = 0
-        ctr = 0
-        for n in param_list:
-            p = await get_param_object(rq_data['dev_id'], rq_data['periph_id'], n)
-            if p == None:
-                self.send(json.dumps(error_response(ERR_CODE_INVALID_PARAM_ID, "Parameter not found")))
-                fail = True
-                break
-            else:
-                names.append(p.name)
-                if ctr > 0:
-                    pkt_len += 1
-                    fstring += "b" ## delimiter byte
-                dtype = p.data_type
-                if dtype == PARAMTYPE_UINT8:
-                    fstring += "B"
-                    pkt_len += 1
-                elif dtype == PARAMTYPE_UINT16:
-                    pkt_len += 2
-                    fstring += "H"
-                elif dtype == PARAMTYPE_UINT32:
-                    pkt_len += 4
-                    fstring += "L"
-                elif dtype == PARAMTYPE_FLOAT:
-                    pkt_len += 4
-                    fstring += "f"
-                elif dtype == PARAMTYPE_DOUBLE:
-                    pkt_len += 8
-                    fstring += "d"
-                elif dtype == PARAMTYPE_STRING:
-                    pkt_len += 1
-                    fstring += "s"
-                elif dtype == PARAMTYPE_BOOL:
-                    pkt_len += 1
-                    fstring += "?"
-                ctr+=1
-        print(f"Build format string: {fstring}")
+        """ returns fail, the compiled FrameLayout for the requested parameters """
+        try:
+            layout = await get_frame_layout(rq_data['dev_id'], rq_data['periph_id'], rq_data['param_ids'])
+        except ValueError as e:
+            await self.send(json.dumps(error_response(ERR_CODE_INVALID_PARAM_ID, str(e))))
+            return True, None
+        return False, layout
+
+
+    ## channel layer handlers ##
+    async def stream_data(self, event):
+        """ decoded frames from the session upstream - one ws_data message per frame,
+            or queued for the next decimated / binary send
+        """
+        if self.decimator is not None:
+            self.decimator.add(event['names'], event['times'], event['columns'])
+            return
+        if self.coalescer is not None:
+            self.coalescer.add(event['names'], event['times'], event['columns'])
+            return
+        for values in zip(*event['columns']):
+            outgoing = dict(zip(event['names'], values))
+            ## assign a packet_type field & send to client 
+            outgoing['packet_type'] = "ws_data"
+            await self.send(json.dumps(outgoing))
+
+
+    async def stream_backfill(self, event):
+        """ recent samples from memory, sent once when joining a stream """
+        series = event['series']
+        if self.decimator is not None:
+            window = max((s['t'][-1] - s['t'][0] for s in series.values() if len(s['t']) > 0), default=0)
+            series = self.decimator.decimate_series(series, window)
+        await self.send(json.dumps({
+            "packet_type": "ws_backfill",
+            "series": series,
+        }))
+
+
+    async def stream_closed(self, event):
+        """ the upstream ended - drop the session so a new start request reconnects """
+        if self.session is not None:
+            ## leave properly - in another worker the session may still be waiting to own the upstream
+            await leave_stream(self.session, self.channel_name)
+            self.session = None
+        await self.send(json.dumps({"packet_type": "ws_closed"}))
 
-        if not fail:
-            if struct.calcsize(fstring) != pkt_len:
-                print(f"Struct size disparity! (pkt_len = {pkt_len}")
-                pkt_len = struct.calcsize(fstring)
-                print(f"new pkt_len = {pkt_len})")
-
-            packet_structure = {
-                "fmt_string": fstring,
-                "pkt_length": pkt_len,
-                "names": names,
-                "items": ctr,
-            }
-
-        return fail, packet_structure
-
-
-
-    async def websocket_bridge(self, url: str, init_packet: dict, pkt_format: dict):
-        cancelled = False
-        err_count = 0
-        pkt_counter = 0
-        ## do the bridging between device and the client ##
-        timeout = aiohttp.ClientTimeout(total=30)
-        outgoing = {}
-        fmt = pkt_format['fmt_string']
-
-        print("middle-man task starting")
-
-        async with aiohttp.ClientSession(timeout=timeout) as session:
-            async with session.ws_connect(url) as ws:
-                ## establish the WS connection & send initial packet...
-                if not self.established:
-                    print("sending " + json.dumps(init_packet))
-                    await ws.send_str(json.dumps(init_packet))
-
-
-                ## until cancelled, loop receiving
-                while not cancelled:
-                    try:
-                        incomming = await ws.receive(timeout=10)
-                        print(f"Got {incomming}")
-                        ## unpack the data here
-                        if incomming.data == None:
-                            err_count += 1
-                            print("Data = None!")
-                        elif incomming.type == WSMsgType.TEXT:
-                            print("Got a text packet")
-                            print(incomming.data)
-                        elif incomming.type == WSMsgType.BINARY:
-                            print("Got a bin packet")
-                            bin_data = incomming.data[:-1]
-                            print(f"bin data: {bin_data} {type(bin_data)}")
-                            data = struct.unpack(fmt, bin_data)
-                            parsed = []                
-                            ## remove the delimiters
-                            for d in data:
-                                if d != API_WEBSOCKET_DELIMITER_CHAR:
-                                    parsed.append(d)
-                            ## length check 
-                            if len(parsed) != pkt_format['items']:
-                                print("Unexpected length")
-                                raise AttributeError
-                            
-                            ## add unpacked data to outgoing
-                            for i in range(len(parsed)):
-                                outgoing[pkt_format['names'][i]] = parsed[i]
-                            
-                            ## assign a packet_type field & send to client 
-                            outgoing['packet_type'] = "ws_data"
-                            print(f"Sending {outgoing} to host")
-                            await self.send(json.dumps(outgoing))
-                    except KeyError as e:
-                        print(f"Keyerror {e}")
-                        err_count += 1
-                        raise
-                    except struct.error as e:
-                        err_count += 1
-                        print(f"Unpacking error! {e}")
-                        pass
-                    except TypeError as e:
-                        err_count += 1
-                        print(f"Unexpected type {e}")
-                        pass
-                    except AttributeError:
-                        err_count += 1
-                        print(f"Invalid length! Got {parsed.length()} expected {pkt_format['items']}")
-                        pass
-                    except asyncio.CancelledError:
-                        ## this should be handled by loop? 
-                        err_count += 1
-                        print("Middle-man task was cancelled!")
-                        cancelled = True
-
-                    if err_count > 10:
-                        print("stopped - error count")
-                        cancelled = True
-                    ## yield to other processes - not sure if needed
-                    asyncio.sleep(0)
-
-                ws.close()
-
-        return
 
 # class ClientStream(AsyncWebsocketConsumer):
 
@@ -0,0 +1,141 @@
+
+import math
+import numpy as np
+
+
+DECIMATION_MINMAX = "minmax"
+DECIMATION_LTTB = "lttb"
+DECIMATION_METHODS = [DECIMATION_MINMAX, DECIMATION_LTTB]
+
+
+def minmax_decimate(times, values, n_out: int):
+    """ min/max bucketing - splits the samples into n_out / 2 equal buckets and keeps
+        the min & max sample of each, in time order. Keeps peaks, cheap to compute
+        returns (times, values) with at most n_out samples
+    """
+    times = np.asarray(times, dtype="f8")
+    values = np.asarray(values, dtype="f8")
+    n = len(values)
+    n_buckets = max(1, int(n_out) // 2)
+    if n <= max(2, int(n_out)):
+        return times, values
+
+    ## pad to a whole number of buckets, padding is nan so never picked
+    size = -(-n // n_buckets)
+    n_buckets = -(-n // size)
+    padded = np.full(n_buckets * size, np.nan)
+    padded[:n] = values
+    rows = padded.reshape(n_buckets, size)
+    base = np.arange(n_buckets) * size
+    lo = base + np.nanargmin(rows, axis=1)
+    hi = base + np.nanargmax(rows, axis=1)
+
+    idx = np.sort(np.stack([lo, hi], axis=1), axis=1).ravel()
+    ## flat buckets pick the same sample twice - keep it once
+    keep = np.ones(len(idx), dtype=bool)
+    keep[1:] = idx[1:] != idx[:-1]
+    idx = idx[keep]
+    return times[idx], values[idx]
+
+
+def lttb_decimate(times, values, n_out: int):
+    """ largest triangle three buckets - keeps the samples which best preserve the
+        visual shape of the line. Always keeps the first & last sample
+        returns (times, values) with at most n_out samples
+    """
+    times = np.asarray(times, dtype="f8")
+    values = np.asarray(values, dtype="f8")
+    n = len(values)
+    n_out = int(n_out)
+    if n_out >= n:
+        return times, values
+    if n_out < 3:
+        idx = [0, n - 1] if n_out == 2 else [n - 1]
+        return times[idx], values[idx]
+
+    every = (n - 2) / (n_out - 2)
+    ## start index of each inner bucket, with the last point as the final edge
+    edges = (np.floor(np.arange(n_out - 1) * every) + 1).astype(int)
+    edges[-1] = n - 1
+
+    idx = np.zeros(n_out, dtype=int)
+    idx[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_t = times[end:next_end].mean()
+        avg_v = values[end:next_end].mean()
+
+        area = np.abs(
+            (times[a] - avg_t) * (values[start:end] - values[a])
+            - (times[a] - times[start:end]) * (avg_v - values[a])
+        )
+        a = start + int(np.argmax(area))
+        idx[i + 1] = a
+
+    return times[idx], values[idx]
+
+
+def decimate(method: str, times, values, n_out: int):
+    if method == DECIMATION_LTTB:
+        return lttb_decimate(times, values, n_out)
+    return minmax_decimate(times, values, n_out)
+
+
+#######################
+##  class StreamDecimator
+#   \brief  - per subscriber buffer of stream samples, flushed as decimated series
+#             numeric columns are downsampled to the subscriber's point rate,
+#             string columns only keep their latest sample
+#   \param method - DECIMATION_MINMAX or DECIMATION_LTTB
+#   \param points_per_second - target points per second, per parameter
+class StreamDecimator():
+
+    def __init__(self, method: str, points_per_second: float):
+        self.method = method
+        self.points_per_second = float(points_per_second)
+        self.names = []
+        self.times = []
+        self.columns = []
+
+    ''' queue the samples from one stream.data event '''
+    def add(self, names: list, times: list, columns: list):
+        if names != self.names:
+            self.names = list(names)
+            self.times = []
+            self.columns = [[] for _ in names]
+        self.times.extend(times)
+        for pending, col in zip(self.columns, columns):
+            pending.extend(col)
+
+    ''' the target number of points for a span of seconds '''
+    def points_for(self, seconds: float):
+        return max(2, int(math.ceil(self.points_per_second * seconds)))
+
+    ''' decimate a {name: {"t": [...], "v": [...]}} series to the target point rate '''
+    def decimate_series(self, series: dict, seconds: float):
+        n_out = self.points_for(seconds)
+        out = {}
+        for name, s in series.items():
+            t, v = decimate(self.method, s["t"], s["v"], n_out)
+            out[name] = {"t": t.tolist(), "v": v.tolist()}
+        return out
+
+    ''' decimate & clear the queued samples - returns a series dict, None if nothing queued '''
+    def flush(self, seconds: float):
+        if len(self.times) == 0:
+            return None
+        n_out = self.points_for(seconds)
+        times = np.asarray(self.times, dtype="f8")
+        series = {}
+        for name, col in zip(self.names, self.columns):
+            if len(col) > 0 and isinstance(col[0], str):
+                series[name] = {"t": [self.times[-1]], "v": [col[-1]]}
+            else:
+                t, v = decimate(self.method, times, col, n_out)
+                series[name] = {"t": t.tolist(), "v": v.tolist()}
+
+        self.times = []
+        self.columns = [[] for _ in self.names]
+        return series
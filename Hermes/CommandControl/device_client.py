@@ -0,0 +1,202 @@
+
+import json
+import time
+import asyncio
+import aiohttp
+
+from django.conf import settings
+
+from .command_api import *
+from .device_health import device_health
+from .metrics import DEVICE_REQUEST_SECONDS, DEVICE_REQUEST_ERRORS, DEVICE_REQUESTS_IN_FLIGHT, device_label, cmd_type_name, err_code_name
+
+
+## default client settings - override with settings.DEVICE_CLIENT
+API_EXT_HTTP_RQ_TIMEOUT = 10
+API_EXT_HTTP_CONNECT_TIMEOUT = 3
+API_EXT_HTTP_MAX_CONNECTIONS = 100
+API_EXT_HTTP_MAX_CONNECTIONS_PER_HOST = 4
+API_EXT_HTTP_KEEPALIVE_TIMEOUT = 30
+## command types which are safe to share between identical concurrent requests
+API_EXT_HTTP_COALESCE_CMD_TYPES = [CMD_TYPE_INFO, CMD_TYPE_GET]
+## command types which change a parameter - later GETs mustn't join one sent before them
+API_EXT_HTTP_WRITE_CMD_TYPES = [CMD_TYPE_SET, CMD_TYPE_ACTION]
+## metrics label of untracked requests, so probed hosts don't each get a series
+SWEEP_DEVICE_LABEL = "sweep"
+
+DEVICE_CLIENT_DEFAULTS = {
+    "TIMEOUT": API_EXT_HTTP_RQ_TIMEOUT,
+    "CONNECT_TIMEOUT": API_EXT_HTTP_CONNECT_TIMEOUT,
+    "LIMIT": API_EXT_HTTP_MAX_CONNECTIONS,
+    "LIMIT_PER_HOST": API_EXT_HTTP_MAX_CONNECTIONS_PER_HOST,
+    "KEEPALIVE_TIMEOUT": API_EXT_HTTP_KEEPALIVE_TIMEOUT,
+    "COALESCE": True,
+}
+
+
+def device_client_config():
+    """ returns the device client settings merged over the defaults """
+    config = dict(DEVICE_CLIENT_DEFAULTS)
+    config.update(getattr(settings, "DEVICE_CLIENT", {}))
+    return config
+
+
+#######################
+##  class DeviceClient
+#   \brief  - holds a single pooled, keep-alive http session for talking to devices
+#             the session is created lazily on the running event loop and recreated
+#             if that loop goes away (eg. between test runs)
+#             identical INFO/GET requests in flight at the same time share one
+#             request to the device & its result. A SET/ACT stops GETs of its
+#             parameter sent after it joining a GET sent before it
+class DeviceClient():
+
+    def __init__(self, config: dict = None):
+        self.config = config if config is not None else device_client_config()
+        self.session = None
+        self.loop = None
+        ''' in flight idempotent requests - coalesce key -> task '''
+        self.in_flight = {}
+
+    ''' build the session timeout from the config '''
+    def build_timeout(self):
+        return aiohttp.ClientTimeout(
+            total=self.config["TIMEOUT"],
+            sock_connect=self.config["CONNECT_TIMEOUT"],
+        )
+
+    ''' return the shared session, creating it if needed '''
+    def get_session(self):
+        loop = asyncio.get_event_loop()
+        if self.session is None or self.session.closed or self.loop is not loop:
+            connector = aiohttp.TCPConnector(
+                limit=self.config["LIMIT"],
+                limit_per_host=self.config["LIMIT_PER_HOST"],
+                keepalive_timeout=self.config["KEEPALIVE_TIMEOUT"],
+            )
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.build_timeout())
+            self.loop = loop
+            self.in_flight = {}
+        return self.session
+
+    ''' (url, cmd_type, periph_id, param_id) for requests which can share a result, else None '''
+    def coalesce_key(self, url: str, data: dict):
+        if not self.config["COALESCE"] or data.get("cmd_type") not in API_EXT_HTTP_COALESCE_CMD_TYPES:
+            return None
+        return (url, data.get("cmd_type"), data.get("periph_id", 0), data.get("param_id", 0))
+
+    ''' post the json data to the url & return (status, response dict)
+        joins an identical INFO/GET request if one is already in flight
+        untracked requests (eg. sweep probes of hosts which may not be devices)
+        are never shared & don't feed device health or per-device metrics
+    '''
+    async def post_json(self, url: str, data: dict, timeout: float = None, tracked: bool = True):
+        if data.get("cmd_type") in API_EXT_HTTP_WRITE_CMD_TYPES:
+            ## the in flight GET keeps its callers but may read the old value
+            self.in_flight.pop((url, CMD_TYPE_GET, data.get("periph_id", 0), data.get("param_id", 0)), None)
+        key = self.coalesce_key(url, data) if tracked else None
+        if key is None:
+            return await self.send_json(url, data, timeout, tracked)
+
+        self.get_session()
+        task = self.in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.send_json(url, data, timeout))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda t: self.in_flight.pop(key) if self.in_flight.get(key) is t else None)
+        else:
+            debug_print(f"joining in flight request to {url}")
+
+        ## shielded so one caller being cancelled doesn't cancel the others
+        result, response_data = await asyncio.shield(task)
+        return result, dict(response_data)
+
+    ''' send one request - returns (status, response dict)
+        requests to a device which is down fail fast with ERR_CODE_DEVICE_DOWN
+    '''
+    async def send_json(self, url: str, data: dict, timeout: float = None, tracked: bool = True):
+        result = HTTP_RSP_AQUIRED
+        response_data = {}
+
+        device = device_label(url) if tracked else SWEEP_DEVICE_LABEL
+        allowed, probe_timeout = device_health.allow(url) if tracked else (True, None)
+        if not allowed:
+            debug_print(f"not posting to {url} - device is down")
+            DEVICE_REQUEST_ERRORS.labels(device, err_code_name(ERR_CODE_DEVICE_DOWN)).inc()
+            return ERR_CODE_DEVICE_DOWN, response_data
+        if probe_timeout is not None:
+            timeout = probe_timeout if timeout is None else min(timeout, probe_timeout)
+        debug_print(f"posting data to {url}")
+
+        kwargs = {}
+        if timeout is not None:
+            kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout, sock_connect=min(timeout, self.config["CONNECT_TIMEOUT"]))
+
+        in_flight = DEVICE_REQUESTS_IN_FLIGHT.labels(device)
+        in_flight.inc()
+        start = time.perf_counter()
+        try:
+            session = self.get_session()
+            async with session.post(url, json=data, **kwargs) as rsp:
+                response_data = await rsp.json(content_type=None)
+                debug_print("sent")
+                debug_print(data)
+                debug_print(f"Got response: (status: {rsp.status})")
+                debug_print(response_data)
+            if type(response_data) is not dict:
+                result = ERR_CODE_INVALID_RSP_JSON
+                response_data = {}
+        except (json.JSONDecodeError, aiohttp.ContentTypeError):
+            result = ERR_CODE_INVALID_RSP_JSON
+        except asyncio.TimeoutError:
+            result = ERR_CODE_HTTP_TIMEOUT
+        except aiohttp.InvalidURL:
+            result = ERR_CODE_INVALID_URL
+        except aiohttp.ClientError:
+            ## connection errors, truncated payloads, bad responses...
+            result = ERR_CODE_DEVICE_UNREACHABLE
+        except BaseException:
+            ## cancelled or unexpected - says nothing about the device
+            result = None
+            raise
+        finally:
+            in_flight.dec()
+            if result is None:
+                ## hand a half-open probe back so the next request probes again
+                if tracked and probe_timeout is not None:
+                    device_health.release_probe(url)
+            else:
+                DEVICE_REQUEST_SECONDS.labels(device, cmd_type_name(data.get("cmd_type"))).observe(time.perf_counter() - start)
+                if result != HTTP_RSP_AQUIRED:
+                    DEVICE_REQUEST_ERRORS.labels(device, err_code_name(result)).inc()
+                if tracked:
+                    device_health.record(url, result)
+
+        return result, response_data
+
+    ''' close the session & release pooled connections '''
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+        self.loop = None
+
+
+## the process-wide client
+_device_client = None
+
+
+def get_device_client():
+    """ returns the shared device client, creating it on first use """
+    global _device_client
+    if _device_client is None:
+        _device_client = DeviceClient()
+    return _device_client
+
+
+async def close_device_client():
+    """ shutdown hook - closes the shared client session """
+    global _device_client
+    if _device_client is not None:
+        await _device_client.close()
+        _device_client = None
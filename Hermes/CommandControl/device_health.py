@@ -0,0 +1,206 @@
+
+import time
+import asyncio
+from urllib.parse import urlsplit
+
+from django.conf import settings
+
+from .command_api import *
+from .registry import registry
+from .metrics import db_hop
+from . import models
+
+
+## health states
+HEALTH_UP = "up"
+HEALTH_DEGRADED = "degraded"
+HEALTH_DOWN = "down"
+HEALTH_HALF_OPEN = "half-open"
+HEALTH_UNKNOWN = "unknown"
+
+## consecutive failures before a device is marked down
+HEALTH_DOWN_AFTER = 3
+## seconds a down device fails fast before a probe is let through - doubles on each failed probe
+HEALTH_OPEN_SECONDS = 10
+HEALTH_OPEN_SECONDS_MAX = 300
+## timeout (seconds) for the probe request to a half-open device
+HEALTH_PROBE_TIMEOUT = 2
+
+## request errors which count against a device's health
+HEALTH_FAILURE_ERRORS = [
+    ERR_CODE_HTTP_TIMEOUT,
+    ERR_CODE_DEVICE_UNREACHABLE,
+]
+
+
+def health_config():
+    """ returns the device health settings merged over the defaults """
+    config = {
+        "DOWN_AFTER": HEALTH_DOWN_AFTER,
+        "OPEN_SECONDS": HEALTH_OPEN_SECONDS,
+        "OPEN_SECONDS_MAX": HEALTH_OPEN_SECONDS_MAX,
+        "PROBE_TIMEOUT": HEALTH_PROBE_TIMEOUT,
+    }
+    config.update(getattr(settings, "DEVICE_HEALTH", {}))
+    return config
+
+
+def health_key(url: str):
+    """ devices are tracked by host:port, so http & stream urls share a state """
+    parts = urlsplit(url)
+    port = parts.port
+    if port is None:
+        port = 443 if parts.scheme in ("https", "wss") else 80
+    return (parts.hostname or "", port)
+
+
+#######################
+##  class DeviceHealth
+#   \brief  - circuit breaker state of one device
+#             up -> degraded on a failure, degraded -> down after DOWN_AFTER
+#             consecutive failures. A down device fails fast until its open time
+#             has passed, then goes half-open & lets one probe request through -
+#             success closes the breaker (up), failure re-opens it for twice as long.
+#             A probe with no outcome by its lease (the probe timeout) counts as failed,
+#             a probe given back without an outcome (cancelled) doesn't
+class DeviceHealth():
+
+    def __init__(self, key):
+        self.key = key
+        self.state = HEALTH_UNKNOWN
+        self.failures = 0
+        self.opened_at = None
+        self.open_for = None
+        ''' monotonic time the half-open probe's lease runs out '''
+        self.probe_deadline = None
+        self.last_change = time.time()
+        ''' the last is_powered saved for the device, None if not saved yet '''
+        self.powered = None
+
+
+#######################
+##  class HealthTracker
+#   \brief  - health of every device the server talks to, fed by request outcomes
+#             changes between reachable & down are saved to Device.is_powered
+class HealthTracker():
+
+    def __init__(self):
+        self.devices = {}
+
+    def get(self, key):
+        health = self.devices.get(key)
+        if health is None:
+            health = DeviceHealth(key)
+            self.devices[key] = health
+        return health
+
+    def state(self, host: str, port: int):
+        health = self.devices.get((host, int(port)))
+        return health.state if health is not None else HEALTH_UNKNOWN
+
+    ''' check a request may be sent - returns (allowed, timeout)
+        timeout is the probe timeout for a half-open device, otherwise None
+    '''
+    def allow(self, url: str):
+        health = self.get(health_key(url))
+        if health.state == HEALTH_DOWN:
+            if time.monotonic() - health.opened_at < health.open_for:
+                return False, None
+            probe_timeout = health_config()["PROBE_TIMEOUT"]
+            health.probe_deadline = time.monotonic() + probe_timeout
+            self.set_state(health, HEALTH_HALF_OPEN)
+            return True, probe_timeout
+        if health.state == HEALTH_HALF_OPEN:
+            ## one probe at a time
+            self.expire_probe(health)
+            return False, None
+        return True, None
+
+    ''' re-open a half-open device whose probe never reported back within its lease '''
+    def expire_probe(self, health: DeviceHealth):
+        if health.state == HEALTH_HALF_OPEN and time.monotonic() >= health.probe_deadline:
+            print(f"Probe of {health.key[0]}:{health.key[1]} timed out without an outcome")
+            self.record_failure_health(health)
+
+    ''' give back the probe of a half-open device which ended without an outcome (eg. cancelled)
+        the device goes back to down with its open time already passed, so the
+        next request probes again - no failure is counted
+    '''
+    def release_probe(self, url: str):
+        health = self.devices.get(health_key(url))
+        if health is None or health.state != HEALTH_HALF_OPEN:
+            return
+        health.probe_deadline = None
+        health.opened_at = time.monotonic() - health.open_for
+        self.set_state(health, HEALTH_DOWN)
+
+    ''' true if requests to the url are currently failing fast - does not start a probe '''
+    def is_down(self, url: str):
+        health = self.devices.get(health_key(url))
+        if health is None:
+            return False
+        if health.state == HEALTH_HALF_OPEN:
+            self.expire_probe(health)
+            return True
+        return health.state == HEALTH_DOWN and time.monotonic() - health.opened_at < health.open_for
+
+    ''' feed the outcome of a request - result is HTTP_RSP_AQUIRED or an error code '''
+    def record(self, url: str, result):
+        if result in HEALTH_FAILURE_ERRORS:
+            self.record_failure(url)
+        else:
+            self.record_success(url)
+
+    def record_success(self, url: str):
+        health = self.get(health_key(url))
+        health.failures = 0
+        health.open_for = None
+        self.set_state(health, HEALTH_UP)
+
+    def record_failure(self, url: str):
+        self.record_failure_health(self.get(health_key(url)))
+
+    def record_failure_health(self, health: DeviceHealth):
+        config = health_config()
+        health.failures += 1
+        if health.state == HEALTH_HALF_OPEN:
+            health.open_for = min(config["OPEN_SECONDS_MAX"], health.open_for * 2)
+            self.open(health)
+        elif health.state == HEALTH_DOWN:
+            pass
+        elif health.failures >= config["DOWN_AFTER"]:
+            health.open_for = config["OPEN_SECONDS"]
+            self.open(health)
+        else:
+            self.set_state(health, HEALTH_DEGRADED)
+
+    def open(self, health: DeviceHealth):
+        health.opened_at = time.monotonic()
+        self.set_state(health, HEALTH_DOWN)
+        print(f"Device {health.key[0]}:{health.key[1]} is down - failing fast for {health.open_for}s")
+
+    def set_state(self, health: DeviceHealth, state: str):
+        if health.state == state:
+            return
+        health.state = state
+        health.last_change = time.time()
+        if state in (HEALTH_UP, HEALTH_DOWN) and health.powered != (state == HEALTH_UP):
+            health.powered = state == HEALTH_UP
+            self.save_powered(health.key, health.powered)
+
+    ''' keep Device.is_powered in step - updates the registry copy & the db in the background '''
+    def save_powered(self, key, is_powered: bool):
+        host, port = key
+        for device in list(registry.devices.values()):
+            if device.ip_address == host and device.api_port == port:
+                device.is_powered = is_powered
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        update = models.Device.objects.filter(ip_address=host, api_port=port).update
+        loop.create_task(db_hop("device_power_update")(update)(is_powered=is_powered))
+
+
+## the process-wide tracker
+device_health = HealthTracker()
@@ -0,0 +1,200 @@
+
+import asyncio
+import ipaddress
+from datetime import datetime
+
+from django.conf import settings
+
+from .command_api import *
+from .tracing import span
+
+
+## max info requests in flight to a single device while enumerating
+ENUM_MAX_IN_FLIGHT = 4
+## subnet sweep limits - probes in flight, largest network & probe timeout (seconds)
+SWEEP_MAX_IN_FLIGHT = 64
+SWEEP_MAX_HOSTS = 1024
+SWEEP_PROBE_TIMEOUT = 1.0
+
+
+def discovery_config():
+    """ returns the discovery settings merged over the defaults """
+    config = {
+        "MAX_IN_FLIGHT": ENUM_MAX_IN_FLIGHT,
+        "SWEEP_MAX_IN_FLIGHT": SWEEP_MAX_IN_FLIGHT,
+        "SWEEP_MAX_HOSTS": SWEEP_MAX_HOSTS,
+        "SWEEP_PROBE_TIMEOUT": SWEEP_PROBE_TIMEOUT,
+    }
+    config.update(getattr(settings, "DISCOVERY", {}))
+    return config
+
+
+async def no_report(msg: str, code: int):
+    pass
+
+
+#######################
+##  class DeviceEnumerator
+#   \brief      - fetches the device, peripheral & parameter info for a device
+#                 peripheral and parameter info requests are sent concurrently,
+#                 with at most max_in_flight requests outstanding to the device
+#   \param url  - the device command url
+#   \param report - coroutine function(msg, code) called with progress messages
+class DeviceEnumerator():
+
+    def __init__(self, url: str, target: str, port: int, ext: str, report=None, max_in_flight: int = None):
+        self.url = url
+        self.target = target
+        self.port = port
+        self.ext = ext
+        self.report = report if report is not None else no_report
+        if max_in_flight is None:
+            max_in_flight = discovery_config()["MAX_IN_FLIGHT"]
+        self.in_flight = asyncio.Semaphore(max(1, int(max_in_flight)))
+        self.fail = False
+
+    ''' send a packet under the in-flight limit, report any error '''
+    async def fetch(self, packet: RequestPacket):
+        async with self.in_flight:
+            with span("http"):
+                res, rsp = await packet.send_request()
+        if res != HTTP_RSP_AQUIRED:
+            self.fail = True
+            msg = error_messages.get(res, "unknown error!")
+            await self.report(f"Error: {msg} (periph {packet.fields['periph_id']}, param {packet.fields['param_id']})", 506)
+            return False
+        return True
+
+    ''' get the info for a parameter - returns the param dict or None '''
+    async def enumerate_parameter(self, periph_data: dict, periph_id: int, param_id: int):
+        paramInfo = ParamInfoPacket(self.url, periph_id, param_id)
+        if not await self.fetch(paramInfo):
+            return None
+
+        param_data = {
+            "name": paramInfo.get_response_value("param_name"),
+            "periph_id": periph_data["periph_id"],
+            "param_id": paramInfo.get_response_value("param_id"),
+            "param_type": 0,
+            "methods": paramInfo.get_response_value("methods"),
+            "max_value": paramInfo.get_response_value("param_max"),
+            "data_type": paramInfo.get_response_value("data_type"),
+        }
+        await self.report(f">>> Parameter {param_data['name']} [id: {hex(param_data['param_id'] or 0)}]", 200)
+        return param_data
+
+    ''' get the info for a peripheral & all its parameters - returns the periph dict or None '''
+    async def enumerate_peripheral(self, dev_id: int, periph_id: int):
+        periphInfo = PeriphInfoPacket(self.url, periph_id)
+        if not await self.fetch(periphInfo):
+            return None
+
+        periph_data = {
+            "device": dev_id,
+            "periph_id": periphInfo.get_response_value("periph_id"),
+            "name": periphInfo.get_response_value("name"),
+            "param_num": periphInfo.get_response_value("param_num"),
+            "param_ids": periphInfo.get_param_ids(),
+            "periph_type": periphInfo.get_response_value("periph_type"),
+            "sleep_state": 0,
+            "parameters": [],
+        }
+        await self.report(f">> Peripheral {periph_data['name']} [id: {hex(periph_data['periph_id'] or 0)}]", 200)
+
+        params = await asyncio.gather(*[
+            self.enumerate_parameter(periph_data, periph_id, prm) for prm in periphInfo.get_param_ids()
+        ])
+        periph_data["parameters"] = [p for p in params if p is not None]
+        return periph_data
+
+    ''' enumerate the whole device - returns fail, nested device dict '''
+    async def enumerate(self):
+        devInfo = DevInfoPacket(self.url)
+        if not await self.fetch(devInfo):
+            return True, {}
+
+        device_data = {
+            "name": devInfo.get_response_value("name"),
+            "periph_num": devInfo.get_response_value("periph_num"),
+            "dev_id": devInfo.get_response_value("dev_id"),
+            "last_polled": datetime.now(),
+            "ip_addr": self.target,
+            "api_port": int(self.port),
+            "cmd_url": self.ext,
+            "sleep_state": 0,
+            "is_powered": True,
+            "setup_date": datetime.now(),
+            "peripherals": [],
+        }
+        await self.report(f"> Device {device_data['name']} [id: {hex(device_data['dev_id'] or 0)}]", 200)
+
+        periphs = await asyncio.gather(*[
+            self.enumerate_peripheral(device_data["dev_id"], p) for p in devInfo.get_periph_ids()
+        ])
+        device_data["peripherals"] = [p for p in periphs if p is not None]
+
+        return self.fail, device_data
+
+
+#######################
+##  class SubnetSweeper
+#   \brief      - probes every host:port in a network with a device info request
+#                 probes are sent concurrently with a short timeout
+#                 raises ValueError for an invalid/oversized network or bad ports
+#   \param cidr - the network to sweep, eg. "192.168.0.0/24"
+#   \param ports - list of api ports to try on each host
+#   \param ext  - the api url extension
+#   \param found - coroutine function(found dict) called as each device responds
+class SubnetSweeper():
+
+    def __init__(self, cidr: str, ports: list, ext: str, found, max_in_flight: int = None, timeout: float = None):
+        config = discovery_config()
+        self.network = ipaddress.ip_network(cidr, strict=False)
+        if self.network.num_addresses > config["SWEEP_MAX_HOSTS"]:
+            raise ValueError(f"Network is too large to sweep (max {config['SWEEP_MAX_HOSTS']} addresses)")
+        self.ports = [int(p) for p in ports]
+        if len(self.ports) == 0 or any(p < 1 or p > 65535 for p in self.ports):
+            raise ValueError("Invalid port list")
+        self.ext = ext
+        self.found = found
+        self.timeout = timeout if timeout is not None else config["SWEEP_PROBE_TIMEOUT"]
+        if max_in_flight is None:
+            max_in_flight = config["SWEEP_MAX_IN_FLIGHT"]
+        self.in_flight = asyncio.Semaphore(max(1, int(max_in_flight)))
+
+    ''' the hosts to probe - a /32 is the single address '''
+    def hosts(self):
+        hosts = list(self.network.hosts())
+        if len(hosts) == 0:
+            hosts = [self.network.network_address]
+        return hosts
+
+    ''' send a device info request to a single host:port - returns the found dict or None
+        probes are untracked - most swept hosts aren't devices & shouldn't get health state
+    '''
+    async def probe(self, host: str, port: int):
+        devInfo = DevInfoPacket(assemble_url(host, port, self.ext))
+        async with self.in_flight:
+            res, rsp = await devInfo.send_request(timeout=self.timeout, tracked=False)
+
+        if res != HTTP_RSP_AQUIRED or not devInfo.check_expected_response_type() \
+         or devInfo.get_response_value("dev_id") is None:
+            return None
+
+        found = {
+            "ip_addr": host,
+            "port": port,
+            "extension": self.ext,
+            "dev_id": devInfo.get_response_value("dev_id"),
+            "name": devInfo.get_response_value("name"),
+            "periph_num": devInfo.get_response_value("periph_num"),
+        }
+        await self.found(found)
+        return found
+
+    ''' probe every host:port - returns the list of responders '''
+    async def sweep(self):
+        results = await asyncio.gather(*[
+            self.probe(str(host), port) for host in self.hosts() for port in self.ports
+        ])
+        return [r for r in results if r is not None]
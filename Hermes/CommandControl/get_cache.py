@@ -0,0 +1,119 @@
+
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .command_api import *
+
+
+## seconds a GET result is served from the cache, by peripheral type
+## fast changing sensors are cached briefly, configuration-like peripherals for longer
+GET_CACHE_DEFAULT_TTL = 1.0
+GET_CACHE_PERIPH_TYPE_TTLS = {
+    PTYPE_ACCEL_SENSOR: 0.1,
+    PTYPE_DISTANCE_SENSOR: 0.25,
+    PTYPE_POWER_SENSOR: 1.0,
+    PTYPE_ENVIRO_SENSOR: 5.0,
+    PTYPE_ADDR_LEDS: 10.0,
+    PTYPE_STD_LED: 10.0,
+    PTYPE_IO: 30.0,
+}
+## most results held - least recently used are dropped first
+GET_CACHE_MAX_ENTRIES = 1024
+
+
+def get_cache_config():
+    """ returns the GET cache settings merged over the defaults
+        PARAMETER_TTLS is keyed by (dev_id, periph_id, param_id) & overrides the peripheral type ttl
+    """
+    config = {
+        "DEFAULT_TTL": GET_CACHE_DEFAULT_TTL,
+        "PERIPH_TYPE_TTLS": GET_CACHE_PERIPH_TYPE_TTLS,
+        "PARAMETER_TTLS": {},
+        "MAX_ENTRIES": GET_CACHE_MAX_ENTRIES,
+    }
+    overrides = dict(getattr(settings, "GET_CACHE", {}))
+    ## per type ttls are merged over the defaults rather than replacing them
+    config["PERIPH_TYPE_TTLS"] = dict(GET_CACHE_PERIPH_TYPE_TTLS)
+    config["PERIPH_TYPE_TTLS"].update(overrides.pop("PERIPH_TYPE_TTLS", {}))
+    config.update(overrides)
+    return config
+
+
+def request_max_age(data: dict):
+    """ the max_age (seconds) from a client request, None if not given or invalid """
+    try:
+        max_age = float(data['max_age'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return max_age if max_age >= 0 else None
+
+
+#######################
+##  class GetCache
+#   \brief  - read-through cache of parameter GET responses, keyed (dev_id, periph_id, param_id)
+#             a response is fresh for its parameter's ttl, or the request's max_age if given
+#             (max_age 0 always reads the device). Bounded LRU - entries are only
+#             removed by eviction or by a SET/ACT to the same parameter.
+#             Each SET/ACT bumps the key's write generation - a GET result is only
+#             stored if no write started since the GET did, so it can't be older
+class GetCache():
+
+    def __init__(self, config: dict = None):
+        self.config = config if config is not None else get_cache_config()
+        self.entries = OrderedDict()
+        ''' key -> count of writes (invalidations) seen '''
+        self.generations = {}
+        self.hits = 0
+        self.misses = 0
+
+    ''' the ttl for a parameter object, from the parameter then peripheral type settings '''
+    def ttl_for(self, param):
+        key = (param.peripheral.device.dev_id, param.peripheral.periph_id, param.param_id)
+        if key in self.config["PARAMETER_TTLS"]:
+            return self.config["PARAMETER_TTLS"][key]
+        return self.config["PERIPH_TYPE_TTLS"].get(param.peripheral.periph_type, self.config["DEFAULT_TTL"])
+
+    ''' a copy of the cached response if fresh enough, else None '''
+    def get(self, key, ttl: float, max_age: float = None):
+        entry = self.entries.get(key)
+        limit = ttl if max_age is None else max_age
+        if entry is None or time.monotonic() - entry[0] > limit:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return dict(entry[1])
+
+    ''' the key's write generation - take it before sending a GET & pass it to put() '''
+    def generation(self, key):
+        return self.generations.get(key, 0)
+
+    ''' store a GET response - skipped if the key was written since generation was taken '''
+    def put(self, key, response: dict, generation: int = None):
+        if generation is not None and generation != self.generation(key):
+            return False
+        self.entries[key] = (time.monotonic(), dict(response))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.config["MAX_ENTRIES"]:
+            self.entries.popitem(last=False)
+        return True
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+        self.generations[key] = self.generation(key) + 1
+
+    def clear(self):
+        self.entries.clear()
+
+
+## the process-wide cache
+get_cache = GetCache()
+
+
+def get_cache_key(dev_id, periph_id, param_id):
+    try:
+        return (int(dev_id), int(periph_id), int(param_id))
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,330 @@
+
+import time
+import atexit
+import asyncio
+import threading
+import numpy as np
+
+from django.conf import settings
+from django.db import transaction, DatabaseError, IntegrityError
+
+from .command_api import debug_print
+from .decimation import minmax_decimate
+from .ring_buffer import get_stream_buffer
+from .metrics import db_hop
+from . import models
+
+
+## rollup periods (seconds), finest first
+HISTORY_TIERS = [60, 3600]
+## seconds of raw samples kept
+HISTORY_RAW_RETENTION = 2 * 86400
+## seconds of rollups kept per tier
+HISTORY_ROLLUP_RETENTION = {
+    60: 30 * 86400,
+    3600: 365 * 86400,
+}
+## seconds between writes of recorded samples
+HISTORY_FLUSH_INTERVAL = 5.0
+## seconds between retention passes
+HISTORY_PRUNE_INTERVAL = 3600
+## default points returned by a range query
+HISTORY_MAX_POINTS = 500
+## samples per parameter kept while the db can't be written - oldest are dropped beyond this
+HISTORY_MAX_PENDING = 10000
+## times a rollup merge is retried when another process created the same rows first
+HISTORY_ROLLUP_RETRIES = 3
+
+
+def history_config():
+    """ returns the history settings merged over the defaults """
+    config = {
+        "TIERS": HISTORY_TIERS,
+        "RAW_RETENTION": HISTORY_RAW_RETENTION,
+        "ROLLUP_RETENTION": HISTORY_ROLLUP_RETENTION,
+        "FLUSH_INTERVAL": HISTORY_FLUSH_INTERVAL,
+        "PRUNE_INTERVAL": HISTORY_PRUNE_INTERVAL,
+        "MAX_POINTS": HISTORY_MAX_POINTS,
+        "MAX_PENDING": HISTORY_MAX_PENDING,
+        "ROLLUP_RETRIES": HISTORY_ROLLUP_RETRIES,
+    }
+    config.update(getattr(settings, "HISTORY", {}))
+    return config
+
+
+def bucket_aggregates(times, values, period: int):
+    """ min/max/sum/count of samples per period bucket - vectorised
+        returns (bucket starts, counts, mins, maxs, sums)
+    """
+    times = np.asarray(times, dtype="f8")
+    values = np.asarray(values, dtype="f8")
+    starts, inverse = np.unique(np.floor(times / period) * period, return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(starts))
+    sums = np.bincount(inverse, weights=values, minlength=len(starts))
+    mins = np.full(len(starts), np.inf)
+    maxs = np.full(len(starts), -np.inf)
+    np.minimum.at(mins, inverse, values)
+    np.maximum.at(maxs, inverse, values)
+    return starts, counts, mins, maxs, sums
+
+
+#######################
+##  class HistoryRecorder
+#   \brief  - buffers numeric parameter samples from GETs & streams, writing them
+#             every flush interval as raw ParameterSamples in one bulk insert.
+#             each flush also merges the new samples into the rollup tiers, so
+#             rollups never need the raw rows re-reading. Old rows are pruned
+#             per tier every prune interval
+class HistoryRecorder():
+
+    def __init__(self):
+        ''' parameter pk -> ([times], [values]) waiting to be written '''
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.task = None
+        self.last_prune = 0
+
+    ''' record one sample of a parameter (by pk) '''
+    def record(self, param_pk: int, timestamp: float, value):
+        self.record_many(param_pk, [timestamp], [value])
+
+    ''' record arrays of samples of a parameter (by pk) '''
+    def record_many(self, param_pk: int, times, values):
+        with self.lock:
+            pending = self.pending.setdefault(param_pk, ([], []))
+            pending[0].extend(float(t) for t in times)
+            pending[1].extend(float(v) for v in values)
+        self.start()
+
+    ''' write the recorded samples & update the rollups - blocking, run in the db thread '''
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+
+        if len(pending) > 0:
+            ## samples of parameters deleted since they were recorded would fail the whole insert
+            known = set(models.Parameter.objects.filter(pk__in=list(pending.keys())).values_list("pk", flat=True))
+            for pk in [pk for pk in pending if pk not in known]:
+                debug_print(f"Dropping history samples of deleted parameter {pk}")
+                del pending[pk]
+
+        if len(pending) > 0:
+            samples = []
+            for pk, (times, values) in pending.items():
+                samples.extend(
+                    models.ParameterSample(parameter_id=pk, timestamp=t, value=v)
+                    for t, v in zip(times, values)
+                )
+            try:
+                with transaction.atomic():
+                    models.ParameterSample.objects.bulk_create(samples, batch_size=500)
+                    for period in history_config()["TIERS"]:
+                        self.update_rollups(pending, period)
+            except DatabaseError as e:
+                print(f"History write failed: {e}")
+                self.requeue(pending)
+                return 0
+            debug_print(f"Wrote {len(samples)} history samples")
+
+        config = history_config()
+        if time.time() - self.last_prune > config["PRUNE_INTERVAL"]:
+            self.prune()
+        return sum(len(times) for times, _ in pending.values())
+
+    ''' put samples from a failed flush back ahead of anything recorded since '''
+    def requeue(self, pending: dict):
+        limit = history_config()["MAX_PENDING"]
+        with self.lock:
+            for pk, (times, values) in pending.items():
+                newer = self.pending.get(pk)
+                if newer is not None:
+                    times = times + newer[0]
+                    values = values + newer[1]
+                self.pending[pk] = (times[-limit:], values[-limit:])
+
+    ''' merge recorded samples into the rollup rows of one tier
+        another process can create a row between the read & the insert - the
+        savepoint is rolled back & the merge retried against the rows now there
+    '''
+    def update_rollups(self, pending: dict, period: int):
+        new = {}
+        for pk, (times, values) in pending.items():
+            for start, count, lo, hi, total in zip(*bucket_aggregates(times, values, period)):
+                new[(pk, float(start))] = (int(count), float(lo), float(hi), float(total))
+        if len(new) == 0:
+            return
+
+        attempts = history_config()["ROLLUP_RETRIES"] + 1
+        for attempt in range(attempts):
+            try:
+                with transaction.atomic():
+                    self.merge_rollups(dict(new), period)
+                return
+            except IntegrityError:
+                if attempt == attempts - 1:
+                    raise
+                debug_print(f"Rollup rows of period {period} created concurrently - retrying")
+
+    ''' the rollup rows of a tier the new aggregates fall into, locked until the merge commits '''
+    def existing_rollups(self, new: dict, period: int):
+        starts = [k[1] for k in new]
+        return models.ParameterRollup.objects.select_for_update().filter(
+            period=period,
+            parameter_id__in=list({k[0] for k in new}),
+            start__gte=min(starts),
+            start__lte=max(starts),
+        )
+
+    ''' add new aggregates {(pk, start): (count, min, max, sum)} to existing rows & create the rest '''
+    def merge_rollups(self, new: dict, period: int):
+        updated = []
+        for R in self.existing_rollups(new, period):
+            agg = new.pop((R.parameter_id, R.start), None)
+            if agg is None:
+                continue
+            count, lo, hi, total = agg
+            R.count += count
+            R.min_value = min(R.min_value, lo)
+            R.max_value = max(R.max_value, hi)
+            R.sum_value += total
+            updated.append(R)
+
+        if len(updated) > 0:
+            models.ParameterRollup.objects.bulk_update(updated, fields=["count", "min_value", "max_value", "sum_value"])
+        models.ParameterRollup.objects.bulk_create([
+            models.ParameterRollup(
+                parameter_id=pk, period=period, start=start,
+                count=count, min_value=lo, max_value=hi, sum_value=total,
+            )
+            for (pk, start), (count, lo, hi, total) in new.items()
+        ])
+
+    ''' delete rows older than each tier's retention '''
+    def prune(self, now: float = None):
+        if now is None:
+            now = time.time()
+        config = history_config()
+        deleted, _ = models.ParameterSample.objects.filter(timestamp__lt=now - config["RAW_RETENTION"]).delete()
+        for period, retention in config["ROLLUP_RETENTION"].items():
+            n, _ = models.ParameterRollup.objects.filter(period=period, start__lt=now - retention).delete()
+            deleted += n
+        self.last_prune = now
+        debug_print(f"History pruned {deleted} rows")
+        return deleted
+
+    ''' start the flush task if it isn't running & there is a running event loop '''
+    def start(self):
+        if self.task is not None and not self.task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self.task = loop.create_task(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(history_config()["FLUSH_INTERVAL"])
+            await db_hop("history_flush")(self.flush)()
+
+    ''' stop the flush task & write anything still recorded '''
+    async def stop(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.task = None
+        await db_hop("history_flush")(self.flush)()
+
+    ''' last chance flush at interpreter exit - a no-op if the shutdown hook already ran '''
+    def flush_at_exit(self):
+        if len(self.pending) == 0:
+            return
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"History exit flush failed: {e}")
+
+
+## the process-wide recorder
+history = HistoryRecorder()
+atexit.register(history.flush_at_exit)
+
+
+async def close_history():
+    await history.stop()
+
+
+def select_tier(start: float, end: float, max_points: int, now: float = None):
+    """ the coarsest rollup period no wider than the requested resolution,
+        None for raw samples. Falls back to the finest rollup when the raw
+        samples for the range have been pruned
+    """
+    if now is None:
+        now = time.time()
+    config = history_config()
+    resolution = (end - start) / max(1, max_points)
+    tier = None
+    for period in sorted(config["TIERS"]):
+        if period <= resolution:
+            tier = period
+    if tier is None and start < now - config["RAW_RETENTION"] and len(config["TIERS"]) > 0:
+        tier = min(config["TIERS"])
+    return tier
+
+
+def query_history(parameter, start: float, end: float, max_points: int = None):
+    """ parameter values between start & end (epoch seconds) - blocking
+        returns {"tier", "source", "t", "v"} plus "min" & "max" for rollup tiers
+        raw ranges still held by a stream ring buffer are served from memory
+    """
+    if max_points is None:
+        max_points = history_config()["MAX_POINTS"]
+    tier = select_tier(start, end, max_points)
+
+    if tier is None:
+        key = (parameter.peripheral.device.dev_id, parameter.peripheral.periph_id, parameter.param_id)
+        buf = get_stream_buffer(key)
+        oldest = buf.oldest() if buf is not None else None
+        if oldest is not None and oldest <= start:
+            times, values = buf.window(since=start, until=end)
+            source = "memory"
+        else:
+            rows = list(models.ParameterSample.objects
+                .filter(parameter=parameter, timestamp__gte=start, timestamp__lte=end)
+                .order_by("timestamp")
+                .values_list("timestamp", "value"))
+            times = np.array([r[0] for r in rows], dtype="f8")
+            values = np.array([r[1] for r in rows], dtype="f8")
+            source = "raw"
+        times, values = minmax_decimate(times, values, max_points)
+        return {"tier": "raw", "source": source, "t": times.tolist(), "v": values.tolist()}
+
+    rows = list(models.ParameterRollup.objects
+        .filter(parameter=parameter, period=tier, start__gte=np.floor(start / tier) * tier, start__lte=end)
+        .order_by("start")
+        .values_list("start", "count", "min_value", "max_value", "sum_value"))
+    if len(rows) == 0:
+        return {"tier": tier, "source": "rollup", "t": [], "v": [], "min": [], "max": []}
+
+    starts, counts, mins, maxs, sums = (np.array(c, dtype="f8") for c in zip(*rows))
+    ## merge neighbouring rollups when the tier is still finer than asked for
+    if len(rows) > max_points:
+        edges = np.arange(0, len(rows), -(-len(rows) // max_points))
+        starts = starts[edges]
+        counts = np.add.reduceat(counts, edges)
+        mins = np.minimum.reduceat(mins, edges)
+        maxs = np.maximum.reduceat(maxs, edges)
+        sums = np.add.reduceat(sums, edges)
+    means = np.divide(sums, counts, out=np.zeros_like(sums), where=counts > 0)
+    return {
+        "tier": tier,
+        "source": "rollup",
+        "t": starts.tolist(),
+        "v": means.tolist(),
+        "min": mins.tolist(),
+        "max": maxs.tolist(),
+    }
@@ -0,0 +1,117 @@
+
+import time
+import asyncio
+
+from django.conf import settings
+
+from .command_api import *
+from .get_cache import get_cache, get_cache_key
+from .metrics import err_code_name
+from .tracing import traced, span, set_trace_attr
+
+
+## most colour sets sent to one strip per second
+LED_MAX_UPDATE_HZ = 20
+## the colour parameter of an addressable led peripheral
+LED_COLOUR_PARAM_ID = 3
+
+
+def led_config():
+    """ returns the led control settings merged over the defaults """
+    config = {
+        "MAX_UPDATE_HZ": LED_MAX_UPDATE_HZ,
+    }
+    config.update(getattr(settings, "LED_CONTROL", {}))
+    return config
+
+
+#######################
+##  class StripSlot
+#   \brief  - the latest colour waiting to go to one strip, keyed (dev_id, periph_id)
+#             a new colour replaces the waiting one, so a strip only ever gets the
+#             newest colour & never works through a backlog
+class StripSlot():
+
+    def __init__(self, key):
+        self.key = key
+        self.pending = None
+        self.last_sent = 0
+        self.task = None
+
+
+#######################
+##  class LedDispatcher
+#   \brief  - sends colour sets to led strips - each strip has its own sender task,
+#             so strips are updated concurrently, limited to MAX_UPDATE_HZ per strip
+class LedDispatcher():
+
+    def __init__(self):
+        self.slots = {}
+
+    ''' queue a colour for a strip - supersedes any colour still waiting for it '''
+    def submit(self, dev_id, periph_id, colour):
+        key = (int(dev_id), int(periph_id))
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = StripSlot(key)
+            self.slots[key] = slot
+        slot.pending = colour
+        if slot.task is None or slot.task.done():
+            slot.task = asyncio.ensure_future(self.run_slot(slot))
+
+    ''' send the latest colour until nothing new is waiting '''
+    async def run_slot(self, slot: StripSlot):
+        interval = 1.0 / led_config()["MAX_UPDATE_HZ"]
+        while slot.pending is not None:
+            wait = slot.last_sent + interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            colour = slot.pending
+            slot.pending = None
+            slot.last_sent = time.monotonic()
+            try:
+                await self.send_colour(slot.key, colour)
+            except Exception as e:
+                print(f"Error setting strip {slot.key} colour: {e}")
+
+    async def send_colour(self, key, colour):
+        ## imported here - consumers imports the dispatcher
+        from .consumers import get_device_object, get_param_object, update_parameter
+
+        dev_id, periph_id = key
+        with traced("led", dev_id=dev_id, periph_id=periph_id):
+            with span("build_request"):
+                dev = await get_device_object(dev_id)
+                if dev is None:
+                    print(f"No device {dev_id} for led strip")
+                    return
+                with span("url"):
+                    url = assemble_url(dev.ip_address, dev.api_port, dev.cmd_url)
+                Request = ParamSetPacket(url, periph_id, LED_COLOUR_PARAM_ID, colour, PARAMTYPE_UINT32)
+
+            with span("http"):
+                res, rsp = await Request.send_request()
+            get_cache.invalidate(get_cache_key(dev_id, periph_id, LED_COLOUR_PARAM_ID))
+            if res != HTTP_RSP_AQUIRED:
+                print(f"Error in led request! {res}")
+                set_trace_attr("error", err_code_name(res))
+            else:
+                p = await get_param_object(dev_id, periph_id, LED_COLOUR_PARAM_ID)
+                with span("update_parameter"):
+                    await update_parameter(colour, p)
+
+    ''' stop every strip sender - waiting colours are dropped '''
+    async def close(self):
+        tasks = [s.task for s in self.slots.values() if s.task is not None and not s.task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.slots = {}
+
+
+## the process-wide dispatcher - strips are shared by every led control client
+led_dispatcher = LedDispatcher()
+
+
+async def close_led_dispatcher():
+    await led_dispatcher.close()
@@ -0,0 +1,93 @@
+
+from .command_api import debug_print
+from .device_client import close_device_client
+from .write_behind import close_write_behind
+from .history import close_history
+from .poller import start_poller, stop_poller
+from .led_dispatch import close_led_dispatcher
+from .channel_layer import close_channel_layer
+from .tracing import close_tracing
+
+
+## coroutine functions run when the ASGI server starts/stops
+startup_hooks = [
+    start_poller,
+]
+shutdown_hooks = [
+    close_channel_layer,
+    close_device_client,
+    close_write_behind,
+    close_history,
+    close_led_dispatcher,
+    stop_poller,
+    close_tracing,
+]
+
+
+def on_startup(hook):
+    """ register a coroutine function to run at server startup """
+    startup_hooks.append(hook)
+    return hook
+
+
+def on_shutdown(hook):
+    """ register a coroutine function to run at server shutdown """
+    shutdown_hooks.append(hook)
+    return hook
+
+
+## set once the startup hooks have run, from lifespan or the first connection
+startup_state = {"started": False}
+
+
+async def startup():
+    """ run the startup hooks, once per process """
+    if startup_state["started"]:
+        return
+    ## set before awaiting so connections arriving meanwhile don't run them again
+    startup_state["started"] = True
+    debug_print("Running startup hooks")
+    await run_hooks(startup_hooks)
+
+
+async def run_hooks(hooks):
+    for hook in hooks:
+        try:
+            await hook()
+        except Exception as e:
+            print(f"Error in lifespan hook {hook.__name__}: {e}")
+
+
+##
+#   LifespanApp - handles the ASGI lifespan protocol for servers which send it (uvicorn, hypercorn)
+#   daphne does not send lifespan events, so under `manage.py runserver` the startup hooks are run by
+#   StartupOnConnect instead & the shutdown hooks don't run (write behind & history flush at exit)
+#
+class LifespanApp():
+
+    async def __call__(self, scope, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                debug_print("Running shutdown hooks")
+                await run_hooks(reversed(shutdown_hooks))
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+##
+#   StartupOnConnect - ASGI middleware running the startup hooks on the first http/websocket
+#   connection, for servers which never send lifespan events (daphne)
+#
+class StartupOnConnect():
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if not startup_state["started"]:
+            await startup()
+        return await self.app(scope, receive, send)
@@ -0,0 +1,125 @@
+import json
+import time
+import random
+import asyncio
+
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+
+from CommandControl.benchmark import latency_summary, format_table, bench_database, quiet, reset_state, close_services
+from CommandControl.simulator import SimFleet
+from CommandControl.consumers import CommandConsumer
+from CommandControl.command_api import RSP_TYPE_ERR
+
+
+##
+#   bench_commands - end to end command latency through CommandConsumer
+#   against a simulated device fleet, at increasing numbers of concurrent clients
+#   runs on a throwaway test database
+#
+class Command(BaseCommand):
+    help = "Benchmark GET/SET latency & throughput through the command websocket against simulated devices"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--devices", type=int, default=8)
+        parser.add_argument("--peripherals", type=int, default=2)
+        parser.add_argument("--parameters", type=int, default=4)
+        parser.add_argument("--latency", type=float, default=20, help="device latency (ms)")
+        parser.add_argument("--jitter", type=float, default=5, help="+/- device latency jitter (ms)")
+        parser.add_argument("--failure-rate", type=float, default=0.0, help="fraction of device requests which fail")
+        parser.add_argument("--concurrency", default="1,4,16,64", help="comma separated concurrent clients per run")
+        parser.add_argument("--commands", type=int, default=400, help="commands per run")
+        parser.add_argument("--set-ratio", type=float, default=0.2, help="fraction of commands which are SETs")
+        parser.add_argument("--use-cache", action="store_true", help="let GETs be served from the GET cache")
+        parser.add_argument("--port", type=int, default=19000, help="first simulated device port")
+
+    def handle(self, *args, **options):
+        try:
+            levels = [int(c) for c in options["concurrency"].split(",")]
+        except ValueError:
+            raise CommandError("--concurrency must be comma separated integers")
+
+        fleet = SimFleet(
+            options["devices"], base_port=options["port"],
+            peripherals=options["peripherals"], parameters=options["parameters"],
+            latency=options["latency"] / 1000, jitter=options["jitter"] / 1000,
+            failure_rate=options["failure_rate"],
+        )
+        self.stdout.write(
+            f"{options['devices']} devices x {options['peripherals']} peripherals x {options['parameters']} parameters, "
+            f"latency {options['latency']}ms +/- {options['jitter']}ms, failure rate {options['failure_rate']}"
+        )
+
+        with bench_database():
+            fleet.populate()
+            rows = asyncio.run(self.run(fleet, levels, options))
+
+        self.stdout.write(format_table(
+            ["clients", "commands", "errors", "device rqs", "p50 ms", "p95 ms", "p99 ms", "max ms", "cmd/s"],
+            rows,
+        ))
+
+    def build_command(self, fleet, options):
+        device = random.choice(fleet.devices)
+        periph_id = random.choice(list(device.params))
+        param = random.choice(list(device.params[periph_id].values()))
+        command = {"dev_id": device.dev_id, "periph_id": periph_id, "param_id": param.param_id}
+        if random.random() < options["set_ratio"]:
+            command.update({"cmd_type": "SET", "data": random.randint(1, param.max_value), "data_type": param.data_type})
+        else:
+            command["cmd_type"] = "GET"
+            if not options["use_cache"]:
+                command["max_age"] = 0
+        return command
+
+    ''' one client sending commands back to back - returns (latencies, errors) '''
+    async def client(self, communicator, count, fleet, options):
+        latencies = []
+        errors = 0
+        for _ in range(count):
+            command = self.build_command(fleet, options)
+            start = time.perf_counter()
+            await communicator.send_to(text_data=json.dumps(command))
+            response = json.loads(await communicator.receive_from(timeout=30))
+            latencies.append(time.perf_counter() - start)
+            if response.get("rsp_type") == RSP_TYPE_ERR:
+                errors += 1
+        return latencies, errors
+
+    async def run_level(self, clients, fleet, options):
+        communicators = [WebsocketCommunicator(CommandConsumer.as_asgi(), "/ws/peripheral/") for _ in range(clients)]
+        for c in communicators:
+            await c.connect()
+
+        ## spread the commands over the clients
+        counts = [options["commands"] // clients + (1 if i < options["commands"] % clients else 0) for i in range(clients)]
+        requests_before = fleet.request_count()
+        start = time.perf_counter()
+        results = await asyncio.gather(*[self.client(c, n, fleet, options) for c, n in zip(communicators, counts)])
+        wall = time.perf_counter() - start
+
+        for c in communicators:
+            await c.disconnect()
+
+        latencies = [t for r in results for t in r[0]]
+        summary = latency_summary(latencies)
+        return [
+            clients, len(latencies), sum(r[1] for r in results), fleet.request_count() - requests_before,
+            summary["p50"], summary["p95"], summary["p99"], summary["max"],
+            len(latencies) / wall if wall > 0 else 0.0,
+        ]
+
+    async def run(self, fleet, levels, options):
+        reset_state()
+        await fleet.start()
+        rows = []
+        try:
+            with quiet():
+                ## warm up - registry load & pooled connections to every device
+                await self.run_level(1, fleet, dict(options, commands=len(fleet.devices) * 2))
+                for clients in levels:
+                    rows.append(await self.run_level(clients, fleet, options))
+                await close_services()
+        finally:
+            await fleet.stop()
+        return rows
@@ -0,0 +1,130 @@
+import json
+import time
+import asyncio
+
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from CommandControl.benchmark import format_table, bench_database, quiet, reset_state, close_services, QueryCounter
+from CommandControl.simulator import SimFleet, SIM_CMD_URL
+from CommandControl.consumers import Discoverer
+from CommandControl.enumeration import discovery_config
+from CommandControl import models
+
+
+## Discoverer console messages which end the network & database phases
+BENCH_NETWORK_DONE = [" Device succesfully enumerated", "Device enumeration failed :("]
+BENCH_ENUM_DONE = ["Succesfully enumerated Device!", "Failed to Enumerate Device :("]
+
+
+@database_sync_to_async
+def remove_devices():
+    models.Device.objects.all().delete()
+
+
+##
+#   bench_enumeration - onboarding through the Discoverer websocket
+#   for each device size (peripherals x parameters), enumerates a fleet of simulated
+#   devices one after another as the discover page does, up to storing the device tree
+#   reports the time per device split into the network & database phases, with the
+#   device http requests & sql statements issued. Runs on a throwaway test database
+#
+class Command(BaseCommand):
+    help = "Benchmark device enumeration & storage through Discoverer against simulated devices"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", default="2x4,8x16,32x32", help="comma separated PERIPHERALSxPARAMETERS device sizes")
+        parser.add_argument("--devices", type=int, default=10, help="devices enumerated per size")
+        parser.add_argument("--latency", type=float, default=5.0, help="device response latency (ms)")
+        parser.add_argument("--jitter", type=float, default=1.0, help="device latency jitter (ms)")
+        parser.add_argument("--max-in-flight", type=int, default=None, help="info requests in flight per device (default from settings)")
+        parser.add_argument("--port", type=int, default=19800, help="first simulated device port")
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [tuple(int(n) for n in s.split("x")) for s in options["sizes"].split(",")]
+            if any(len(s) != 2 for s in sizes):
+                raise ValueError
+        except ValueError:
+            raise CommandError("--sizes must be comma separated PERIPHERALSxPARAMETERS, eg. 2x4,8x16")
+
+        discovery = discovery_config()
+        if options["max_in_flight"] is not None:
+            discovery["MAX_IN_FLIGHT"] = options["max_in_flight"]
+        self.stdout.write(
+            f"{options['devices']} devices per size, {options['latency']}ms +/- {options['jitter']}ms latency, "
+            f"{discovery['MAX_IN_FLIGHT']} requests in flight per device"
+        )
+
+        with bench_database(), override_settings(DISCOVERY=discovery):
+            rows = asyncio.run(self.run(sizes, options))
+
+        self.stdout.write(format_table(
+            ["periphs", "params", "ok", "total ms", "network ms", "db ms", "sql ms", "http rqs", "sql queries", "devices/s"],
+            rows,
+        ))
+        self.stdout.write("ms, http rqs & sql queries are per device - sql ms is the time inside sql statements")
+
+    ''' enumerate one device - returns success, network seconds, database seconds '''
+    async def enumerate(self, communicator, device):
+        start = time.perf_counter()
+        network_done = None
+        await communicator.send_to(text_data=json.dumps({
+            "ip_addr": device.host, "port": device.port, "extension": SIM_CMD_URL,
+        }))
+        while True:
+            msg = json.loads(await communicator.receive_from(timeout=60))["data"]
+            if msg in BENCH_NETWORK_DONE:
+                network_done = time.perf_counter()
+            elif msg in BENCH_ENUM_DONE:
+                end = time.perf_counter()
+                if network_done is None:
+                    network_done = end
+                return msg == BENCH_ENUM_DONE[0], network_done - start, end - network_done
+
+    async def run_size(self, peripherals, parameters, options):
+        fleet = SimFleet(
+            options["devices"], base_port=options["port"], peripherals=peripherals, parameters=parameters,
+            latency=options["latency"] / 1000, jitter=options["jitter"] / 1000,
+        )
+        await fleet.start()
+        communicator = WebsocketCommunicator(Discoverer.as_asgi(), "/ws/discover/")
+        await communicator.connect()
+        queries = QueryCounter()
+        await queries.install()
+
+        ok = 0
+        network = database = 0.0
+        start = time.perf_counter()
+        try:
+            for device in fleet.devices:
+                success, net, db = await self.enumerate(communicator, device)
+                ok += success
+                network += net
+                database += db
+        finally:
+            wall = time.perf_counter() - start
+            await queries.remove()
+            await communicator.disconnect()
+            await fleet.stop()
+        ## the next size reuses the device ids
+        await remove_devices()
+        reset_state()
+
+        n = len(fleet.devices)
+        return [
+            peripherals, parameters, f"{ok}/{n}",
+            wall / n * 1000, network / n * 1000, database / n * 1000, queries.elapsed / n * 1000,
+            fleet.request_count() / n, queries.count / n, n / wall,
+        ]
+
+    async def run(self, sizes, options):
+        reset_state()
+        rows = []
+        with quiet():
+            for peripherals, parameters in sizes:
+                rows.append(await self.run_size(peripherals, parameters, options))
+            await close_services()
+        return rows
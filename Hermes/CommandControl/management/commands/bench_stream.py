@@ -0,0 +1,219 @@
+import json
+import time
+import asyncio
+import multiprocessing
+
+import numpy as np
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+
+from CommandControl.benchmark import latency_summary, format_table, bench_database, quiet, reset_state, close_services
+from CommandControl.simulator import SimFleet
+from CommandControl.consumers import DeviceStream
+from CommandControl.stream_decoder import FrameLayout
+from CommandControl.stream_encoder import decode_binary_frame, STREAM_PROTOCOLS
+from CommandControl.command_api import *
+
+
+## stream rate codes for the rates a device can be asked for
+BENCH_STREAM_RATES = {hz: rate for rate, hz in API_WEBSOCKET_RATE_HZ.items()}
+## names of the probe parameters (see SimDevice) in the client packets
+BENCH_CLOCK_NAME = "param 1"
+BENCH_SEQ_NAME = "param 2"
+
+
+def run_fleet(fleet, sent, ready, stop):
+    """ child process - serve the simulated devices, publishing frames sent per device """
+    async def serve():
+        await fleet.start()
+        ready.set()
+        while not stop.is_set():
+            for i, device in enumerate(fleet.devices):
+                sent[i] = device.frames_sent
+            await asyncio.sleep(0.05)
+        await fleet.stop()
+    asyncio.run(serve())
+
+
+#######################
+##  class StreamClient
+#   \brief  - one subscribed browser client - records the latency of every frame
+#             (from the probe clock) & the sequence numbers seen, while recording is on
+class StreamClient():
+
+    def __init__(self, clock_epoch: float):
+        self.communicator = WebsocketCommunicator(DeviceStream.as_asgi(), "/ws/stream/")
+        self.names = []
+        self.clock_epoch = clock_epoch
+        self.recording = False
+        self.latencies = []
+        self.seqs = []
+        self.frames = 0
+        self.task = None
+
+    async def start(self, start_request: dict):
+        await self.communicator.connect()
+        await self.communicator.send_to(text_data=json.dumps(start_request))
+        self.task = asyncio.ensure_future(self.receive())
+
+    def record(self, clocks, seqs):
+        if self.recording:
+            now = time.time() - self.clock_epoch
+            self.latencies.extend(now - c for c in clocks)
+            self.seqs.extend(int(s) for s in seqs)
+            self.frames += len(seqs)
+
+    async def receive(self):
+        while True:
+            output = await self.communicator.receive_output(timeout=60)
+            if output.get("bytes") is not None:
+                times, columns = decode_binary_frame(output["bytes"])
+                self.record(columns[self.names.index(BENCH_CLOCK_NAME)], columns[self.names.index(BENCH_SEQ_NAME)])
+            elif output.get("text") is not None:
+                packet = json.loads(output["text"])
+                if packet.get("packet_type") == "ws_stream_info":
+                    self.names = packet["names"]
+                elif packet.get("packet_type") == "ws_data":
+                    self.record([packet[BENCH_CLOCK_NAME]], [packet[BENCH_SEQ_NAME]])
+
+    ''' frames missing between the first & last sequence numbers seen '''
+    def drops(self):
+        if len(self.seqs) == 0:
+            return 0
+        seqs = np.unique(self.seqs)
+        return int(seqs[-1] - seqs[0] + 1 - len(seqs))
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        await self.communicator.disconnect()
+
+
+##
+#   bench_stream - device stream throughput & latency through DeviceStream
+#   simulated devices (in a child process) stream probe frames to the server - for each
+#   number of streams, reports frames in/out per second, drops, end to end latency
+#   to the subscribed clients & server cpu per frame. Runs on a throwaway test database
+#
+class Command(BaseCommand):
+    help = "Benchmark device stream throughput, latency & cpu through DeviceStream against simulated devices"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--streams", default="1,10,50,100", help="comma separated stream counts per run")
+        parser.add_argument("--parameters", type=int, default=4, help="parameters per stream (at least 2)")
+        parser.add_argument("--rate", type=int, default=10, choices=sorted(BENCH_STREAM_RATES), help="stream rate (Hz)")
+        parser.add_argument("--frames-per-message", type=int, default=1)
+        parser.add_argument("--clients", type=int, default=1, help="subscribed clients per stream")
+        parser.add_argument("--protocol", default="json", choices=STREAM_PROTOCOLS)
+        parser.add_argument("--seconds", type=float, default=5.0, help="measured seconds per run")
+        parser.add_argument("--warmup", type=float, default=1.0, help="seconds before measuring")
+        parser.add_argument("--decode-frames", type=int, default=200000, help="frames for the decode benchmark")
+        parser.add_argument("--port", type=int, default=19500, help="first simulated device port")
+
+    def handle(self, *args, **options):
+        try:
+            levels = [int(s) for s in options["streams"].split(",")]
+        except ValueError:
+            raise CommandError("--streams must be comma separated integers")
+        if options["parameters"] < 2:
+            raise CommandError("--parameters must be at least 2 (the clock & sequence probes)")
+
+        self.stdout.write(self.decode_benchmark(options))
+
+        clock_epoch = time.time()
+        fleet = SimFleet(
+            max(levels), base_port=options["port"], peripherals=1, parameters=options["parameters"],
+            frames_per_message=options["frames_per_message"], stream_probe=True, clock_epoch=clock_epoch,
+        )
+        self.stdout.write(
+            f"{options['parameters']} parameters at {options['rate']}Hz, {options['frames_per_message']} frames/message, "
+            f"{options['clients']} clients/stream, {options['protocol']} protocol, {options['seconds']}s per run"
+        )
+
+        with bench_database():
+            fleet.populate()
+            sent = multiprocessing.Array("q", len(fleet.devices), lock=False)
+            ready = multiprocessing.Event()
+            stop = multiprocessing.Event()
+            ## the devices run in their own process, so the cpu measured is the server's
+            child = multiprocessing.Process(target=run_fleet, args=(fleet, sent, ready, stop), daemon=True)
+            child.start()
+            try:
+                if not ready.wait(30):
+                    raise CommandError("Simulated devices didn't start")
+                rows = asyncio.run(self.run(levels, sent, clock_epoch, options))
+            finally:
+                stop.set()
+                child.join(10)
+
+        self.stdout.write(format_table(
+            ["streams", "frames in/s", "frames out/s", "drops", "drop %", "p50 ms", "p95 ms", "p99 ms", "cpu us/frame", "cpu %"],
+            rows,
+        ))
+
+    ''' decode + column conversion rate for the stream's frame layout '''
+    def decode_benchmark(self, options):
+        data_types = [PARAMTYPE_DOUBLE] + [PARAMTYPE_UINT32] * (options["parameters"] - 1)
+        layout = FrameLayout([f"param {i + 1}" for i in range(options["parameters"])], data_types)
+        per_message = options["frames_per_message"]
+        message = bytes([API_WEBSOCKET_DELIMITER_CHAR]) * (layout.frame_size * per_message)
+        messages = max(1, options["decode_frames"] // per_message)
+
+        start = time.perf_counter()
+        for _ in range(messages):
+            layout.columns(layout.decode(message))
+        elapsed = time.perf_counter() - start
+        frames = messages * per_message
+        return (
+            f"decode: {frames / elapsed:,.0f} frames/s, {elapsed / frames * 1e6:.2f} us/frame "
+            f"({layout.fmt_string}, {per_message} frames/message)"
+        )
+
+    async def run_level(self, streams, sent, clock_epoch, options):
+        start_request = {
+            "cmd_type": "STREAM", "periph_id": 1, "param_ids": list(range(1, options["parameters"] + 1)),
+            "rate": BENCH_STREAM_RATES[options["rate"]], "type": 0, "backfill": 0, "protocol": options["protocol"],
+        }
+        clients = []
+        for dev_id in range(1, streams + 1):
+            for _ in range(options["clients"]):
+                client = StreamClient(clock_epoch)
+                await client.start(dict(start_request, dev_id=dev_id))
+                clients.append(client)
+
+        await asyncio.sleep(options["warmup"])
+        sent_before = sum(sent[:streams])
+        cpu_before = time.process_time()
+        start = time.perf_counter()
+        for c in clients:
+            c.recording = True
+        await asyncio.sleep(options["seconds"])
+        for c in clients:
+            c.recording = False
+        wall = time.perf_counter() - start
+        cpu = time.process_time() - cpu_before
+        frames_in = sum(sent[:streams]) - sent_before
+
+        for c in clients:
+            await c.stop()
+        ## let the upstreams close before the next run
+        await asyncio.sleep(0.5)
+
+        frames_out = sum(c.frames for c in clients)
+        drops = sum(c.drops() for c in clients)
+        summary = latency_summary([t for c in clients for t in c.latencies])
+        return [
+            streams, frames_in / wall, frames_out / wall, drops,
+            100.0 * drops / max(1, drops + frames_out),
+            summary["p50"], summary["p95"], summary["p99"],
+            cpu / max(1, frames_in) * 1e6, 100.0 * cpu / wall,
+        ]
+
+    async def run(self, levels, sent, clock_epoch, options):
+        reset_state()
+        rows = []
+        with quiet():
+            for streams in levels:
+                rows.append(await self.run_level(streams, sent, clock_epoch, options))
+            await close_services()
+        return rows
@@ -0,0 +1,297 @@
+
+import abc
+import time
+import bisect
+import functools
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from . import command_api
+
+
+## prometheus text exposition format
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+## default histogram buckets (seconds) - device round trips & database hops
+METRICS_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def metrics_config():
+    """ returns the metrics settings merged over the defaults """
+    config = {
+        "ENABLED": True,
+    }
+    config.update(getattr(settings, "METRICS", {}))
+    return config
+
+
+## label names for the api codes - ERR_CODE_*/CMD_TYPE_* constant name by value
+def code_names(prefix: str):
+    return {v: k for k, v in vars(command_api).items() if k.startswith(prefix) and isinstance(v, int)}
+
+
+ERR_CODE_NAMES = code_names("ERR_CODE_")
+CMD_TYPE_NAMES = code_names("CMD_TYPE_")
+
+
+def err_code_name(err_code):
+    return ERR_CODE_NAMES.get(err_code, "UNKNOWN")
+
+
+def cmd_type_name(cmd_type):
+    return CMD_TYPE_NAMES.get(cmd_type, "UNKNOWN")
+
+
+def device_label(url: str):
+    """ host:port of a device url - the device label """
+    parts = url.split("/")
+    return parts[2] if len(parts) > 2 else url
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+#######################
+##  class CounterChild / GaugeChild / HistogramChild
+#   \brief  - the value(s) of a metric for one set of label values
+#             hold on to the child (metric.labels(...)) in hot paths - an update is
+#             then a single attribute add. Updated from the event loop, so not locked
+class CounterChild():
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class GaugeChild(CounterChild):
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+class HistogramChild():
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        ''' per bucket counts, the last is +Inf - made cumulative when rendered '''
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    ''' a context manager observing the seconds spent inside it '''
+    def time(self):
+        return HistogramTimer(self)
+
+
+class HistogramTimer():
+
+    def __init__(self, child: HistogramChild):
+        self.child = child
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(time.perf_counter() - self.start)
+
+
+#######################
+##  class Metric
+#   \brief  - a named metric with a fixed list of label names & a child per
+#             set of label values - create with counter(), gauge() or histogram()
+#             abstract - subclasses give the kind & the child type
+class Metric(abc.ABC):
+
+    kind = "untyped"
+
+    def __init__(self, name: str, doc: str, label_names: tuple = ()):
+        self.name = name
+        self.doc = doc
+        self.label_names = tuple(label_names)
+        self.children = {}
+
+    ''' a child holding the value(s) for one set of label values '''
+    @abc.abstractmethod
+    def new_child(self):
+        pass
+
+    ''' the child for these label values, created on first use '''
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError(f"{self.name} takes labels {self.label_names}")
+            child = self.new_child()
+            self.children[values] = child
+        return child
+
+    def label_string(self, values, extra: str = ""):
+        pairs = [f'{n}="{escape_label(v)}"' for n, v in zip(self.label_names, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self):
+        for values, child in list(self.children.items()):
+            yield self.name, self.label_string(values), child.value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        lines += [f"{name}{labels} {value!r}" for name, labels, value in self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+
+    kind = "counter"
+
+    def new_child(self):
+        return CounterChild()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+
+    kind = "gauge"
+
+    def new_child(self):
+        return GaugeChild()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1):
+        self.labels().dec(amount)
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, label_names: tuple = (), buckets: tuple = METRICS_LATENCY_BUCKETS):
+        super().__init__(name, doc, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def samples(self):
+        bounds = [repr(float(b)) for b in self.buckets] + ["+Inf"]
+        for values, child in list(self.children.items()):
+            total = 0
+            for bound, count in zip(bounds, child.counts):
+                total += count
+                yield self.name + "_bucket", self.label_string(values, f'le="{bound}"'), total
+            yield self.name + "_sum", self.label_string(values), child.sum
+            yield self.name + "_count", self.label_string(values), total
+
+
+#######################
+##  class MetricsRegistry
+#   \brief  - every metric in the process, rendered together for /metrics
+#             each worker process has its own registry (see README)
+class MetricsRegistry():
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric: Metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        return "\n".join(m.render() for m in self.metrics.values()) + "\n"
+
+
+## the process-wide registry
+metrics_registry = MetricsRegistry()
+
+
+def counter(name: str, doc: str, label_names: tuple = ()):
+    return metrics_registry.register(Counter(name, doc, label_names))
+
+
+def gauge(name: str, doc: str, label_names: tuple = ()):
+    return metrics_registry.register(Gauge(name, doc, label_names))
+
+
+def histogram(name: str, doc: str, label_names: tuple = (), buckets: tuple = METRICS_LATENCY_BUCKETS):
+    return metrics_registry.register(Histogram(name, doc, label_names, buckets))
+
+
+def render_metrics():
+    """ every metric in the text exposition format """
+    return metrics_registry.render()
+
+
+## device i/o
+DEVICE_REQUEST_SECONDS = histogram("hermes_device_request_seconds", "Device api request round trip time", ("device", "cmd_type"))
+DEVICE_REQUEST_ERRORS = counter("hermes_device_request_errors_total", "Failed device api requests", ("device", "code"))
+DEVICE_REQUESTS_IN_FLIGHT = gauge("hermes_device_requests_in_flight", "Device api requests awaiting a response", ("device",))
+ERROR_RESPONSES = counter("hermes_error_responses_total", "Error responses sent to clients", ("code",))
+
+## device streams
+STREAM_FRAMES = counter("hermes_stream_frames_total", "Stream frames received from devices", ("device",))
+STREAM_BYTES = counter("hermes_stream_bytes_total", "Stream bytes received from devices", ("device",))
+STREAM_DECODE_ERRORS = counter("hermes_stream_decode_errors_total", "Stream messages which failed to decode", ("device",))
+STREAM_UPSTREAMS = gauge("hermes_stream_upstreams", "Device stream upstreams open in this worker")
+
+## websockets & database
+WEBSOCKET_CONNECTIONS = gauge("hermes_websocket_connections", "Open websocket connections", ("route",))
+WEBSOCKET_CONNECTIONS_TOTAL = counter("hermes_websocket_connections_total", "Websocket connections opened", ("route",))
+DB_HOP_SECONDS = histogram("hermes_db_hop_seconds", "Time for a database_sync_to_async hop, queueing included", ("op",))
+
+
+def db_hop(op: str):
+    """ database_sync_to_async, with the time of every hop observed into DB_HOP_SECONDS """
+    def wrap(func):
+        hop = database_sync_to_async(func)
+        child = DB_HOP_SECONDS.labels(op)
+
+        @functools.wraps(func)
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await hop(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - start)
+        return timed
+    return wrap
+
+
+def count_connections(route: str, app):
+    """ wrap a websocket route's asgi app to count its connections - the app
+        runs for as long as the connection is open
+    """
+    current = WEBSOCKET_CONNECTIONS.labels(route)
+    total = WEBSOCKET_CONNECTIONS_TOTAL.labels(route)
+
+    async def counted(scope, receive, send):
+        current.inc()
+        total.inc()
+        try:
+            return await app(scope, receive, send)
+        finally:
+            current.dec()
+    return counted
@@ -0,0 +1,132 @@
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CommandControl', '0010_auto_20201224_2312'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='parameter',
+            name='value_type',
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='api_port',
+            field=models.IntegerField(default=80),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='cmd_url',
+            field=models.CharField(default='', max_length=50),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='dev_id',
+            field=models.IntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='is_powered',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='last_polled',
+            field=models.DateField(default=datetime.datetime(1, 1, 1, 0, 0)),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='setup_date',
+            field=models.DateField(default=datetime.datetime(1, 1, 1, 0, 0)),
+        ),
+        migrations.AddField(
+            model_name='device',
+            name='sleep_state',
+            field=models.IntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='parameter',
+            name='data_type',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='parameter',
+            name='is_streamable',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='parameter',
+            name='last_value',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='parameter',
+            name='last_value_string',
+            field=models.CharField(default='', max_length=500),
+        ),
+        migrations.AddField(
+            model_name='parameter',
+            name='param_id',
+            field=models.IntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='parameter',
+            name='units',
+            field=models.TextField(default='', max_length=20),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='peripheral',
+            name='is_powered',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='peripheral',
+            name='periph_id',
+            field=models.IntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='peripheral',
+            name='sleep_state',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='parameter',
+            name='is_action',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='parameter',
+            name='is_getable',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='parameter',
+            name='is_setable',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='parameter',
+            name='max_value',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='peripheral',
+            name='num_params',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='peripheral',
+            name='periph_type',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,42 @@
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CommandControl', '0011_sync_models'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ParameterRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.IntegerField()),
+                ('start', models.FloatField()),
+                ('count', models.IntegerField(default=0)),
+                ('min_value', models.FloatField()),
+                ('max_value', models.FloatField()),
+                ('sum_value', models.FloatField()),
+                ('parameter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='CommandControl.parameter')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['period', 'start'], name='CommandCont_period_f55f82_idx')],
+                'unique_together': {('parameter', 'period', 'start')},
+            },
+        ),
+        migrations.CreateModel(
+            name='ParameterSample',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('timestamp', models.FloatField()),
+                ('value', models.FloatField()),
+                ('parameter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='CommandControl.parameter')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['parameter', 'timestamp'], name='CommandCont_paramet_6f6527_idx'), models.Index(fields=['timestamp'], name='CommandCont_timesta_a8e412_idx')],
+            },
+        ),
+    ]
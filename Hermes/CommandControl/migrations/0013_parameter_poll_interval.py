@@ -0,0 +1,17 @@
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CommandControl', '0012_parameter_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='parameter',
+            name='poll_interval',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,33 @@
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CommandControl', '0013_parameter_poll_interval'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Scene',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=40, unique=True)),
+                ('description', models.CharField(blank=True, default='', max_length=200)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SceneTarget',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.IntegerField(default=0)),
+                ('parameter', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='CommandControl.parameter')),
+                ('scene', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='targets', to='CommandControl.scene')),
+            ],
+            options={
+                'unique_together': {('scene', 'parameter')},
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('CommandControl', '0014_scenes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scenetarget',
+            name='value_string',
+            field=models.CharField(blank=True, default='', max_length=500),
+        ),
+    ]
@@ -48,5 +48,67 @@ class Parameter(models.Model):
     last_value = models.IntegerField(default=0)
     last_value_string = models.CharField(default="", max_length=500)
     units = models.TextField(max_length=20)
+    ## seconds between background polls - 0 uses the peripheral type default, < 0 never polls
+    poll_interval = models.IntegerField(default=0)
 
 
+
+class ParameterSample(models.Model):
+    """ a raw parameter value - timestamp is epoch seconds """
+
+    parameter = models.ForeignKey(Parameter, on_delete=models.CASCADE)
+    timestamp = models.FloatField()
+    value = models.FloatField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["parameter", "timestamp"]),
+            models.Index(fields=["timestamp"]),
+        ]
+
+
+class ParameterRollup(models.Model):
+    """ min/max/mean of a parameter over one period (seconds) starting at start (epoch seconds) """
+
+    parameter = models.ForeignKey(Parameter, on_delete=models.CASCADE)
+    period = models.IntegerField()
+    start = models.FloatField()
+    count = models.IntegerField(default=0)
+    min_value = models.FloatField()
+    max_value = models.FloatField()
+    sum_value = models.FloatField()
+
+    class Meta:
+        unique_together = [("parameter", "period", "start")]
+        indexes = [
+            models.Index(fields=["period", "start"]),
+        ]
+
+    @property
+    def mean_value(self):
+        return self.sum_value / self.count if self.count else 0.0
+
+
+class Scene(models.Model):
+    """ a named set of parameter values applied together, eg. "evening" """
+
+    name = models.CharField(max_length=40, unique=True)
+    description = models.CharField(max_length=200, blank=True, default="")
+
+    def __str__(self):
+        return self.name
+
+
+class SceneTarget(models.Model):
+    """ one parameter value of a scene - the parameter gives the device & peripheral
+        like Parameter.last_value(_string), int & bool parameters use value, string
+        parameters value_string. Float parameters use value_string when it is set
+    """
+
+    scene = models.ForeignKey(Scene, on_delete=models.CASCADE, related_name="targets")
+    parameter = models.ForeignKey(Parameter, on_delete=models.CASCADE)
+    value = models.IntegerField(default=0)
+    value_string = models.CharField(default="", max_length=500, blank=True)
+
+    class Meta:
+        unique_together = [("scene", "parameter")]
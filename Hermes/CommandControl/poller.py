@@ -0,0 +1,251 @@
+
+import time
+import heapq
+import random
+import asyncio
+from datetime import date
+
+from django.conf import settings
+from channels.layers import get_channel_layer
+
+from .command_api import *
+from .registry import registry
+from .consumers import send_command
+from .worker_lock import WorkerLock, worker_config
+from .channel_layer import shares_workers
+from .metrics import db_hop
+from . import models
+
+
+## seconds between polls of a getable parameter without its own poll_interval
+POLL_DEFAULT_INTERVAL = 60
+## seconds between polls per peripheral type - sensors are polled more often
+POLL_PERIPH_TYPE_INTERVALS = {
+    PTYPE_ENVIRO_SENSOR: 30,
+    PTYPE_DISTANCE_SENSOR: 15,
+    PTYPE_POWER_SENSOR: 15,
+    PTYPE_ADC: 30,
+    PTYPE_IO: 30,
+}
+## polls in flight across all devices, & per device
+POLL_MAX_IN_FLIGHT = 8
+POLL_DEVICE_CONCURRENCY = 1
+## +/- fraction of the interval added to each reschedule
+POLL_JITTER = 0.1
+## longest backoff (seconds) after repeated failures
+POLL_BACKOFF_MAX = 600
+## longest sleep (seconds) between scheduler passes
+POLL_TICK = 1.0
+
+## errors which mean the device itself is unreachable - these back off the whole device
+POLL_DEVICE_ERRORS = [
+    ERR_CODE_INVALID_URL,
+    ERR_CODE_HTTP_TIMEOUT,
+    ERR_CODE_DEVICE_UNREACHABLE,
+    ERR_CODE_INVALID_RSP_JSON,
+    ERR_CODE_DEVICE_DOWN,
+]
+
+
+def polling_config():
+    """ returns the polling settings merged over the defaults """
+    config = {
+        "ENABLED": True,
+        "DEFAULT_INTERVAL": POLL_DEFAULT_INTERVAL,
+        "PERIPH_TYPE_INTERVALS": POLL_PERIPH_TYPE_INTERVALS,
+        "MAX_IN_FLIGHT": POLL_MAX_IN_FLIGHT,
+        "DEVICE_CONCURRENCY": POLL_DEVICE_CONCURRENCY,
+        "JITTER": POLL_JITTER,
+        "BACKOFF_MAX": POLL_BACKOFF_MAX,
+        "TICK": POLL_TICK,
+    }
+    overrides = dict(getattr(settings, "POLLING", {}))
+    ## per type intervals are merged over the defaults rather than replacing them
+    config["PERIPH_TYPE_INTERVALS"] = dict(POLL_PERIPH_TYPE_INTERVALS)
+    config["PERIPH_TYPE_INTERVALS"].update(overrides.pop("PERIPH_TYPE_INTERVALS", {}))
+    config.update(overrides)
+    return config
+
+
+#######################
+##  class ParameterPoller
+#   \brief  - background GETs of every getable parameter, keyed (dev_id, periph_id, param_id)
+#             each parameter is polled on its poll_interval, or its peripheral type's
+#             interval. First polls are spread randomly over one interval & every
+#             reschedule is jittered, so the fleet isn't polled in lock step
+#             failures back off exponentially - per device when it is unreachable,
+#             per parameter when the device returns an error
+#             responses go through send_command, the same update path as user GETs
+#             with several workers only the one holding the poller lock polls
+class ParameterPoller():
+
+    def __init__(self):
+        ''' heap of (due time, key) '''
+        self.schedule = []
+        self.intervals = {}
+        self.generation = None
+        self.failures = {}
+        self.device_failures = {}
+        self.device_retry_at = {}
+        self.device_semaphores = {}
+        self.semaphore = None
+        self.in_flight = set()
+        self.tasks = set()
+        self.polled_devices = set()
+        self.task = None
+        ''' the poller's WorkerLock, None when this is the only worker '''
+        self.lock = None
+        self.config = polling_config()
+
+    def interval_for(self, param):
+        if param.poll_interval != 0:
+            return param.poll_interval
+        return self.config["PERIPH_TYPE_INTERVALS"].get(param.peripheral.periph_type, self.config["DEFAULT_INTERVAL"])
+
+    def jittered(self, interval: float):
+        j = self.config["JITTER"]
+        return interval * (1 + random.uniform(-j, j))
+
+    def backoff(self, interval: float, failures: int):
+        return min(self.config["BACKOFF_MAX"], interval * (2 ** failures))
+
+    ''' sync the schedule with the registry - existing parameters keep their due times '''
+    def rebuild(self, now: float):
+        intervals = {}
+        for param in registry.all_parameters():
+            if param.is_getable:
+                interval = self.interval_for(param)
+                if interval > 0:
+                    key = (param.peripheral.device.dev_id, param.peripheral.periph_id, param.param_id)
+                    intervals[key] = interval
+
+        due = {key: t for t, key in self.schedule if key in intervals}
+        for key, interval in intervals.items():
+            if key not in due and key not in self.in_flight:
+                due[key] = now + random.uniform(0, interval)
+        self.schedule = [(t, key) for key, t in due.items()]
+        heapq.heapify(self.schedule)
+        self.intervals = intervals
+        self.generation = registry.generation
+        debug_print(f"Poll schedule has {len(intervals)} parameters")
+
+    ''' start polls for every due parameter, returns seconds until the next is due '''
+    def dispatch(self, now: float):
+        while len(self.schedule) > 0 and self.schedule[0][0] <= now:
+            _, key = heapq.heappop(self.schedule)
+            if key not in self.intervals or key in self.in_flight:
+                continue
+            retry_at = self.device_retry_at.get(key[0], 0)
+            if retry_at > now:
+                heapq.heappush(self.schedule, (retry_at + random.uniform(0, self.config["TICK"]), key))
+                continue
+            self.in_flight.add(key)
+            task = asyncio.ensure_future(self.poll(key))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+        if len(self.schedule) == 0:
+            return self.config["TICK"]
+        return min(self.config["TICK"], max(0, self.schedule[0][0] - now))
+
+    ''' GET one parameter & reschedule it '''
+    async def poll(self, key):
+        dev_id = key[0]
+        interval = self.intervals.get(key, self.config["DEFAULT_INTERVAL"])
+        next_poll = self.jittered(interval)
+        try:
+            device = registry.get_device(dev_id)
+            if device is None:
+                return
+            device_sem = self.device_semaphores.setdefault(dev_id, asyncio.Semaphore(self.config["DEVICE_CONCURRENCY"]))
+            async with device_sem:
+                async with self.semaphore:
+                    url = assemble_url(device.ip_address, device.api_port, device.cmd_url)
+                    rq = {"cmd_type": CMD_TYPE_GET, "periph_id": key[1], "param_id": key[2]}
+                    ## always read the device - the poll refreshes the GET cache too
+                    response = await send_command(rq, url, dev_id, max_age=0)
+
+            now = time.monotonic()
+            if response.get('rsp_type') != RSP_TYPE_ERR:
+                self.failures.pop(key, None)
+                self.device_failures.pop(dev_id, None)
+                self.device_retry_at.pop(dev_id, None)
+                self.polled_devices.add(dev_id)
+            elif response.get('err_code') in POLL_DEVICE_ERRORS:
+                failures = self.device_failures.get(dev_id, 0) + 1
+                self.device_failures[dev_id] = failures
+                self.device_retry_at[dev_id] = now + self.jittered(self.backoff(interval, failures - 1))
+                debug_print(f"Polling device {dev_id} failed {failures} times, backing off")
+            else:
+                failures = self.failures.get(key, 0) + 1
+                self.failures[key] = failures
+                next_poll = self.jittered(self.backoff(interval, failures))
+        finally:
+            self.in_flight.discard(key)
+            if key in self.intervals:
+                heapq.heappush(self.schedule, (time.monotonic() + next_poll, key))
+
+    ''' record the poll date on devices polled since the last call - one update query '''
+    async def mark_polled(self):
+        today = date.today()
+        dev_ids = []
+        for dev_id in self.polled_devices:
+            device = registry.get_device(dev_id)
+            if device is not None and device.last_polled != today:
+                device.last_polled = today
+                dev_ids.append(dev_id)
+        self.polled_devices = set()
+        if len(dev_ids) > 0:
+            await db_hop("poll_update")(
+                models.Device.objects.filter(dev_id__in=dev_ids).update
+            )(last_polled=today)
+
+    async def run(self):
+        self.config = polling_config()
+        self.semaphore = asyncio.Semaphore(self.config["MAX_IN_FLIGHT"])
+        ## a single worker always polls - no lock file needed
+        if self.lock is None and shares_workers(get_channel_layer()):
+            self.lock = WorkerLock("poller")
+        ## another worker may be polling - wait to take over if it exits
+        while self.lock is not None and not self.lock.try_acquire():
+            await asyncio.sleep(worker_config()["LOCK_RETRY"])
+        print("Parameter poller started")
+        while True:
+            await registry.ensure_loaded()
+            now = time.monotonic()
+            if self.generation != registry.generation:
+                self.rebuild(now)
+            wait = self.dispatch(now)
+            await self.mark_polled()
+            await asyncio.sleep(wait)
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.run())
+
+    ''' stop the scheduler & any polls in flight '''
+    async def stop(self):
+        for task in [self.task] + list(self.tasks):
+            if task is not None and not task.done():
+                task.cancel()
+        if self.task is not None:
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.task = None
+        if self.lock is not None:
+            self.lock.release()
+
+
+## the process-wide poller
+poller = ParameterPoller()
+
+
+async def start_poller():
+    if polling_config()["ENABLED"]:
+        poller.start()
+
+
+async def stop_poller():
+    await poller.stop()
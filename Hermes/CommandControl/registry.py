@@ -0,0 +1,152 @@
+
+import time
+import threading
+
+from django.db.models.signals import post_save, post_delete
+
+from .command_api import debug_print
+from .metrics import db_hop
+from . import models
+
+
+## seconds before the registry is reloaded even without a change signal
+## (catches changes made by other processes)
+REGISTRY_MAX_AGE = 60
+
+## fields which change during normal operation - saves touching only these
+## are copied onto the cached objects instead of invalidating the registry
+REGISTRY_VOLATILE_FIELDS = {
+    "last_value",
+    "last_value_string",
+    "is_powered",
+    "last_polled",
+    "sleep_state",
+}
+
+
+def registry_key(*ids):
+    """ normalise ids from requests (often strings) to an int tuple, None if invalid """
+    try:
+        return tuple(int(i) for i in ids)
+    except (TypeError, ValueError):
+        return None
+
+
+#######################
+##  class DeviceRegistry
+#   \brief  - in-memory index of devices, peripherals & parameters for the command path
+#             indexed by (dev_id), (dev_id, periph_id) & (dev_id, periph_id, param_id)
+#             the cached objects share parents - parameter.peripheral.device is the
+#             same object as the one returned by get_device()
+class DeviceRegistry():
+
+    def __init__(self, max_age: float = REGISTRY_MAX_AGE):
+        self.max_age = max_age
+        self.devices = {}
+        self.peripherals = {}
+        self.parameters = {}
+        self.by_pk = {}
+        self.loaded_at = None
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    ''' (re)load the whole registry - blocking, run in the db thread '''
+    def load(self):
+        generation = self.generation
+
+        devices = {D.pk: D for D in models.Device.objects.all()}
+        periphs = {}
+        for P in models.Peripheral.objects.all():
+            if P.device_id in devices:
+                P.device = devices[P.device_id]
+                periphs[P.pk] = P
+        params = {}
+        for prm in models.Parameter.objects.all():
+            if prm.peripheral_id in periphs:
+                prm.peripheral = periphs[prm.peripheral_id]
+                params[prm.pk] = prm
+        ## values waiting in the write behind buffer are newer than the db
+        from .write_behind import write_behind
+        write_behind.apply_pending(params)
+
+        by_pk = {}
+        dev_index = {}
+        for D in devices.values():
+            dev_index[D.dev_id] = D
+            by_pk[(models.Device, D.pk)] = D
+        periph_index = {}
+        for P in periphs.values():
+            periph_index[(P.device.dev_id, P.periph_id)] = P
+            by_pk[(models.Peripheral, P.pk)] = P
+        param_index = {}
+        for prm in params.values():
+            param_index[(prm.peripheral.device.dev_id, prm.peripheral.periph_id, prm.param_id)] = prm
+            by_pk[(models.Parameter, prm.pk)] = prm
+
+        with self.lock:
+            self.devices = dev_index
+            self.peripherals = periph_index
+            self.parameters = param_index
+            self.by_pk = by_pk
+            ## only mark loaded if nothing changed while we were reading
+            if generation == self.generation:
+                self.loaded_at = time.monotonic()
+        debug_print(f"Registry loaded {len(dev_index)} devices, {len(periph_index)} peripherals, {len(param_index)} parameters")
+
+    ''' mark the registry stale - it is reloaded on next use '''
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.loaded_at = None
+
+    def is_stale(self):
+        return self.loaded_at is None or (time.monotonic() - self.loaded_at) > self.max_age
+
+    ''' load the registry if stale - a single db hop '''
+    async def ensure_loaded(self):
+        if self.is_stale():
+            await db_hop("registry_load")(self.load)()
+
+    ''' copy updated volatile fields onto the cached copy of an object '''
+    def refresh_fields(self, instance, fields):
+        cached = self.by_pk.get((type(instance), instance.pk))
+        if cached is None:
+            self.invalidate()
+        elif cached is not instance:
+            for f in fields:
+                setattr(cached, f, getattr(instance, f))
+
+    def get_device(self, dev_id):
+        key = registry_key(dev_id)
+        return self.devices.get(key[0]) if key else None
+
+    def get_peripheral(self, dev_id, periph_id):
+        return self.peripherals.get(registry_key(dev_id, periph_id))
+
+    def get_parameter(self, dev_id, periph_id, param_id):
+        return self.parameters.get(registry_key(dev_id, periph_id, param_id))
+
+    def all_parameters(self):
+        return list(self.parameters.values())
+
+
+## the process-wide registry
+registry = DeviceRegistry()
+
+
+## signal handlers - connected in CommandcontrolConfig.ready()
+def on_model_saved(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and set(update_fields) <= REGISTRY_VOLATILE_FIELDS:
+        registry.refresh_fields(instance, update_fields)
+    else:
+        registry.invalidate()
+
+
+def on_model_deleted(sender, instance, **kwargs):
+    registry.invalidate()
+
+
+def connect_signals():
+    for model in (models.Device, models.Peripheral, models.Parameter):
+        post_save.connect(on_model_saved, sender=model, dispatch_uid=f"registry_save_{model.__name__}")
+        post_delete.connect(on_model_deleted, sender=model, dispatch_uid=f"registry_delete_{model.__name__}")
@@ -0,0 +1,127 @@
+
+import time
+import numpy as np
+
+from django.conf import settings
+
+from .command_api import *
+
+
+## seconds of stream samples kept in memory per parameter
+STREAM_BUFFER_SECONDS = 600
+## default seconds of history sent to a new subscriber
+STREAM_BACKFILL_SECONDS = 60
+## seconds between decimated sends to a subscriber
+STREAM_DECIMATION_INTERVAL = 0.5
+## default ms of samples coalesced into one binary frame
+STREAM_BINARY_WINDOW_MS = 50
+
+
+def streaming_config():
+    """ returns the streaming settings merged over the defaults """
+    config = {
+        "BUFFER_SECONDS": STREAM_BUFFER_SECONDS,
+        "BACKFILL_SECONDS": STREAM_BACKFILL_SECONDS,
+        "DECIMATION_INTERVAL": STREAM_DECIMATION_INTERVAL,
+        "BINARY_WINDOW_MS": STREAM_BINARY_WINDOW_MS,
+    }
+    config.update(getattr(settings, "STREAMING", {}))
+    return config
+
+
+#######################
+##  class SampleRingBuffer
+#   \brief  - fixed size, array backed buffer of (time, value) samples
+#             the oldest samples are overwritten once full
+#   \param capacity - number of samples held
+class SampleRingBuffer():
+
+    def __init__(self, capacity: int):
+        self.capacity = int(capacity)
+        self.times = np.zeros(self.capacity, dtype="f8")
+        self.values = np.zeros(self.capacity, dtype="f8")
+        ''' index of the next write & number of valid samples '''
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    ''' append arrays of samples - vectorised, wrapping at the end of the buffer '''
+    def extend(self, times, values):
+        times = np.asarray(times, dtype="f8")
+        values = np.asarray(values, dtype="f8")
+        n = len(times)
+        if n == 0:
+            return
+        if n >= self.capacity:
+            times = times[-self.capacity:]
+            values = values[-self.capacity:]
+            n = self.capacity
+
+        end = self.head + n
+        if end <= self.capacity:
+            self.times[self.head:end] = times
+            self.values[self.head:end] = values
+        else:
+            split = self.capacity - self.head
+            self.times[self.head:] = times[:split]
+            self.values[self.head:] = values[:split]
+            self.times[:n - split] = times[split:]
+            self.values[:n - split] = values[split:]
+
+        self.head = end % self.capacity
+        self.count = min(self.capacity, self.count + n)
+
+    ''' all samples in time order - returns copies of (times, values) '''
+    def ordered(self):
+        if self.count < self.capacity:
+            return self.times[:self.count].copy(), self.values[:self.count].copy()
+        return np.roll(self.times, -self.head), np.roll(self.values, -self.head)
+
+    ''' samples at or after since (epoch seconds), or all samples if since is None '''
+    def window(self, since: float = None, until: float = None):
+        times, values = self.ordered()
+        start = 0 if since is None else np.searchsorted(times, since, side="left")
+        end = len(times) if until is None else np.searchsorted(times, until, side="right")
+        return times[start:end], values[start:end]
+
+    ''' the time of the oldest sample held, None if empty '''
+    def oldest(self):
+        if self.count == 0:
+            return None
+        return self.times[self.head if self.count == self.capacity else 0]
+
+
+## ring buffers per streamed parameter, keyed by (dev_id, periph_id, param_id)
+_stream_buffers = {}
+
+
+def get_stream_buffer(key, create: bool = False):
+    buf = _stream_buffers.get(key)
+    if buf is None and create:
+        config = streaming_config()
+        hz = API_WEBSOCKET_RATE_HZ[API_WEBSOCKET_MAX_RATE]
+        buf = SampleRingBuffer(config["BUFFER_SECONDS"] * hz)
+        _stream_buffers[key] = buf
+    return buf
+
+
+def frame_times(n: int, rate: int, now: float = None):
+    """ receive times for n frames which arrived in one message - spaced back
+        from now by the stream rate period
+    """
+    if now is None:
+        now = time.time()
+    period = 1.0 / API_WEBSOCKET_RATE_HZ.get(rate, 1)
+    return now - period * np.arange(n - 1, -1, -1, dtype="f8")
+
+
+def recent_samples(dev_id, periph_id, param_id, seconds: float):
+    """ samples from the last `seconds` for a streamed parameter - served from memory
+        returns (times, values) arrays, empty if the parameter has no stream buffer
+    """
+    buf = get_stream_buffer((int(dev_id), int(periph_id), int(param_id)))
+    if buf is None:
+        return np.zeros(0), np.zeros(0)
+    return buf.window(since=time.time() - seconds)
@@ -1,12 +1,13 @@
 from django.urls import re_path
 from . import consumers
+from .metrics import count_connections
 
 
 # stream_path = "ws/" + consumers.API_WEBSOCKET_INCOMMING_STREAM_EXTENSION 
 
 websocket_urlpatterns = [
-    re_path('ws/peripheral/', consumers.CommandConsumer.as_asgi()),
-    re_path('ws/discover/', consumers.Discoverer.as_asgi()),
-    re_path('ws/ledctrl', consumers.LedCtrlConsumer.as_asgi()),
-    re_path('ws/stream/', consumers.DeviceStream.as_asgi()),
+    re_path('ws/peripheral/', count_connections("peripheral", consumers.CommandConsumer.as_asgi())),
+    re_path('ws/discover/', count_connections("discover", consumers.Discoverer.as_asgi())),
+    re_path('ws/ledctrl', count_connections("ledctrl", consumers.LedCtrlConsumer.as_asgi())),
+    re_path('ws/stream/', count_connections("stream", consumers.DeviceStream.as_asgi())),
 ]
\ No newline at end of file
@@ -0,0 +1,149 @@
+
+import time
+import asyncio
+
+
+from .command_api import *
+from .registry import registry
+from .device_health import device_health, health_key, HEALTH_UP
+from .metrics import db_hop
+from . import models
+
+
+## scene target outcomes
+SCENE_TARGET_APPLIED = "applied"
+SCENE_TARGET_SKIPPED = "skipped"
+SCENE_TARGET_FAILED = "failed"
+
+
+def load_scene(scene_id: int = None, name: str = None):
+    """ the scene & its targets by primary key, or by name if no key is given
+        blocking, run in the db thread - returns (scene, [targets]) or (None, [])
+    """
+    if scene_id is not None:
+        scene = models.Scene.objects.filter(pk=scene_id).first()
+    else:
+        scene = models.Scene.objects.filter(name=name).first()
+    if scene is None:
+        return None, []
+    return scene, list(scene.targets.all())
+
+
+def target_value(target, param):
+    """ the value a scene target sets, typed for its parameter
+        raises ValueError if a float target's value_string isn't a number
+    """
+    if param.data_type == PARAMTYPE_STRING:
+        return target.value_string
+    if param.data_type in (PARAMTYPE_FLOAT, PARAMTYPE_DOUBLE) and target.value_string != "":
+        return float(target.value_string)
+    return target.value
+
+
+#######################
+##  class SceneApply
+#   \brief  - applies one scene - every SET is sent concurrently, limited per device
+#             targets whose value is already current (last value matches & the
+#             device has been reachable since) are skipped unless forced
+#             run() returns a report with the outcome & time of every target
+class SceneApply():
+
+    def __init__(self, scene, targets, force: bool = False, device_concurrency: int = 2):
+        self.scene = scene
+        self.targets = targets
+        self.force = force
+        self.device_concurrency = device_concurrency
+        self.device_locks = {}
+
+    ''' true if the parameter is known to hold value already '''
+    def is_current(self, param, device, value):
+        last_value = param.last_value_string if param.data_type == PARAMTYPE_STRING else param.last_value
+        if last_value != value:
+            return False
+        ## a device which was down or hasn't been heard from may have reset
+        host, port = health_key(assemble_url(device.ip_address, device.api_port, device.cmd_url))
+        return device_health.state(host, port) == HEALTH_UP
+
+    def target_report(self, param, value, status, elapsed=0.0, err_code=None, msg=None):
+        report = {
+            "dev_id": param.peripheral.device.dev_id if param is not None else None,
+            "periph_id": param.peripheral.periph_id if param is not None else None,
+            "param_id": param.param_id if param is not None else None,
+            "value": value,
+            "status": status,
+            "elapsed_ms": round(elapsed * 1000, 1),
+        }
+        if err_code is not None:
+            report["err_code"] = err_code
+            report["msg"] = msg if msg is not None else error_messages.get(err_code, "unknown error!")
+        return report
+
+    ''' SET one target - returns its report '''
+    async def apply_target(self, param, value):
+        ## imported here - consumers imports the scenes
+        from .consumers import send_command, update_parameter
+
+        device = param.peripheral.device
+        if not param.is_setable:
+            return self.target_report(param, value, SCENE_TARGET_FAILED, err_code=ERR_CODE_INVALID_REQUEST, msg="Parameter is not setable")
+        if not isinstance(value, str) and (value < 0 or (param.max_value > 0 and value > param.max_value)):
+            return self.target_report(param, value, SCENE_TARGET_FAILED, err_code=ERR_CODE_INVALID_DATA_VALUE)
+        if not self.force and self.is_current(param, device, value):
+            return self.target_report(param, value, SCENE_TARGET_SKIPPED)
+
+        url = assemble_url(device.ip_address, device.api_port, device.cmd_url)
+        rq = {
+            "cmd_type": CMD_TYPE_SET,
+            "periph_id": param.peripheral.periph_id,
+            "param_id": param.param_id,
+            "data_type": int(param.data_type),
+            "data": value,
+        }
+        lock = self.device_locks.setdefault(device.dev_id, asyncio.Semaphore(self.device_concurrency))
+        start = time.monotonic()
+        async with lock:
+            response = await send_command(rq, url, device.dev_id, max_age=0)
+        elapsed = time.monotonic() - start
+
+        if response.get('rsp_type') == RSP_TYPE_ERR:
+            return self.target_report(param, value, SCENE_TARGET_FAILED, elapsed, response.get('err_code'), response.get('msg'))
+        await update_parameter(value, param)
+        return self.target_report(param, value, SCENE_TARGET_APPLIED, elapsed)
+
+    async def run(self):
+        start = time.monotonic()
+        await registry.ensure_loaded()
+
+        jobs = []
+        reports = []
+        for target in self.targets:
+            param = registry.by_pk.get((models.Parameter, target.parameter_id))
+            if param is None:
+                reports.append(self.target_report(None, target.value, SCENE_TARGET_FAILED, err_code=ERR_CODE_INVALID_PARAM_ID))
+                continue
+            try:
+                value = target_value(target, param)
+            except ValueError:
+                reports.append(self.target_report(param, target.value_string, SCENE_TARGET_FAILED, err_code=ERR_CODE_INVALID_DATA_VALUE))
+                continue
+            jobs.append(self.apply_target(param, value))
+
+        reports += await asyncio.gather(*jobs)
+        statuses = [r["status"] for r in reports]
+        return {
+            "scene": self.scene.name,
+            "count": len(reports),
+            "applied": statuses.count(SCENE_TARGET_APPLIED),
+            "skipped": statuses.count(SCENE_TARGET_SKIPPED),
+            "failed": statuses.count(SCENE_TARGET_FAILED),
+            "elapsed_ms": round((time.monotonic() - start) * 1000, 1),
+            "targets": reports,
+        }
+
+
+async def apply_scene(scene_id: int = None, name: str = None, force: bool = False, device_concurrency: int = 2):
+    """ apply a scene by primary key or name - returns the report, None if there is no such scene """
+    scene, targets = await db_hop("load_scene")(load_scene)(scene_id, name)
+    if scene is None:
+        return None
+    return await SceneApply(scene, targets, force, device_concurrency).run()
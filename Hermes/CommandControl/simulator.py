@@ -0,0 +1,270 @@
+
+import json
+import time
+import random
+import asyncio
+
+import numpy as np
+from aiohttp import web
+
+from .command_api import *
+from .stream_decoder import FrameLayout
+from . import models
+
+
+## default simulated fleet - per device peripheral & parameter counts, seconds of
+## response latency (+/- jitter) & the fraction of requests which fail
+SIM_PERIPHERALS = 2
+SIM_PARAMETERS = 4
+SIM_LATENCY = 0.02
+SIM_JITTER = 0.005
+SIM_FAILURE_RATE = 0.0
+## peripheral types handed out in turn
+SIM_PERIPH_TYPES = [
+    PTYPE_ADDR_LEDS,
+    PTYPE_ENVIRO_SENSOR,
+    PTYPE_POWER_SENSOR,
+    PTYPE_IO,
+]
+SIM_CMD_URL = "api"
+SIM_STREAM_URL = "stream"
+
+
+#######################
+##  class SimParameter
+#   \brief  - one parameter of a simulated peripheral - getable, setable & streamable
+class SimParameter():
+
+    def __init__(self, param_id: int, max_value: int = 1000, data_type: int = PARAMTYPE_UINT32):
+        self.param_id = param_id
+        self.max_value = max_value
+        self.data_type = data_type
+        self.methods = API_GET_MASK | API_SET_MASK | API_STREAM_MASK
+        self.value = random.randint(0, max_value)
+
+    def info(self, periph_id: int):
+        return {
+            "rsp_type": RSP_TYPE_INFO,
+            "param_name": f"param {self.param_id}",
+            "periph_id": periph_id,
+            "param_id": self.param_id,
+            "methods": self.methods,
+            "param_max": self.max_value,
+            "data_type": self.data_type,
+        }
+
+
+#######################
+##  class SimDevice
+#   \brief  - a virtual device speaking the device json api on its own port
+#             latency, jitter & failure_rate shape every response - a failed
+#             request gets an error response, or (one in four) the connection is dropped
+#             streams frames in the FrameLayout format at the requested rate (or
+#             stream_hz), frames_per_message frames per websocket message
+#             with stream_probe, parameter 1 of every peripheral is a double holding the
+#             send time (seconds since clock_epoch) & parameter 2 a frame sequence number
+class SimDevice():
+
+    def __init__(self, dev_id: int, port: int, host: str = "127.0.0.1",
+                 peripherals: int = SIM_PERIPHERALS, parameters: int = SIM_PARAMETERS,
+                 latency: float = SIM_LATENCY, jitter: float = SIM_JITTER, failure_rate: float = SIM_FAILURE_RATE,
+                 stream_hz: float = None, frames_per_message: int = 1, stream_probe: bool = False, clock_epoch: float = 0.0):
+        self.dev_id = dev_id
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.periph_types = {p: SIM_PERIPH_TYPES[(p - 1) % len(SIM_PERIPH_TYPES)] for p in range(1, peripherals + 1)}
+        self.params = {
+            p: {n: SimParameter(n) for n in range(1, parameters + 1)}
+            for p in range(1, peripherals + 1)
+        }
+        self.stream_hz = stream_hz
+        self.frames_per_message = frames_per_message
+        self.stream_probe = stream_probe
+        self.clock_epoch = clock_epoch
+        if stream_probe:
+            for params in self.params.values():
+                params[1].data_type = PARAMTYPE_DOUBLE
+        ''' requests handled - cmd_type -> count '''
+        self.requests = {}
+        self.failures = 0
+        self.frames_sent = 0
+        self.runner = None
+
+    @property
+    def url(self):
+        return assemble_url(self.host, self.port, SIM_CMD_URL)
+
+    def error(self, err_code: int):
+        return {"rsp_type": RSP_TYPE_ERR, "err_code": err_code, "msg": error_messages.get(err_code, "error")}
+
+    ''' the response to one request dict '''
+    def respond(self, rq: dict):
+        cmd_type = rq.get("cmd_type")
+        periph_id = rq.get("periph_id", 0)
+        param_id = rq.get("param_id", 0)
+
+        if cmd_type == CMD_TYPE_INFO and periph_id == 0:
+            return {
+                "rsp_type": RSP_TYPE_INFO,
+                "name": f"sim device {self.dev_id}",
+                "periph_ids": list(self.params),
+                "periph_num": len(self.params),
+                "dev_id": self.dev_id,
+            }
+        if periph_id not in self.params:
+            return self.error(ERR_CODE_INVALID_PERIPH_ID)
+        if cmd_type == CMD_TYPE_INFO and param_id == 0:
+            return {
+                "rsp_type": RSP_TYPE_INFO,
+                "name": f"peripheral {periph_id}",
+                "periph_id": periph_id,
+                "param_ids": list(self.params[periph_id]),
+                "param_num": len(self.params[periph_id]),
+                "periph_type": self.periph_types[periph_id],
+            }
+        param = self.params[periph_id].get(param_id)
+        if param is None:
+            return self.error(ERR_CODE_INVALID_PARAM_ID)
+
+        if cmd_type == CMD_TYPE_INFO:
+            return param.info(periph_id)
+        if cmd_type == CMD_TYPE_GET:
+            return {"rsp_type": RSP_TYPE_DATA, "periph_id": periph_id, "param_id": param_id, "data": param.value, "data_type": param.data_type}
+        if cmd_type == CMD_TYPE_SET:
+            try:
+                value = int(rq["data"])
+            except (KeyError, TypeError, ValueError):
+                return self.error(ERR_CODE_INVALID_DATA_TYPE)
+            if value > param.max_value:
+                return self.error(ERR_CODE_INVALID_DATA_VALUE)
+            param.value = value
+            return {"rsp_type": RSP_TYPE_OK, "periph_id": periph_id, "param_id": param_id}
+        if cmd_type == CMD_TYPE_ACTION:
+            return {"rsp_type": RSP_TYPE_OK, "periph_id": periph_id, "param_id": param_id}
+        return self.error(ERR_CODE_INVALID_REQUEST)
+
+    async def handle_command(self, request):
+        try:
+            rq = await request.json()
+        except ValueError:
+            return web.json_response(self.error(ERR_CODE_INVALID_JSON))
+        cmd_type = rq.get("cmd_type")
+        self.requests[cmd_type] = self.requests.get(cmd_type, 0) + 1
+
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        if self.failure_rate > 0 and random.random() < self.failure_rate:
+            self.failures += 1
+            if random.random() < 0.25:
+                request.transport.close()
+                return web.Response()
+            return web.json_response(self.error(ERR_CODE_ERROR_RESPONSE))
+        return web.json_response(self.respond(rq))
+
+    ''' fill the next frames of a stream - the probe parameters, then the stored values '''
+    def fill_frames(self, frames, layout: FrameLayout, params: list, seq: int):
+        n = len(frames)
+        for f, param in zip(layout.fields, params):
+            if self.stream_probe and param.param_id == 1:
+                frames[f] = time.time() - self.clock_epoch
+            elif self.stream_probe and param.param_id == 2:
+                frames[f] = np.arange(seq, seq + n)
+            else:
+                frames[f] = param.value
+
+    async def handle_stream(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        try:
+            init = json.loads((await ws.receive(timeout=10)).data)
+            periph_id = init["periph_id"]
+            params = [self.params[periph_id][p] for p in init["param_ids"]]
+            layout = FrameLayout([f"param {p.param_id}" for p in params], [p.data_type for p in params])
+        except (ValueError, KeyError, TypeError, asyncio.TimeoutError):
+            await ws.close()
+            return ws
+
+        hz = self.stream_hz or API_WEBSOCKET_RATE_HZ.get(init.get("rate"), 1)
+        period = self.frames_per_message / hz
+        ## frames are written into a buffer pre-filled with the delimiter, so only values change
+        buf = bytearray([API_WEBSOCKET_DELIMITER_CHAR]) * (layout.frame_size * self.frames_per_message)
+        frames = np.frombuffer(buf, dtype=layout.dtype)
+        seq = 0
+        loop = asyncio.get_event_loop()
+        next_send = loop.time()
+        try:
+            while not ws.closed:
+                self.fill_frames(frames, layout, params, seq)
+                await ws.send_bytes(bytes(buf))
+                seq += self.frames_per_message
+                self.frames_sent += self.frames_per_message
+                next_send += period
+                await asyncio.sleep(max(0, next_send - loop.time()))
+        except (ConnectionError, RuntimeError):
+            pass
+        return ws
+
+    def build_app(self):
+        app = web.Application()
+        app.router.add_post(f"/{SIM_CMD_URL}", self.handle_command)
+        app.router.add_get(f"/{SIM_STREAM_URL}", self.handle_stream)
+        return app
+
+    async def start(self):
+        self.runner = web.AppRunner(self.build_app(), access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    ''' add the device, peripherals & parameters to the db, as enumeration would - blocking '''
+    def populate(self):
+        device = models.Device.objects.create(
+            dev_id=self.dev_id, ip_address=self.host, api_port=self.port, cmd_url=SIM_CMD_URL,
+            mac_address="", name=f"sim device {self.dev_id}", num_peripherals=len(self.params),
+            dev_type="sim", sleep_state=0,
+        )
+        for periph_id, params in self.params.items():
+            periph = models.Peripheral.objects.create(
+                periph_id=periph_id, device=device, name=f"peripheral {periph_id}",
+                num_params=len(params), periph_type=self.periph_types[periph_id],
+            )
+            models.Parameter.objects.bulk_create([
+                models.Parameter(
+                    param_id=p.param_id, peripheral=periph, name=f"param {p.param_id}",
+                    max_value=p.max_value, data_type=p.data_type, is_getable=True,
+                    is_setable=True, is_streamable=True, last_value=p.value, units="",
+                )
+                for p in params.values()
+            ])
+        return device
+
+
+#######################
+##  class SimFleet
+#   \brief  - N simulated devices on consecutive ports from base_port
+class SimFleet():
+
+    def __init__(self, count: int, base_port: int = 19000, **device_kwargs):
+        self.devices = [SimDevice(i + 1, base_port + i, **device_kwargs) for i in range(count)]
+
+    async def start(self):
+        await asyncio.gather(*[d.start() for d in self.devices])
+
+    async def stop(self):
+        await asyncio.gather(*[d.stop() for d in self.devices])
+
+    def populate(self):
+        for d in self.devices:
+            d.populate()
+
+    def request_count(self):
+        return sum(sum(d.requests.values()) for d in self.devices)
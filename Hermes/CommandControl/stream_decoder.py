@@ -0,0 +1,124 @@
+
+import struct
+import numpy as np
+
+from .command_api import *
+from .registry import registry
+
+
+## numpy types for each api parameter type - little endian, matching the device packing
+## the api does not distinguish signed types, so ints are unpacked as unsigned (as before)
+PARAM_DTYPES = {
+    PARAMTYPE_UINT8: "u1",
+    PARAMTYPE_UINT16: "<u2",
+    PARAMTYPE_UINT32: "<u4",
+    PARAMTYPE_FLOAT: "<f4",
+    PARAMTYPE_DOUBLE: "<f8",
+    PARAMTYPE_STRING: "S1",
+    PARAMTYPE_BOOL: "?",
+}
+
+## struct format characters for each api parameter type
+PARAM_STRUCT_CHARS = {
+    PARAMTYPE_UINT8: "B",
+    PARAMTYPE_UINT16: "H",
+    PARAMTYPE_UINT32: "L",
+    PARAMTYPE_FLOAT: "f",
+    PARAMTYPE_DOUBLE: "d",
+    PARAMTYPE_STRING: "s",
+    PARAMTYPE_BOOL: "?",
+}
+
+
+#######################
+##  class FrameLayout
+#   \brief  - compiled layout of a stream frame
+#             a frame is each value packed little endian with a delimiter byte
+#             between values and a trailing delimiter byte:
+#                 [value0][0x7C][value1][0x7C]...[valueN][0x7C]
+#             the delimiter slots are skipped by offset so real values equal
+#             to the delimiter char are kept
+#   \param names - the parameter names, in stream order
+#   \param data_types - the api data type of each parameter
+class FrameLayout():
+
+    def __init__(self, names: list, data_types: list):
+        self.names = list(names)
+        self.items = len(self.names)
+
+        fields = []
+        formats = []
+        offsets = []
+        fstring = "<"
+        offset = 0
+        for i, dtype in enumerate(data_types):
+            if dtype not in PARAM_DTYPES:
+                raise ValueError(f"Parameter {self.names[i]} has unstreamable data type {dtype}")
+            if i > 0:
+                offset += 1
+                fstring += "b" ## delimiter byte
+            fields.append(f"f{i}")
+            formats.append(PARAM_DTYPES[dtype])
+            offsets.append(offset)
+            offset += np.dtype(PARAM_DTYPES[dtype]).itemsize
+            fstring += PARAM_STRUCT_CHARS[dtype]
+
+        self.fields = fields
+        self.fmt_string = fstring
+        self.pkt_length = struct.calcsize(fstring)
+        ''' frame size on the wire includes the trailing delimiter '''
+        self.frame_size = self.pkt_length + 1
+        self.dtype = np.dtype({
+            "names": fields,
+            "formats": formats,
+            "offsets": offsets,
+            "itemsize": self.frame_size,
+        })
+
+    ''' decode a binary message holding one or more frames - returns a structured array '''
+    def decode(self, data: bytes):
+        if len(data) == 0 or len(data) % self.frame_size != 0:
+            raise ValueError(f"Message length {len(data)} is not a multiple of frame size {self.frame_size}")
+        return np.frombuffer(data, dtype=self.dtype)
+
+    ''' convert decoded frames to per-parameter lists of python values '''
+    def columns(self, frames):
+        columns = []
+        for f in self.fields:
+            col = frames[f]
+            if col.dtype.kind == "S":
+                columns.append([v.decode("latin-1") for v in col.tolist()])
+            else:
+                columns.append(col.tolist())
+        return columns
+
+    ''' convert decoded frames to a list of {name: value} dicts, one per frame '''
+    def to_dicts(self, frames):
+        return [dict(zip(self.names, values)) for values in zip(*self.columns(frames))]
+
+
+## compiled layouts keyed by (dev_id, periph_id, param_ids)
+_layout_cache = {}
+
+
+async def get_frame_layout(dev_id, periph_id, param_ids: list):
+    """ returns the cached FrameLayout for the stream, building it from the
+        registry if needed. Raises ValueError for an unknown/unstreamable parameter
+    """
+    await registry.ensure_loaded()
+    key = (dev_id, periph_id, tuple(param_ids))
+    cached = _layout_cache.get(key)
+    if cached is not None and cached[0] == registry.generation:
+        return cached[1]
+
+    params = []
+    for n in param_ids:
+        p = registry.get_parameter(dev_id, periph_id, n)
+        if p is None:
+            raise ValueError(f"Parameter {n} not found")
+        params.append(p)
+
+    layout = FrameLayout([p.name for p in params], [p.data_type for p in params])
+    debug_print(f"Built frame layout: {layout.fmt_string}")
+    _layout_cache[key] = (registry.generation, layout)
+    return layout
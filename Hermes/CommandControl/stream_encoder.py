@@ -0,0 +1,121 @@
+
+import struct
+import numpy as np
+
+
+## binary subscriber protocol - little endian, one websocket frame per window:
+##     header      <2sBBId   magic "HS", version, column count, sample count, t0 (epoch seconds)
+##     col types   uint8 per column, zero padded to a multiple of 4 bytes
+##     times       int32 per sample - ms offset from t0
+##     columns     4 bytes per sample for each column, Float32, Int32 or Uint32 by col type
+## the column names are sent once as JSON (ws_stream_info) when the stream starts
+BINARY_MAGIC = b"HS"
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct("<2sBBId")
+
+BINARY_COL_FLOAT32 = 0
+BINARY_COL_INT32 = 1
+BINARY_COL_UINT32 = 2
+
+INT32_MIN = -2**31
+INT32_MAX = 2**31 - 1
+UINT32_MAX = 2**32 - 1
+
+BINARY_COL_DTYPES = {
+    BINARY_COL_FLOAT32: "<f4",
+    BINARY_COL_INT32: "<i4",
+    BINARY_COL_UINT32: "<u4",
+}
+
+PROTOCOL_JSON = "json"
+PROTOCOL_BINARY = "binary"
+STREAM_PROTOCOLS = [PROTOCOL_JSON, PROTOCOL_BINARY]
+
+
+def encode_column(col: list):
+    """ pack a column of stream values - returns (col type, bytes)
+        floats pack as Float32, ints & bools as Int32, single char strings as their Int32 code
+        ints above the Int32 range pack as Uint32, any that fit neither go as Float32 rather than wrapping
+    """
+    if len(col) > 0 and isinstance(col[0], str):
+        return BINARY_COL_INT32, np.array([ord(c[:1]) if c else 0 for c in col], dtype="<i4").tobytes()
+    arr = np.asarray(col)
+    if arr.dtype.kind == "f":
+        return BINARY_COL_FLOAT32, arr.astype("<f4").tobytes()
+    if arr.size == 0:
+        return BINARY_COL_INT32, b""
+    ## object arrays hold ints too big for int64 - python ints compare fine either way
+    low, high = arr.min(), arr.max()
+    if low >= INT32_MIN and high <= INT32_MAX:
+        return BINARY_COL_INT32, arr.astype("<i4").tobytes()
+    if low >= 0 and high <= UINT32_MAX:
+        return BINARY_COL_UINT32, arr.astype("<u4").tobytes()
+    return BINARY_COL_FLOAT32, arr.astype("<f4").tobytes()
+
+
+def encode_binary_frame(times: list, columns: list):
+    """ pack samples into one binary protocol frame """
+    times = np.asarray(times, dtype="f8")
+    t0 = float(times[0])
+    offsets = np.round((times - t0) * 1000).astype("<i4")
+
+    col_types = bytearray()
+    payload = []
+    for col in columns:
+        col_type, data = encode_column(col)
+        col_types.append(col_type)
+        payload.append(data)
+    col_types.extend(b"\x00" * (-len(col_types) % 4))
+
+    header = BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(columns), len(times), t0)
+    return b"".join([header, bytes(col_types), offsets.tobytes()] + payload)
+
+
+def decode_binary_frame(data: bytes):
+    """ unpack a binary protocol frame - returns (times, columns) as numpy arrays """
+    magic, version, ncols, nsamples, t0 = BINARY_HEADER.unpack_from(data, 0)
+    if magic != BINARY_MAGIC or version != BINARY_VERSION:
+        raise ValueError("Not a binary stream frame")
+    offset = BINARY_HEADER.size
+    col_types = data[offset:offset + ncols]
+    offset += ncols + (-ncols % 4)
+
+    times = t0 + np.frombuffer(data, dtype="<i4", count=nsamples, offset=offset) / 1000.0
+    offset += 4 * nsamples
+    columns = []
+    for col_type in col_types:
+        dtype = BINARY_COL_DTYPES.get(col_type, "<i4")
+        columns.append(np.frombuffer(data, dtype=dtype, count=nsamples, offset=offset))
+        offset += 4 * nsamples
+    return times, columns
+
+
+#######################
+##  class FrameCoalescer
+#   \brief  - per subscriber buffer of stream samples, flushed as one binary
+#             protocol frame per window
+class FrameCoalescer():
+
+    def __init__(self):
+        self.names = []
+        self.times = []
+        self.columns = []
+
+    ''' queue the samples from one stream.data event '''
+    def add(self, names: list, times: list, columns: list):
+        if names != self.names:
+            self.names = list(names)
+            self.times = []
+            self.columns = [[] for _ in names]
+        self.times.extend(times)
+        for pending, col in zip(self.columns, columns):
+            pending.extend(col)
+
+    ''' encode & clear the queued samples - returns the frame bytes, None if nothing queued '''
+    def flush(self):
+        if len(self.times) == 0:
+            return None
+        frame = encode_binary_frame(self.times, self.columns)
+        self.times = []
+        self.columns = [[] for _ in self.names]
+        return frame
@@ -0,0 +1,244 @@
+
+import json
+import time
+import asyncio
+import hashlib
+import aiohttp
+from aiohttp.http_websocket import WSMsgType
+
+from channels.layers import get_channel_layer
+
+from .command_api import *
+from .stream_decoder import FrameLayout
+from .ring_buffer import get_stream_buffer, frame_times, streaming_config
+from .registry import registry
+from .history import history
+from .device_health import device_health
+from .worker_lock import WorkerLock, worker_config
+from .channel_layer import group_size, shares_workers
+from .metrics import STREAM_FRAMES, STREAM_BYTES, STREAM_DECODE_ERRORS, STREAM_UPSTREAMS, device_label
+
+
+## give up on the upstream after this many bad packets
+STREAM_MAX_ERRORS = 10
+## seconds without a packet before the upstream is considered dead
+STREAM_RECEIVE_TIMEOUT = 10
+## seconds between checks for subscribers in other workers once the local ones have left
+STREAM_LINGER_CHECK = 2.0
+
+
+def stream_key(dev_id, periph_id, param_ids: list):
+    return (int(dev_id), int(periph_id), tuple(int(p) for p in param_ids))
+
+
+def stream_group_name(key):
+    """ channel layer group for a stream - hashed to keep within the group name rules """
+    digest = hashlib.sha1(repr(key).encode()).hexdigest()[:16]
+    return f"stream.{key[0]}.{key[1]}.{digest}"
+
+
+#######################
+##  class StreamSession
+#   \brief  - a single upstream websocket to a device, shared by every client
+#             streaming the same device/peripheral/parameters
+#             decoded frames are sent to the session's channel layer group,
+#             the upstream is closed when the last subscriber leaves
+#             the stream rate is set by the first subscriber
+#             with several workers (the unix socket channel layer) only the one holding
+#             the stream's worker lock runs the upstream - the others' subscribers get its
+#             frames through the channel layer, & one of them takes the upstream over if
+#             that worker exits. Backfill comes from the local ring buffers, so only
+#             subscribers on the upstream's worker get one
+class StreamSession():
+
+    def __init__(self, key, url: str, init_packet: dict, layout: FrameLayout):
+        self.key = key
+        self.group = stream_group_name(key)
+        self.url = url
+        self.init_packet = init_packet
+        self.layout = layout
+        self.subscribers = set()
+        self.task = None
+        self.linger_task = None
+        self.channel_layer = get_channel_layer()
+        ## a single worker always owns its streams - no lock file needed
+        self.lock = WorkerLock(self.group) if shares_workers(self.channel_layer) else None
+        self.rate = init_packet.get("rate", API_WEBSOCKET_RATE_1HZ)
+        ## metric children, looked up once for the receive loop
+        device = device_label(url)
+        self.frames_metric = STREAM_FRAMES.labels(device)
+        self.bytes_metric = STREAM_BYTES.labels(device)
+        self.decode_errors_metric = STREAM_DECODE_ERRORS.labels(device)
+        ## ring buffers for the numeric parameters, in frame order (None for strings)
+        self.buffers = [
+            get_stream_buffer((key[0], key[1], param_id), create=True) if layout.dtype[f].kind != "S" else None
+            for param_id, f in zip(key[2], layout.fields)
+        ]
+        ## parameter pks for the history, in frame order
+        self.param_pks = []
+        for param_id in key[2]:
+            p = registry.get_parameter(key[0], key[1], param_id)
+            self.param_pks.append(p.pk if p is not None else None)
+
+    ''' start the upstream task if it isn't running '''
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.ensure_future(self.own())
+
+    ''' run the upstream once this worker holds the stream's lock '''
+    async def own(self):
+        if self.lock is None:
+            await self.run()
+            return
+        while not self.lock.try_acquire():
+            await asyncio.sleep(worker_config()["LOCK_RETRY"])
+        try:
+            await self.run()
+        finally:
+            self.lock.release()
+
+    ''' stop the upstream task '''
+    async def stop(self):
+        if self.linger_task is not None and self.linger_task is not asyncio.current_task():
+            self.linger_task.cancel()
+        self.linger_task = None
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                print("Stream upstream cancelled")
+        self.task = None
+
+    ''' keep the upstream running while other workers have subscribers, stop once nobody is left '''
+    async def linger(self):
+        while len(self.subscribers) == 0:
+            await asyncio.sleep(STREAM_LINGER_CHECK)
+            if len(self.subscribers) == 0 and await group_size(self.channel_layer, self.group) == 0:
+                if _sessions.get(self.key) is self:
+                    del _sessions[self.key]
+                await self.stop()
+                return
+
+    ''' store the decoded frames in the ring buffers & history, then fan out to every subscriber '''
+    async def publish(self, frames):
+        times = frame_times(len(frames), self.rate)
+        for buf, f, pk in zip(self.buffers, self.layout.fields, self.param_pks):
+            if buf is not None:
+                buf.extend(times, frames[f])
+                if pk is not None:
+                    history.record_many(pk, times, frames[f])
+
+        await self.channel_layer.group_send(self.group, {
+            "type": "stream.data",
+            "names": self.layout.names,
+            "times": times.tolist(),
+            "columns": self.layout.columns(frames),
+        })
+
+    ''' the recent buffered samples for a new subscriber - {name: {"t": [...], "v": [...]}} '''
+    def backfill(self, seconds: float):
+        since = time.time() - seconds
+        series = {}
+        for name, buf in zip(self.layout.names, self.buffers):
+            if buf is not None:
+                times, values = buf.window(since=since)
+                series[name] = {"t": times.tolist(), "v": values.tolist()}
+        return series
+
+    ''' the upstream bridge - connect to the device & publish frames until cancelled or failed '''
+    async def run(self):
+        err_count = 0
+        connected = False
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=STREAM_RECEIVE_TIMEOUT)
+        print(f"Stream upstream starting for {self.key}")
+        STREAM_UPSTREAMS.inc()
+
+        try:
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                async with session.ws_connect(self.url) as ws:
+                    connected = True
+                    device_health.record_success(self.url)
+                    debug_print("sending " + json.dumps(self.init_packet))
+                    await ws.send_str(json.dumps(self.init_packet))
+
+                    while err_count <= STREAM_MAX_ERRORS:
+                        incomming = await ws.receive(timeout=STREAM_RECEIVE_TIMEOUT)
+                        if incomming.type == WSMsgType.BINARY:
+                            self.bytes_metric.inc(len(incomming.data))
+                            try:
+                                frames = self.layout.decode(incomming.data)
+                            except ValueError as e:
+                                err_count += 1
+                                self.decode_errors_metric.inc()
+                                print(f"Unpacking error! {e}")
+                                continue
+                            self.frames_metric.inc(len(frames))
+                            await self.publish(frames)
+                        elif incomming.type == WSMsgType.TEXT:
+                            debug_print(f"Got a text packet {incomming.data}")
+                        elif incomming.type in (WSMsgType.CLOSE, WSMsgType.CLOSED, WSMsgType.ERROR):
+                            print("Device closed the stream")
+                            break
+                        else:
+                            err_count += 1
+
+                    if err_count > STREAM_MAX_ERRORS:
+                        print("stopped - error count")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"Stream upstream error: {e}")
+            if not connected:
+                device_health.record_failure(self.url)
+        finally:
+            STREAM_UPSTREAMS.dec()
+
+        ## tell the subscribers the stream has ended ##
+        await self.channel_layer.group_send(self.group, {"type": "stream.closed"})
+        if _sessions.get(self.key) is self:
+            del _sessions[self.key]
+
+
+## the running sessions, keyed by stream_key
+_sessions = {}
+
+
+async def join_stream(key, url: str, init_packet: dict, layout: FrameLayout, channel_name: str, backfill_seconds: float = None):
+    """ subscribe a consumer channel to the stream, starting the upstream if needed
+        the subscriber is first sent the last backfill_seconds of buffered samples
+        returns the session
+    """
+    session = _sessions.get(key)
+    if session is None:
+        session = StreamSession(key, url, init_packet, layout)
+        _sessions[key] = session
+
+    if backfill_seconds is None:
+        backfill_seconds = streaming_config()["BACKFILL_SECONDS"]
+    series = session.backfill(backfill_seconds) if backfill_seconds > 0 else {}
+
+    ## join the group straight after taking the backfill, & before the upstream starts,
+    ## so no frames are missed
+    await session.channel_layer.group_add(session.group, channel_name)
+    session.subscribers.add(channel_name)
+    if len(series) > 0:
+        await session.channel_layer.send(channel_name, {
+            "type": "stream.backfill",
+            "series": series,
+        })
+    session.start()
+    return session
+
+
+async def leave_stream(session: StreamSession, channel_name: str):
+    """ unsubscribe a consumer channel - the upstream is closed when nobody is left """
+    await session.channel_layer.group_discard(session.group, channel_name)
+    session.subscribers.discard(channel_name)
+    if len(session.subscribers) == 0:
+        if session.lock is not None and session.lock.held and await group_size(session.channel_layer, session.group) > 0:
+            ## subscribers in other workers still need this worker's upstream
+            if session.linger_task is None or session.linger_task.done():
+                session.linger_task = asyncio.ensure_future(session.linger())
+            return
+        if _sessions.get(session.key) is session:
+            del _sessions[session.key]
+        await session.stop()
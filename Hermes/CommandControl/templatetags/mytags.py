@@ -1,6 +1,8 @@
 
 from django import template
 
+from ..device_health import device_health
+
 register = template.Library()
 
 @register.filter
@@ -8,3 +10,9 @@ def ashex(value):
     return hex(value)
 
 
+
+
+@register.filter
+def health(device):
+    """ the tracked health state of a device - up, degraded, down, half-open or unknown """
+    return device_health.state(device.ip_address, device.api_port)
@@ -1,3 +1,1295 @@
-from django.test import TestCase
+import time
+import math
+import struct
+import random
+import asyncio
+import os
+import tempfile
+import io
+import contextlib
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from channels.testing import WebsocketCommunicator
+from channels.db import database_sync_to_async
+from channels.layers import InMemoryChannelLayer
+from django.db import DatabaseError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+
+from .command_api import *
+from .registry import registry, REGISTRY_MAX_AGE
+from .stream_decoder import FrameLayout
+from .ring_buffer import SampleRingBuffer
+from .decimation import minmax_decimate, lttb_decimate, StreamDecimator, DECIMATION_LTTB, DECIMATION_MINMAX
+from .stream_encoder import (encode_binary_frame, decode_binary_frame, encode_column, FrameCoalescer,
+                             BINARY_COL_FLOAT32, BINARY_COL_INT32, BINARY_COL_UINT32)
+from .write_behind import ParameterWriteBehind, write_behind, close_write_behind
+from .history import HistoryRecorder, select_tier, query_history, close_history
+from .poller import ParameterPoller, polling_config
+from .device_health import (HealthTracker, device_health, health_key, HEALTH_UP, HEALTH_DEGRADED,
+                            HEALTH_DOWN, HEALTH_HALF_OPEN, HEALTH_UNKNOWN, HEALTH_DOWN_AFTER,
+                            HEALTH_OPEN_SECONDS)
+from .device_client import DeviceClient, SWEEP_DEVICE_LABEL
+from .enumeration import SubnetSweeper
+from .get_cache import GetCache, get_cache, get_cache_key, request_max_age, get_cache_config
+from .scenes import apply_scene
+from .channel_layer import UnixSocketChannelLayer, group_size, shares_workers
+from .metrics import MetricsRegistry, Counter, Gauge, Histogram, Metric, DEVICE_REQUEST_SECONDS, cmd_type_name
+from .simulator import SimDevice, SIM_CMD_URL
+from .benchmark import reset_state, close_services
+from .lifespan import StartupOnConnect, startup_state
+from . import consumers, lifespan, models
+
+
+## simulated devices for the tests listen from here
+TEST_SIM_PORT = 19400
+
+
+@contextlib.contextmanager
+def quiet():
+    """ silence the print logging of the code under test """
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+def make_device(dev_id: int = 1, params: int = 2):
+    """ a device with one peripheral of getable & setable parameters 1..params """
+    device = models.Device.objects.create(
+        dev_id=dev_id, ip_address="192.0.2.1", api_port=8080, cmd_url="api",
+        mac_address="", name=f"device {dev_id}", num_peripherals=1, dev_type="test", sleep_state=0,
+    )
+    periph = models.Peripheral.objects.create(periph_id=1, device=device, name="peripheral 1", num_params=params)
+    for param_id in range(1, params + 1):
+        models.Parameter.objects.create(
+            param_id=param_id, peripheral=periph, name=f"param {param_id}",
+            max_value=100, is_getable=True, is_setable=True, units="",
+        )
+    return device
+
+
+##
+#   device registry cache
+#
+class RegistryTests(TestCase):
+
+    def setUp(self):
+        make_device()
+        registry.invalidate()
+        with quiet():
+            registry.load()
+
+    def test_lookups_share_parents(self):
+        param = registry.get_parameter("1", 1, 2)
+        self.assertEqual(param.param_id, 2)
+        self.assertIs(param.peripheral, registry.get_peripheral(1, 1))
+        self.assertIs(param.peripheral.device, registry.get_device(1))
+        self.assertIsNone(registry.get_parameter(1, 1, 9))
+        self.assertIsNone(registry.get_device("x"))
+
+    def test_save_invalidates(self):
+        generation = registry.generation
+        device = models.Device.objects.get(dev_id=1)
+        device.name = "renamed"
+        device.save()
+        self.assertTrue(registry.is_stale())
+        self.assertEqual(registry.generation, generation + 1)
+
+    def test_delete_invalidates(self):
+        models.Parameter.objects.filter(param_id=2).delete()
+        self.assertTrue(registry.is_stale())
+        with quiet():
+            registry.load()
+        self.assertIsNone(registry.get_parameter(1, 1, 2))
+
+    def test_volatile_save_refreshes_in_place(self):
+        generation = registry.generation
+        cached = registry.get_parameter(1, 1, 1)
+        param = models.Parameter.objects.get(pk=cached.pk)
+        param.last_value = 42
+        param.save(update_fields=["last_value"])
+        self.assertFalse(registry.is_stale())
+        self.assertEqual(registry.generation, generation)
+        self.assertIs(registry.get_parameter(1, 1, 1), cached)
+        self.assertEqual(cached.last_value, 42)
+
+    def test_other_field_save_invalidates(self):
+        param = models.Parameter.objects.get(param_id=1)
+        param.name = "renamed"
+        param.save(update_fields=["name"])
+        self.assertTrue(registry.is_stale())
+
+    def test_max_age_expires(self):
+        self.assertFalse(registry.is_stale())
+        registry.loaded_at -= REGISTRY_MAX_AGE + 1
+        self.assertTrue(registry.is_stale())
+
+
+##
+#   stream frame decoding
+#
+class FrameLayoutTests(SimpleTestCase):
+
+    def pack(self, layout, *frames):
+        return b"".join(struct.pack(layout.fmt_string, *f) + bytes([API_WEBSOCKET_DELIMITER_CHAR]) for f in frames)
+
+    def test_decode_frames(self):
+        layout = FrameLayout(["a", "b", "c"], [PARAMTYPE_UINT16, PARAMTYPE_FLOAT, PARAMTYPE_STRING])
+        self.assertEqual(layout.frame_size, 2 + 1 + 4 + 1 + 1 + 1)
+        ## a value equal to the delimiter char is still a value
+        data = self.pack(layout, (1, 0, 1.5, 0, b"x"), (API_WEBSOCKET_DELIMITER_CHAR, 0, -2.0, 0, b"y"))
+        frames = layout.decode(data)
+        self.assertEqual(len(frames), 2)
+        self.assertEqual(layout.columns(frames), [[1, API_WEBSOCKET_DELIMITER_CHAR], [1.5, -2.0], ["x", "y"]])
+        self.assertEqual(layout.to_dicts(frames)[1], {"a": API_WEBSOCKET_DELIMITER_CHAR, "b": -2.0, "c": "y"})
+
+    def test_bad_length(self):
+        layout = FrameLayout(["a"], [PARAMTYPE_UINT32])
+        with self.assertRaises(ValueError):
+            layout.decode(b"\x00" * (layout.frame_size + 1))
+        with self.assertRaises(ValueError):
+            layout.decode(b"")
+
+    def test_unstreamable_type(self):
+        with self.assertRaises(ValueError):
+            FrameLayout(["a"], [PARAMTYPE_INVALID])
+
+
+##
+#   stream sample ring buffer
+#
+class RingBufferTests(SimpleTestCase):
+
+    def test_wraps_in_time_order(self):
+        buf = SampleRingBuffer(5)
+        buf.extend([1, 2, 3], [10, 20, 30])
+        buf.extend([4, 5, 6, 7], [40, 50, 60, 70])
+        self.assertEqual(len(buf), 5)
+        times, values = buf.ordered()
+        self.assertEqual(times.tolist(), [3, 4, 5, 6, 7])
+        self.assertEqual(values.tolist(), [30, 40, 50, 60, 70])
+        self.assertEqual(buf.oldest(), 3)
+
+    def test_extend_larger_than_capacity(self):
+        buf = SampleRingBuffer(3)
+        buf.extend(range(10), range(100, 110))
+        self.assertEqual(buf.ordered()[1].tolist(), [107, 108, 109])
+
+    def test_window(self):
+        buf = SampleRingBuffer(10)
+        buf.extend([1, 2, 3, 4, 5], [1, 2, 3, 4, 5])
+        self.assertEqual(buf.window(since=3)[0].tolist(), [3, 4, 5])
+        self.assertEqual(buf.window(since=2, until=4)[1].tolist(), [2, 3, 4])
+        self.assertEqual(len(buf.window(since=10)[0]), 0)
+
+    def test_empty(self):
+        buf = SampleRingBuffer(4)
+        buf.extend([], [])
+        self.assertEqual(len(buf), 0)
+        self.assertIsNone(buf.oldest())
+
+
+##
+#   stream start backfill
+#
+class BackfillTests(SimpleTestCase):
+
+    def setUp(self):
+        self.stream = consumers.DeviceStream()
+
+    def test_default_and_clamped(self):
+        self.assertEqual(self.stream.parse_backfill({}), (False, None))
+        self.assertEqual(self.stream.parse_backfill({"backfill": "2.5"}), (False, 2.5))
+        limit = consumers.streaming_config()["BUFFER_SECONDS"]
+        self.assertEqual(self.stream.parse_backfill({"backfill": limit * 10}), (False, limit))
+
+    def test_invalid(self):
+        for backfill in ("abc", -1, "nan", "inf", [1]):
+            self.assertTrue(self.stream.parse_backfill({"backfill": backfill})[0], backfill)
+
+
+##
+#   decimation - min/max bucketing & lttb
+#
+class DecimationTests(SimpleTestCase):
+
+    def setUp(self):
+        self.times = np.arange(1000, dtype="f8")
+        self.values = np.sin(self.times / 50.0)
+        ## a single spike that any decimation worth having keeps
+        self.values[437] = 5.0
+
+    def test_minmax_keeps_peaks(self):
+        t, v = minmax_decimate(self.times, self.values, 100)
+        self.assertLessEqual(len(v), 100)
+        self.assertIn(5.0, v)
+        self.assertEqual(v.min(), self.values.min())
+        self.assertTrue(np.all(np.diff(t) > 0))
+
+    def test_minmax_short_input_unchanged(self):
+        t, v = minmax_decimate(self.times[:10], self.values[:10], 100)
+        self.assertEqual(len(v), 10)
+
+    def test_lttb_keeps_ends_and_count(self):
+        t, v = lttb_decimate(self.times, self.values, 50)
+        self.assertEqual(len(v), 50)
+        self.assertEqual(t[0], 0)
+        self.assertEqual(t[-1], 999)
+        self.assertIn(5.0, v)
+        self.assertTrue(np.all(np.diff(t) > 0))
+
+    def test_lttb_small_outputs(self):
+        self.assertEqual(lttb_decimate(self.times, self.values, 2)[0].tolist(), [0, 999])
+        self.assertEqual(len(lttb_decimate(self.times, self.values, 5000)[0]), 1000)
+
+    def test_stream_decimator(self):
+        decimator = StreamDecimator(DECIMATION_LTTB, 10)
+        self.assertIsNone(decimator.flush(1.0))
+        decimator.add(["a", "s"], self.times.tolist(), [self.values.tolist(), ["x"] * 1000])
+        series = decimator.flush(1.0)
+        self.assertEqual(len(series["a"]["v"]), 10)
+        ## string columns only keep their latest sample
+        self.assertEqual(series["s"], {"t": [999.0], "v": ["x"]})
+        self.assertIsNone(decimator.flush(1.0))
+
+    def test_stream_decimator_minimum_points(self):
+        decimator = StreamDecimator(DECIMATION_MINMAX, 0.1)
+        self.assertEqual(decimator.points_for(1.0), 2)
+
+
+##
+#   binary subscriber protocol
+#
+class BinaryEncoderTests(SimpleTestCase):
+
+    def test_round_trip(self):
+        times = [100.0, 100.05, 100.1]
+        columns = [[1, -2, 3], [0.5, 1.5, 2.5], ["a", "b", ""]]
+        t, cols = decode_binary_frame(encode_binary_frame(times, columns))
+        self.assertTrue(np.allclose(t, times))
+        self.assertEqual(cols[0].tolist(), [1, -2, 3])
+        self.assertEqual(cols[1].tolist(), [0.5, 1.5, 2.5])
+        self.assertEqual(cols[2].tolist(), [97, 98, 0])
+
+    def test_column_types(self):
+        self.assertEqual(encode_column([1, 2])[0], BINARY_COL_INT32)
+        self.assertEqual(encode_column([1.0, 2])[0], BINARY_COL_FLOAT32)
+
+    def test_bad_magic(self):
+        frame = bytearray(encode_binary_frame([1.0], [[1]]))
+        frame[0:2] = b"XX"
+        with self.assertRaises(ValueError):
+            decode_binary_frame(bytes(frame))
+
+    def test_coalescer(self):
+        coalescer = FrameCoalescer()
+        self.assertIsNone(coalescer.flush())
+        coalescer.add(["a"], [1.0], [[1]])
+        coalescer.add(["a"], [1.1, 1.2], [[2, 3]])
+        t, cols = decode_binary_frame(coalescer.flush())
+        self.assertEqual(cols[0].tolist(), [1, 2, 3])
+        self.assertIsNone(coalescer.flush())
+
+    def test_uint32_columns(self):
+        self.assertEqual(encode_column([2**31])[0], BINARY_COL_UINT32)
+        ## too big for either - sent as a float rather than wrapped
+        self.assertEqual(encode_column([-1, 2**32])[0], BINARY_COL_FLOAT32)
+        t, cols = decode_binary_frame(encode_binary_frame([1.0, 2.0, 3.0], [[2**31, 2**32 - 1, 0]]))
+        self.assertEqual(cols[0].tolist(), [2**31, 2**32 - 1, 0])
+
+
+##
+#   parameter value write behind
+#
+class WriteBehindTests(TestCase):
+
+    def setUp(self):
+        make_device()
+        self.param = models.Parameter.objects.get(param_id=1)
+        self.buffer = ParameterWriteBehind()
+
+    def tearDown(self):
+        write_behind.dirty = {}
+
+    def set_value(self, buffer, value):
+        self.param.last_value = value
+        buffer.record(self.param)
+
+    def test_flush_coalesces_writes(self):
+        for value in (1, 2, 3):
+            self.set_value(self.buffer, value)
+        self.assertEqual(len(self.buffer.dirty), 1)
+        with quiet():
+            self.assertEqual(self.buffer.flush(), 1)
+            self.assertEqual(self.buffer.flush(), 0)
+        self.assertEqual(models.Parameter.objects.get(pk=self.param.pk).last_value, 3)
+
+    def test_requeued_on_database_error(self):
+        def locked(*args, **kwargs):
+            ## a newer value recorded while the write fails wins over the requeued one
+            self.set_value(self.buffer, 6)
+            raise DatabaseError("database is locked")
+
+        self.set_value(self.buffer, 5)
+        with quiet(), mock.patch.object(models.Parameter.objects, "bulk_update", side_effect=locked):
+            self.assertEqual(self.buffer.flush(), 0)
+        self.assertEqual(self.buffer.dirty, {self.param.pk: (6, "")})
+        with quiet():
+            self.assertEqual(self.buffer.flush(), 1)
+        self.assertEqual(models.Parameter.objects.get(pk=self.param.pk).last_value, 6)
+
+    def test_registry_load_applies_pending(self):
+        self.set_value(write_behind, 9)
+        registry.invalidate()
+        with quiet():
+            registry.load()
+        self.assertEqual(registry.get_parameter(1, 1, 1).last_value, 9)
+        self.assertEqual(models.Parameter.objects.get(pk=self.param.pk).last_value, 0)
+
+
+##
+#   parameter history & rollups
+#
+class HistoryTests(TestCase):
+
+    def setUp(self):
+        make_device()
+        self.param = models.Parameter.objects.get(param_id=1)
+        self.recorder = HistoryRecorder()
+        ## no retention pass during the tests
+        self.recorder.last_prune = time.time()
+        ## recent enough for the raw samples to be kept, on an hour boundary
+        self.base = math.floor(time.time() / 3600) * 3600.0 - 86400
+
+    def rollups(self, period):
+        return list(models.ParameterRollup.objects
+            .filter(parameter=self.param, period=period)
+            .order_by("start")
+            .values_list("start", "count", "min_value", "max_value", "sum_value"))
+
+    def test_flushes_merge_into_rollups(self):
+        base = self.base
+        self.recorder.record_many(self.param.pk, [base + 1, base + 2, base + 61], [1.0, 5.0, 2.0])
+        with quiet():
+            self.assertEqual(self.recorder.flush(), 3)
+        ## a later flush merges into the rows already written
+        self.recorder.record(self.param.pk, base + 30, -1.0)
+        with quiet():
+            self.assertEqual(self.recorder.flush(), 1)
+        self.assertEqual(models.ParameterSample.objects.filter(parameter=self.param).count(), 4)
+        self.assertEqual(self.rollups(60), [(base, 3, -1.0, 5.0, 5.0), (base + 60, 1, 2.0, 2.0, 2.0)])
+        self.assertEqual(self.rollups(3600), [(base, 4, -1.0, 5.0, 7.0)])
+
+    def test_concurrent_rollup_insert_retried(self):
+        base = self.base
+        ## another process wrote the minute row after this flush read the rollups
+        models.ParameterRollup.objects.create(parameter=self.param, period=60, start=base,
+                                              count=2, min_value=0.0, max_value=3.0, sum_value=3.0)
+        reads = []
+        existing_rollups = self.recorder.existing_rollups
+
+        def stale_first(new, period):
+            reads.append(period)
+            if len(reads) == 1:
+                return models.ParameterRollup.objects.none()
+            return existing_rollups(new, period)
+
+        self.recorder.record_many(self.param.pk, [base + 1, base + 2], [1.0, 5.0])
+        with quiet(), mock.patch.object(self.recorder, "existing_rollups", side_effect=stale_first):
+            self.assertEqual(self.recorder.flush(), 2)
+        self.assertEqual(reads, [60, 60, 3600])
+        self.assertEqual(self.rollups(60), [(base, 4, 0.0, 5.0, 9.0)])
+        self.assertEqual(self.rollups(3600), [(base, 2, 1.0, 5.0, 6.0)])
+        self.assertEqual(models.ParameterSample.objects.filter(parameter=self.param).count(), 2)
+
+    def test_select_tier(self):
+        now = self.base + 86400
+        self.assertIsNone(select_tier(now - 600, now, 500, now=now))
+        ## the coarsest tier no wider than the resolution asked for
+        self.assertEqual(select_tier(now - 86400, now, 500, now=now), 60)
+        self.assertEqual(select_tier(now - 30 * 86400, now, 500, now=now), 3600)
+        ## raw samples this old have been pruned
+        start = now - 3 * 86400
+        self.assertEqual(select_tier(start, start + 600, 500, now=now), 60)
+
+    def test_query_history_tiers(self):
+        times = self.base + np.arange(0, 86400, 10.0)
+        values = np.arange(len(times)) % 7
+        self.recorder.record_many(self.param.pk, times, values)
+        with quiet():
+            self.recorder.flush()
+
+        raw = query_history(self.param, self.base, self.base + 600, max_points=500)
+        self.assertEqual((raw["tier"], raw["source"]), ("raw", "raw"))
+        self.assertEqual(raw["t"], times[:61].tolist())
+
+        ## 1440 minute rollups merged down to the points asked for
+        rollup = query_history(self.param, self.base, self.base + 86400, max_points=100)
+        self.assertEqual((rollup["tier"], rollup["source"]), (60, "rollup"))
+        self.assertEqual(len(rollup["t"]), 96)
+        self.assertEqual(rollup["t"][0], self.base)
+        self.assertEqual((min(rollup["min"]), max(rollup["max"])), (0, 6))
+        self.assertAlmostEqual(np.mean(rollup["v"]), np.mean(values), places=1)
+
+    def test_failed_flush_requeues(self):
+        self.recorder.record(self.param.pk, self.base, 1.0)
+        with quiet(), mock.patch.object(models.ParameterSample.objects, "bulk_create", side_effect=DatabaseError("database is locked")):
+            self.assertEqual(self.recorder.flush(), 0)
+        ## requeued samples go ahead of ones recorded since
+        self.recorder.record(self.param.pk, self.base + 1, 2.0)
+        self.assertEqual(self.recorder.pending[self.param.pk], ([self.base, self.base + 1], [1.0, 2.0]))
+        with quiet():
+            self.assertEqual(self.recorder.flush(), 2)
+
+    def test_deleted_parameter_samples_dropped(self):
+        self.recorder.record(self.param.pk, self.base, 1.0)
+        self.recorder.record(self.param.pk + 1000, self.base, 1.0)
+        with quiet():
+            self.assertEqual(self.recorder.flush(), 1)
+        self.assertEqual(models.ParameterSample.objects.count(), 1)
+
+
+##
+#   background parameter polling schedule
+#
+class PollerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.poller = ParameterPoller()
+        self.poller.config = dict(polling_config(), JITTER=0.1, BACKOFF_MAX=600, TICK=1.0)
+        self.device = models.Device(dev_id=1, ip_address="192.0.2.1", api_port=8080, cmd_url="api")
+        self.responses = []
+
+    def param(self, param_id, poll_interval=10, periph_type=0, is_getable=True):
+        periph = models.Peripheral(periph_id=1, device=self.device, periph_type=periph_type)
+        return models.Parameter(param_id=param_id, peripheral=periph, poll_interval=poll_interval, is_getable=is_getable)
+
+    async def send_command(self, rq, url, dev_id, max_age=None):
+        return self.responses.pop(0)
+
+    def test_intervals(self):
+        self.assertEqual(self.poller.interval_for(self.param(1, poll_interval=5)), 5)
+        self.assertEqual(self.poller.interval_for(self.param(1, poll_interval=0, periph_type=PTYPE_DISTANCE_SENSOR)), 15)
+        self.assertEqual(self.poller.interval_for(self.param(1, poll_interval=0)), self.poller.config["DEFAULT_INTERVAL"])
+
+    def test_jitter_and_backoff(self):
+        for _ in range(100):
+            self.assertTrue(9 <= self.poller.jittered(10) <= 11)
+        self.assertEqual(self.poller.backoff(10, 0), 10)
+        self.assertEqual(self.poller.backoff(10, 3), 80)
+        self.assertEqual(self.poller.backoff(10, 10), 600)
+
+    def test_rebuild_spreads_first_polls_and_keeps_due_times(self):
+        params = [self.param(i) for i in range(1, 21)] + [self.param(21, is_getable=False), self.param(22, poll_interval=-1)]
+        with mock.patch.object(registry, "all_parameters", return_value=params):
+            with quiet():
+                self.poller.rebuild(1000.0)
+            self.assertEqual(len(self.poller.schedule), 20)
+            self.assertEqual(self.poller.schedule[0], min(self.poller.schedule))
+            self.assertTrue(all(1000.0 <= t <= 1010.0 for t, _ in self.poller.schedule))
+
+            due = dict((key, t) for t, key in self.poller.schedule)
+            del params[0]
+            with quiet():
+                self.poller.rebuild(2000.0)
+        self.assertEqual(dict((key, t) for t, key in self.poller.schedule), {k: t for k, t in due.items() if k != (1, 1, 1)})
+
+    async def test_dispatch_defers_backed_off_devices(self):
+        polled = []
+
+        async def poll(key):
+            polled.append(key)
+
+        self.poller.poll = poll
+        self.poller.intervals = {(1, 1, 1): 10, (2, 1, 1): 10, (1, 1, 2): 10}
+        self.poller.schedule = [(99.0, (1, 1, 1)), (99.5, (2, 1, 1)), (105.0, (1, 1, 2))]
+        self.poller.device_retry_at[2] = 130.0
+        self.assertEqual(self.poller.dispatch(100.0), 1.0)
+        await asyncio.gather(*self.poller.tasks)
+        self.assertEqual(polled, [(1, 1, 1)])
+        self.assertEqual(self.poller.in_flight, {(1, 1, 1)})
+        deferred = dict((key, t) for t, key in self.poller.schedule)
+        self.assertTrue(130.0 <= deferred[(2, 1, 1)] <= 131.0)
+        self.assertEqual(deferred[(1, 1, 2)], 105.0)
+
+    async def test_poll_backs_off_and_recovers(self):
+        key = (1, 1, 1)
+        self.poller.intervals = {key: 10}
+        self.poller.semaphore = asyncio.Semaphore(1)
+        self.responses = [
+            {"rsp_type": RSP_TYPE_ERR, "err_code": ERR_CODE_INVALID_PARAM_ID},
+            {"rsp_type": RSP_TYPE_ERR, "err_code": ERR_CODE_INVALID_PARAM_ID},
+            {"rsp_type": RSP_TYPE_ERR, "err_code": ERR_CODE_HTTP_TIMEOUT},
+            {"rsp_type": RSP_TYPE_OK, "data": 1},
+        ]
+
+        def next_poll():
+            t, k = self.poller.schedule.pop()
+            self.assertEqual(k, key)
+            return t - time.monotonic()
+
+        with quiet(), mock.patch("CommandControl.poller.send_command", self.send_command), \
+             mock.patch.object(registry, "get_device", return_value=self.device):
+            ## device errors back the parameter off exponentially
+            await self.poller.poll(key)
+            self.assertTrue(18 <= next_poll() <= 22)
+            await self.poller.poll(key)
+            self.assertTrue(36 <= next_poll() <= 44)
+            self.assertEqual(self.poller.failures[key], 2)
+
+            ## an unreachable device backs the whole device off
+            await self.poller.poll(key)
+            next_poll()
+            self.assertEqual(self.poller.device_failures[1], 1)
+            self.assertTrue(9 <= self.poller.device_retry_at[1] - time.monotonic() <= 11)
+
+            await self.poller.poll(key)
+            self.assertTrue(8 <= next_poll() <= 11)
+        self.assertEqual((self.poller.failures, self.poller.device_failures, self.poller.device_retry_at), ({}, {}, {}))
+        self.assertEqual(self.poller.polled_devices, {1})
+
+
+    async def start_and_stop(self, layer):
+        """ run the poller until it loads the registry - returns (lock, held while running) """
+        loaded = asyncio.Event()
+
+        async def ensure_loaded():
+            loaded.set()
+            await asyncio.sleep(60)
+
+        with quiet(), mock.patch("CommandControl.poller.get_channel_layer", return_value=layer), \
+             mock.patch.object(registry, "ensure_loaded", ensure_loaded):
+            self.poller.start()
+            try:
+                await asyncio.wait_for(loaded.wait(), 2)
+            finally:
+                lock = self.poller.lock
+                held = lock is not None and lock.held
+                await self.poller.stop()
+        return lock, held
+
+    async def test_lock_only_with_shared_workers(self):
+        ## a single worker always polls
+        lock, held = await self.start_and_stop(InMemoryChannelLayer())
+        self.assertIsNone(lock)
+
+        with tempfile.TemporaryDirectory() as lock_dir, override_settings(WORKERS={"LOCK_DIR": lock_dir}):
+            lock, held = await self.start_and_stop(UnixSocketChannelLayer(path=os.path.join(lock_dir, "layer.sock")))
+            self.assertTrue(held)
+            self.assertFalse(lock.held)
+
+
+##
+#   device health circuit breaker
+#
+class HealthTrackerTests(SimpleTestCase):
+
+    url = "http://192.0.2.1:8080/api"
+
+    def setUp(self):
+        self.tracker = HealthTracker()
+        self.health = self.tracker.get(health_key(self.url))
+
+    def open_breaker(self):
+        with quiet():
+            for _ in range(HEALTH_DOWN_AFTER):
+                self.tracker.record(self.url, ERR_CODE_HTTP_TIMEOUT)
+
+    def pass_open_time(self):
+        self.health.opened_at -= self.health.open_for + 1
+
+    def test_health_key(self):
+        self.assertEqual(health_key(self.url), ("192.0.2.1", 8080))
+        self.assertEqual(health_key("ws://192.0.2.1:8080/stream"), ("192.0.2.1", 8080))
+        self.assertEqual(health_key("http://192.0.2.1/api"), ("192.0.2.1", 80))
+
+    def test_up_degraded_down(self):
+        self.assertEqual(self.health.state, HEALTH_UNKNOWN)
+        self.tracker.record(self.url, HTTP_RSP_AQUIRED)
+        self.assertEqual(self.health.state, HEALTH_UP)
+        self.tracker.record(self.url, ERR_CODE_DEVICE_UNREACHABLE)
+        self.assertEqual(self.health.state, HEALTH_DEGRADED)
+        self.assertEqual(self.tracker.allow(self.url), (True, None))
+        with quiet():
+            self.tracker.record(self.url, ERR_CODE_HTTP_TIMEOUT)
+            self.tracker.record(self.url, ERR_CODE_HTTP_TIMEOUT)
+        self.assertEqual(self.health.state, HEALTH_DOWN)
+        self.assertEqual(self.tracker.allow(self.url), (False, None))
+        self.assertTrue(self.tracker.is_down(self.url))
+
+    def test_device_errors_are_not_failures(self):
+        ## the device answered, so it is up
+        self.tracker.record(self.url, ERR_CODE_INVALID_RSP_JSON)
+        self.assertEqual(self.health.state, HEALTH_UP)
+
+    def test_probe_success_closes(self):
+        self.open_breaker()
+        self.pass_open_time()
+        self.assertFalse(self.tracker.is_down(self.url))
+        allowed, timeout = self.tracker.allow(self.url)
+        self.assertTrue(allowed)
+        self.assertIsNotNone(timeout)
+        self.assertEqual(self.health.state, HEALTH_HALF_OPEN)
+        ## one probe at a time
+        self.assertEqual(self.tracker.allow(self.url), (False, None))
+        self.tracker.record(self.url, HTTP_RSP_AQUIRED)
+        self.assertEqual(self.health.state, HEALTH_UP)
+        self.assertEqual(self.tracker.allow(self.url), (True, None))
+
+    def test_probe_failure_backs_off(self):
+        self.open_breaker()
+        self.pass_open_time()
+        self.tracker.allow(self.url)
+        with quiet():
+            self.tracker.record(self.url, ERR_CODE_HTTP_TIMEOUT)
+        self.assertEqual(self.health.state, HEALTH_DOWN)
+        self.assertEqual(self.health.open_for, HEALTH_OPEN_SECONDS * 2)
+
+    def test_probe_lease_expires(self):
+        self.open_breaker()
+        self.pass_open_time()
+        self.tracker.allow(self.url)
+        ## the probe never reports back
+        self.health.probe_deadline = time.monotonic() - 1
+        with quiet():
+            self.assertEqual(self.tracker.allow(self.url), (False, None))
+        self.assertEqual(self.health.state, HEALTH_DOWN)
+        self.assertEqual(self.health.open_for, HEALTH_OPEN_SECONDS * 2)
+
+
+    def test_released_probe_is_not_a_failure(self):
+        self.open_breaker()
+        self.pass_open_time()
+        self.tracker.allow(self.url)
+        self.tracker.release_probe(self.url)
+        self.assertEqual(self.health.state, HEALTH_DOWN)
+        self.assertEqual((self.health.failures, self.health.open_for), (HEALTH_DOWN_AFTER, HEALTH_OPEN_SECONDS))
+        ## the next request is the probe
+        allowed, timeout = self.tracker.allow(self.url)
+        self.assertTrue(allowed)
+        self.assertIsNotNone(timeout)
+
+
+##
+#   cancelled device requests
+#
+class CancelledRequestTests(SimpleTestCase):
+
+    def setUp(self):
+        device_health.devices = {}
+
+    def tearDown(self):
+        device_health.devices = {}
+
+    async def hanging_device(self):
+        """ a server which accepts requests & never answers - returns (server, url) """
+        async def hang(reader, writer):
+            try:
+                await asyncio.sleep(60)
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(hang, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        return server, assemble_url("127.0.0.1", port, "api")
+
+    async def cancel_request(self, url):
+        client = DeviceClient()
+        task = asyncio.ensure_future(client.send_json(url, {"cmd_type": CMD_TYPE_INFO}))
+        try:
+            await asyncio.sleep(0.2)
+            self.assertFalse(task.done())
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        finally:
+            await client.close()
+
+    async def test_cancelled_probe_is_released(self):
+        server, url = await self.hanging_device()
+        health = device_health.get(health_key(url))
+        try:
+            with quiet():
+                for _ in range(HEALTH_DOWN_AFTER):
+                    device_health.record(url, ERR_CODE_HTTP_TIMEOUT)
+            health.opened_at -= health.open_for + 1
+            await self.cancel_request(url)
+        finally:
+            server.close()
+            await server.wait_closed()
+
+        ## back to down without the open time doubling - the next request probes again
+        self.assertEqual(health.state, HEALTH_DOWN)
+        self.assertEqual((health.failures, health.open_for), (HEALTH_DOWN_AFTER, HEALTH_OPEN_SECONDS))
+        self.assertTrue(device_health.allow(url)[0])
+        self.assertEqual(health.state, HEALTH_HALF_OPEN)
+
+    async def test_cancelled_request_records_nothing(self):
+        server, url = await self.hanging_device()
+        device_health.record(url, HTTP_RSP_AQUIRED)
+        try:
+            await self.cancel_request(url)
+        finally:
+            server.close()
+            await server.wait_closed()
+
+        health = device_health.get(health_key(url))
+        self.assertEqual((health.state, health.failures), (HEALTH_UP, 0))
+
+
+##
+#   coalescing of identical requests in flight
+#
+class CoalescingTests(SimpleTestCase):
+
+    url = "http://192.0.2.1:8080/api"
+    get = {"cmd_type": CMD_TYPE_GET, "periph_id": 1, "param_id": 1}
+
+    def setUp(self):
+        self.device_client = DeviceClient()
+        self.device_client.send_json = self.send_json
+        self.sent = []
+
+    async def send_json(self, url, data, timeout=None, tracked=True):
+        self.sent.append(data)
+        await asyncio.sleep(0.05)
+        return HTTP_RSP_AQUIRED, {"rsp_type": RSP_TYPE_OK, "data": len(self.sent)}
+
+    async def test_identical_gets_share_a_request(self):
+        try:
+            results = await asyncio.gather(*[self.device_client.post_json(self.url, dict(self.get)) for _ in range(3)])
+        finally:
+            await self.device_client.close()
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual([r[1]["data"] for r in results], [1, 1, 1])
+        ## every caller gets its own copy of the response
+        results[0][1]["data"] = 0
+        self.assertEqual(results[1][1]["data"], 1)
+        self.assertEqual(self.device_client.in_flight, {})
+
+    async def test_sets_are_not_shared(self):
+        rq = {"cmd_type": CMD_TYPE_SET, "periph_id": 1, "param_id": 1, "data": 1}
+        try:
+            await asyncio.gather(*[self.device_client.post_json(self.url, dict(rq)) for _ in range(2)])
+        finally:
+            await self.device_client.close()
+        self.assertEqual(len(self.sent), 2)
+
+    async def test_get_after_set_not_shared(self):
+        set_rq = {"cmd_type": CMD_TYPE_SET, "periph_id": 1, "param_id": 1, "data": 1}
+        try:
+            first = asyncio.ensure_future(self.device_client.post_json(self.url, dict(self.get)))
+            await asyncio.sleep(0.01)
+            write = asyncio.ensure_future(self.device_client.post_json(self.url, dict(set_rq)))
+            await asyncio.sleep(0.01)
+            ## sent after the SET, so it can't share the GET sent before it
+            second = await self.device_client.post_json(self.url, dict(self.get))
+            await asyncio.gather(first, write)
+        finally:
+            await self.device_client.close()
+        self.assertEqual([rq["cmd_type"] for rq in self.sent], [CMD_TYPE_GET, CMD_TYPE_SET, CMD_TYPE_GET])
+        self.assertEqual(second[1]["data"], 3)
+
+    async def test_cancelled_caller_leaves_the_others(self):
+        try:
+            first = asyncio.ensure_future(self.device_client.post_json(self.url, dict(self.get)))
+            second = asyncio.ensure_future(self.device_client.post_json(self.url, dict(self.get)))
+            await asyncio.sleep(0.01)
+            first.cancel()
+            result, response = await second
+        finally:
+            await self.device_client.close()
+        self.assertEqual((result, response["data"]), (HTTP_RSP_AQUIRED, 1))
+        self.assertTrue(first.cancelled())
+
+
+##
+#   parameter GET cache
+#
+class GetCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = GetCache(dict(get_cache_config(), MAX_ENTRIES=2))
+
+    def test_fresh_and_stale(self):
+        self.cache.put((1, 1, 1), {"data": 5})
+        self.assertEqual(self.cache.get((1, 1, 1), ttl=10), {"data": 5})
+        self.assertIsNone(self.cache.get((1, 1, 1), ttl=10, max_age=0))
+        self.cache.entries[(1, 1, 1)] = (time.monotonic() - 20, {"data": 5})
+        self.assertIsNone(self.cache.get((1, 1, 1), ttl=10))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 2))
+
+    def test_returns_copies(self):
+        self.cache.put((1, 1, 1), {"data": 5})
+        self.cache.get((1, 1, 1), ttl=10)["data"] = 6
+        self.assertEqual(self.cache.get((1, 1, 1), ttl=10), {"data": 5})
+
+    def test_lru_eviction(self):
+        self.cache.put((1, 1, 1), {})
+        self.cache.put((1, 1, 2), {})
+        self.cache.get((1, 1, 1), ttl=10)
+        self.cache.put((1, 1, 3), {})
+        self.assertEqual(list(self.cache.entries), [(1, 1, 1), (1, 1, 3)])
+
+    def test_put_after_write_skipped(self):
+        generation = self.cache.generation((1, 1, 1))
+        self.cache.invalidate((1, 1, 1))
+        ## the GET started before the SET - its result may be the old value
+        self.assertFalse(self.cache.put((1, 1, 1), {"data": 5}, generation))
+        self.assertIsNone(self.cache.get((1, 1, 1), ttl=10))
+        self.assertTrue(self.cache.put((1, 1, 1), {"data": 6}, self.cache.generation((1, 1, 1))))
+
+    def test_request_helpers(self):
+        self.assertEqual(request_max_age({"max_age": "2.5"}), 2.5)
+        self.assertIsNone(request_max_age({"max_age": -1}))
+        self.assertIsNone(request_max_age({}))
+        self.assertEqual(get_cache_key("1", 2, 3), (1, 2, 3))
+        self.assertIsNone(get_cache_key(None, 2, 3))
+
+
+##
+#   scenes
+#
+class SceneTests(TransactionTestCase):
+
+    def setUp(self):
+        make_device()
+        self.scene = models.Scene.objects.create(name="evening")
+        self.param = models.Parameter.objects.get(param_id=1)
+        self.url = assemble_url("192.0.2.1", 8080, "api")
+        self.sent = []
+        registry.invalidate()
+        device_health.devices = {}
+
+    async def send_command(self, rq, url, dev_id, max_age=None):
+        self.sent.append(rq)
+        return {"rsp_type": RSP_TYPE_OK}
+
+    async def apply(self, *args, **kwargs):
+        with quiet(), mock.patch.object(consumers, "send_command", self.send_command):
+            try:
+                return await apply_scene(*args, **kwargs)
+            finally:
+                await close_write_behind()
+                await close_history()
+
+    def add_target(self, param, **values):
+        models.SceneTarget.objects.create(scene=self.scene, parameter=param, **values)
+
+    def set_last_value(self, **values):
+        models.Parameter.objects.filter(pk=self.param.pk).update(**values)
+
+    async def test_applies_value(self):
+        await database_sync_to_async(self.add_target)(self.param, value=7)
+        report = await self.apply(self.scene.pk)
+        self.assertEqual((report["count"], report["applied"]), (1, 1))
+        self.assertEqual([rq["data"] for rq in self.sent], [7])
+        self.assertEqual(registry.get_parameter(1, 1, 1).last_value, 7)
+
+    async def test_current_value_skipped(self):
+        await database_sync_to_async(self.add_target)(self.param, value=7)
+        await database_sync_to_async(self.set_last_value)(last_value=7)
+        device_health.record(self.url, HTTP_RSP_AQUIRED)
+        report = await self.apply(self.scene.pk)
+        self.assertEqual((report["applied"], report["skipped"]), (0, 1))
+        self.assertEqual(self.sent, [])
+
+        ## unless forced
+        report = await self.apply(self.scene.pk, force=True)
+        self.assertEqual(report["applied"], 1)
+
+    async def test_current_value_resent_to_device_not_up(self):
+        ## a device which hasn't been heard from may have reset
+        await database_sync_to_async(self.add_target)(self.param, value=7)
+        await database_sync_to_async(self.set_last_value)(last_value=7)
+        report = await self.apply(self.scene.pk)
+        self.assertEqual(report["applied"], 1)
+
+    async def test_out_of_range_fails(self):
+        await database_sync_to_async(self.add_target)(self.param, value=101)
+        report = await self.apply(self.scene.pk)
+        self.assertEqual(report["failed"], 1)
+        self.assertEqual(report["targets"][0]["err_code"], ERR_CODE_INVALID_DATA_VALUE)
+        self.assertEqual(self.sent, [])
+
+    async def test_unknown_scene(self):
+        self.assertIsNone(await self.apply(self.scene.pk + 1))
+
+    def typed_param(self, param_id, data_type):
+        periph = models.Peripheral.objects.get(periph_id=1)
+        return models.Parameter.objects.create(
+            param_id=param_id, peripheral=periph, name=f"param {param_id}",
+            data_type=data_type, is_getable=True, is_setable=True, units="",
+        )
+
+    async def test_string_value(self):
+        param = await database_sync_to_async(self.typed_param)(3, PARAMTYPE_STRING)
+        await database_sync_to_async(self.add_target)(param, value_string="warm")
+        report = await self.apply(self.scene.pk)
+        self.assertEqual(report["applied"], 1)
+        self.assertEqual([rq["data"] for rq in self.sent], ["warm"])
+        self.assertEqual(registry.get_parameter(1, 1, 3).last_value_string, "warm")
+
+        ## compared with last_value_string when deduping
+        device_health.record(self.url, HTTP_RSP_AQUIRED)
+        report = await self.apply(self.scene.pk)
+        self.assertEqual(report["skipped"], 1)
+
+    async def test_float_values(self):
+        good = await database_sync_to_async(self.typed_param)(3, PARAMTYPE_FLOAT)
+        bad = await database_sync_to_async(self.typed_param)(4, PARAMTYPE_FLOAT)
+        await database_sync_to_async(self.add_target)(good, value_string="2.5")
+        await database_sync_to_async(self.add_target)(bad, value_string="warm")
+        report = await self.apply(self.scene.pk)
+        self.assertEqual((report["applied"], report["failed"]), (1, 1))
+        self.assertEqual([rq["data"] for rq in self.sent], [2.5])
+        failed = [t for t in report["targets"] if t["status"] == "failed"]
+        self.assertEqual((failed[0]["value"], failed[0]["err_code"]), ("warm", ERR_CODE_INVALID_DATA_VALUE))
+
+    async def test_lookup_by_name(self):
+        await database_sync_to_async(self.add_target)(self.param, value=7)
+        self.assertEqual((await self.apply(name="evening"))["scene"], "evening")
+        ## a numeric name is still a name
+        self.assertIsNone(await self.apply(name=str(self.scene.pk)))
+
+
+##
+#   unix socket channel layer
+#
+class ChannelLayerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "layer.sock")
+        self.layers = []
+        self.settings = override_settings(WORKERS={"LOCK_DIR": self.dir.name})
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.dir.cleanup()
+
+    async def close_layers(self):
+        for layer in reversed(self.layers):
+            await layer.close()
+
+    async def layer(self):
+        """ a layer connected to the hub - each one stands in for a worker process """
+        layer = UnixSocketChannelLayer(path=self.path)
+        self.layers.append(layer)
+        await layer.connection()
+
+        ## messages for a worker the hub hasn't heard from yet are dropped
+        async def registered():
+            return any(l.hub is not None and layer.proc_id in l.hub.writers for l in self.layers)
+        await self.eventually(registered)
+        return layer
+
+    async def eventually(self, check, timeout=2.0):
+        deadline = time.monotonic() + timeout
+        while not await check():
+            self.assertLess(time.monotonic(), deadline, "timed out")
+            await asyncio.sleep(0.01)
+
+    async def test_send_between_workers(self):
+        try:
+            with quiet():
+                first = await self.layer()
+                second = await self.layer()
+                channel = await second.new_channel()
+                await first.send(channel, {"type": "test.message", "data": b"\x00\xff"})
+                message = await asyncio.wait_for(second.receive(channel), 2)
+            self.assertIsNotNone(first.hub)
+            self.assertIsNone(second.hub)
+        finally:
+            await self.close_layers()
+        self.assertEqual(message, {"type": "test.message", "data": b"\x00\xff"})
+
+    async def test_group_send_and_size(self):
+        try:
+            with quiet():
+                first = await self.layer()
+                second = await self.layer()
+                channels = [await first.new_channel(), await second.new_channel()]
+                await first.group_add("g", channels[0])
+                await second.group_add("g", channels[1])
+
+                async def both_members():
+                    return await group_size(second, "g") == 2
+                await self.eventually(both_members)
+
+                await first.group_send("g", {"type": "test.group"})
+                received = [
+                    await asyncio.wait_for(first.receive(channels[0]), 2),
+                    await asyncio.wait_for(second.receive(channels[1]), 2),
+                ]
+                await first.group_discard("g", channels[0])
+
+                async def one_member():
+                    return await group_size(second, "g") == 1
+                await self.eventually(one_member)
+        finally:
+            await self.close_layers()
+        self.assertEqual(received, [{"type": "test.group"}] * 2)
+
+    async def test_group_size_of_local_layers(self):
+        layer = InMemoryChannelLayer()
+        await layer.group_add("g", "test.channel")
+        self.assertEqual(await group_size(layer, "g"), 1)
+
+    async def test_hub_handover(self):
+        try:
+            with quiet():
+                first = await self.layer()
+                second = await self.layer()
+                await first.close()
+
+                async def second_is_hub():
+                    return second.hub is not None and second.writer is not None
+                await self.eventually(second_is_hub)
+
+                third = await self.layer()
+                channel = await second.new_channel()
+                await third.send(channel, {"type": "test.message"})
+                message = await asyncio.wait_for(second.receive(channel), 2)
+        finally:
+            await self.close_layers()
+        self.assertEqual(message, {"type": "test.message"})
+
+    async def test_hub_close_drops_every_connection(self):
+        try:
+            with quiet():
+                first = await self.layer()
+                hub = first.hub
+                ## a worker which hasn't said hello yet
+                reader, writer = await asyncio.open_unix_connection(self.path)
+
+                async def accepted():
+                    return len(hub.connections) == len(hub.writers) + 1
+                await self.eventually(accepted)
+                await hub.close()
+                self.assertEqual(await asyncio.wait_for(reader.read(), 2), b"")
+                writer.close()
+        finally:
+            await self.close_layers()
+
+    def test_shares_workers(self):
+        self.assertTrue(shares_workers(UnixSocketChannelLayer(path=self.path)))
+        self.assertFalse(shares_workers(InMemoryChannelLayer()))
+
+
+##
+#   the command websocket against a simulated device
+#
+class SimulatedDeviceTests(TransactionTestCase):
+
+    def setUp(self):
+        self.device = SimDevice(1, TEST_SIM_PORT, latency=0.0, jitter=0.0)
+        self.device.populate()
+        reset_state()
+
+    async def command(self, communicator, data: dict):
+        await communicator.send_json_to(data)
+        return await communicator.receive_json_from(timeout=5)
+
+    async def test_get_cache_serves_repeat_gets(self):
+        await self.device.start()
+        communicator = WebsocketCommunicator(consumers.CommandConsumer.as_asgi(), "/ws/CC/")
+        try:
+            with quiet():
+                await communicator.connect()
+                get = {"cmd_type": "GET", "dev_id": 1, "periph_id": 1, "param_id": 1}
+                first = await self.command(communicator, get)
+                second = await self.command(communicator, get)
+                self.assertEqual(first["data"], self.device.params[1][1].value)
+                self.assertEqual(second, first)
+                self.assertEqual(self.device.requests[CMD_TYPE_GET], 1)
+
+                ## a SET drops the cached value
+                await self.command(communicator, {"cmd_type": "SET", "dev_id": 1, "periph_id": 1, "param_id": 1, "data": 7})
+                third = await self.command(communicator, get)
+                self.assertEqual(third["data"], 7)
+                self.assertEqual(self.device.requests[CMD_TYPE_GET], 2)
+                self.assertIsNotNone(get_cache.get((1, 1, 1), ttl=60))
+        finally:
+            await communicator.disconnect()
+            await self.device.stop()
+            await close_services()
+
+    async def test_get_overtaken_by_set(self):
+        self.device.latency = 0.2
+        old = self.device.params[1][1].value
+        get = {"cmd_type": CMD_TYPE_GET, "periph_id": 1, "param_id": 1}
+        await self.device.start()
+        try:
+            with quiet():
+                first = asyncio.ensure_future(consumers.send_command(dict(get), self.device.url, 1))
+                await asyncio.sleep(0.05)
+                write = asyncio.ensure_future(consumers.send_command(
+                    {"cmd_type": CMD_TYPE_SET, "periph_id": 1, "param_id": 1, "data": old + 1}, self.device.url, 1))
+                await asyncio.sleep(0.05)
+                second = await consumers.send_command(dict(get), self.device.url, 1)
+                first = await first
+                await write
+                ## neither GET may cache - both were in flight while the SET was
+                self.assertIsNone(get_cache.get((1, 1, 1), ttl=60))
+                third = await consumers.send_command(dict(get), self.device.url, 1)
+        finally:
+            await self.device.stop()
+            await close_services()
+
+        self.assertEqual((first["data"], second["data"], third["data"]), (old, old + 1, old + 1))
+        self.assertEqual(self.device.requests[CMD_TYPE_GET], 3)
+        self.assertEqual(get_cache.get((1, 1, 1), ttl=60)["data"], old + 1)
+
+    async def test_batch_reports_every_command(self):
+        await self.device.start()
+        communicator = WebsocketCommunicator(consumers.CommandConsumer.as_asgi(), "/ws/CC/")
+        try:
+            with quiet():
+                await communicator.connect()
+                await communicator.send_json_to({"cmd_type": "BATCH", "batch_id": "b", "commands": [
+                    {"corr_id": 1, "cmd_type": "GET", "dev_id": 1, "periph_id": 1, "param_id": 1},
+                    {"corr_id": 2, "cmd_type": "GET", "dev_id": 1, "periph_id": 2, "param_id": 3},
+                    {"corr_id": 3, "cmd_type": "GET", "dev_id": 1, "periph_id": 9, "param_id": 1},
+                ]})
+                packets = [await communicator.receive_json_from(timeout=5) for _ in range(4)]
+        finally:
+            await communicator.disconnect()
+            await self.device.stop()
+            await close_services()
+
+        results = {p["corr_id"]: p for p in packets if p["packet_type"] == "batch_result"}
+        self.assertEqual(results[2]["data"], self.device.params[2][3].value)
+        self.assertEqual(results[3]["rsp_type"], RSP_TYPE_ERR)
+        self.assertEqual(packets[-1], {"packet_type": "batch_done", "batch_id": "b", "count": 3, "failed": 1})
+
+    async def test_batch_command_that_raises(self):
+        async def broken(rq, url, dev_id, max_age=None):
+            raise RuntimeError("broken")
+
+        communicator = WebsocketCommunicator(consumers.CommandConsumer.as_asgi(), "/ws/CC/")
+        try:
+            with quiet(), mock.patch.object(consumers, "send_command", broken):
+                await communicator.connect()
+                await communicator.send_json_to({"cmd_type": "BATCH", "batch_id": "b", "commands": [
+                    {"corr_id": 1, "cmd_type": "GET", "dev_id": 1, "periph_id": 1, "param_id": 1},
+                    {"corr_id": 2, "cmd_type": "GET", "dev_id": 1, "periph_id": 1, "param_id": 2},
+                ]})
+                packets = [await communicator.receive_json_from(timeout=5) for _ in range(3)]
+        finally:
+            await communicator.disconnect()
+            await close_services()
+
+        self.assertEqual([p["rsp_type"] for p in packets[:2]], [RSP_TYPE_ERR] * 2)
+        self.assertEqual(packets[-1], {"packet_type": "batch_done", "batch_id": "b", "count": 2, "failed": 2})
+
+    async def test_sweep_leaves_health_alone(self):
+        found = []
+
+        async def on_found(device):
+            found.append(device)
+
+        probes = sum(DEVICE_REQUEST_SECONDS.labels(SWEEP_DEVICE_LABEL, cmd_type_name(CMD_TYPE_INFO)).counts)
+        await self.device.start()
+        try:
+            sweeper = SubnetSweeper("127.0.0.1/32", [TEST_SIM_PORT, TEST_SIM_PORT + 1], SIM_CMD_URL, on_found, timeout=1)
+            with quiet():
+                responders = await sweeper.sweep()
+        finally:
+            await self.device.stop()
+            await close_services()
+
+        self.assertEqual([r["port"] for r in responders], [TEST_SIM_PORT])
+        self.assertEqual(found, responders)
+        ## no health state for either host - the probes are counted under the sweep label
+        self.assertEqual(device_health.devices, {})
+        devices = {values[0] for values in DEVICE_REQUEST_SECONDS.children}
+        self.assertNotIn(f"127.0.0.1:{TEST_SIM_PORT + 1}", devices)
+        self.assertEqual(sum(DEVICE_REQUEST_SECONDS.labels(SWEEP_DEVICE_LABEL, cmd_type_name(CMD_TYPE_INFO)).counts) - probes, 2)
+
+    async def test_unreachable_device_goes_down(self):
+        ## the simulator is never started - every request is refused
+        communicator = WebsocketCommunicator(consumers.CommandConsumer.as_asgi(), "/ws/CC/")
+        try:
+            with quiet():
+                await communicator.connect()
+                get = {"cmd_type": "GET", "dev_id": 1, "periph_id": 1, "param_id": 1}
+                codes = [(await self.command(communicator, get))["err_code"] for _ in range(HEALTH_DOWN_AFTER + 1)]
+        finally:
+            await communicator.disconnect()
+            await close_services()
+        self.assertEqual(codes, [ERR_CODE_DEVICE_UNREACHABLE] * HEALTH_DOWN_AFTER + [ERR_CODE_DEVICE_DOWN])
+
+
+##
+#   startup hooks without lifespan events
+#
+class LifespanTests(SimpleTestCase):
+
+    def setUp(self):
+        self.started = startup_state["started"]
+        startup_state["started"] = False
+
+    def tearDown(self):
+        startup_state["started"] = self.started
+
+    async def test_startup_on_first_connection(self):
+        hooks = []
+        calls = []
+
+        async def hook():
+            hooks.append(1)
+
+        async def app(scope, receive, send):
+            calls.append(scope["type"])
+
+        wrapped = StartupOnConnect(app)
+        with quiet(), mock.patch.object(lifespan, "startup_hooks", [hook]):
+            await wrapped({"type": "websocket"}, None, None)
+            await wrapped({"type": "http"}, None, None)
+        self.assertEqual(hooks, [1])
+        self.assertEqual(calls, ["websocket", "http"])
+
+
+##
+#   prometheus text rendering
+#
+class MetricsTests(SimpleTestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_counter_and_gauge(self):
+        counter = self.registry.register(Counter("t_requests_total", "Requests", ("device",)))
+        gauge = self.registry.register(Gauge("t_open", "Open things"))
+        counter.labels('dev "1"').inc(2)
+        gauge.inc(3)
+        gauge.dec()
+        text = self.registry.render()
+        self.assertIn("# TYPE t_requests_total counter", text)
+        self.assertIn('t_requests_total{device="dev \\"1\\""} 2.0', text)
+        self.assertIn("# TYPE t_open gauge\nt_open 2.0", text)
+        self.assertTrue(text.endswith("\n"))
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = self.registry.register(Histogram("t_seconds", "Latency", ("op",), buckets=(0.1, 1.0)))
+        child = histogram.labels("get")
+        for value in (0.05, 0.5, 0.5, 5.0):
+            child.observe(value)
+        text = self.registry.render()
+        self.assertIn('t_seconds_bucket{op="get",le="0.1"} 1', text)
+        self.assertIn('t_seconds_bucket{op="get",le="1.0"} 3', text)
+        self.assertIn('t_seconds_bucket{op="get",le="+Inf"} 4', text)
+        self.assertIn('t_seconds_count{op="get"} 4', text)
+        self.assertIn('t_seconds_sum{op="get"} 6.05', text)
+
+    def test_label_count_and_duplicates(self):
+        counter = self.registry.register(Counter("t_total", "Things", ("a", "b")))
+        with self.assertRaises(ValueError):
+            counter.labels("only one")
+        with self.assertRaises(ValueError):
+            self.registry.register(Counter("t_total", "Again"))
+
+    def test_metric_is_abstract(self):
+        with self.assertRaises(TypeError):
+            Metric("t_base", "Base")
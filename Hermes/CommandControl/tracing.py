@@ -0,0 +1,257 @@
+
+import os
+import json
+import time
+import uuid
+import random
+import asyncio
+import threading
+import contextvars
+import contextlib
+from collections import deque
+
+from django.conf import settings
+
+from .command_api import debug_print
+
+
+## fraction of commands traced
+TRACING_SAMPLE_RATE = 0.1
+## finished traces kept in memory for the traces page
+TRACING_RECENT = 500
+## spans kept per trace - the rest are counted only
+TRACING_MAX_SPANS = 200
+## seconds between appends to the trace file
+TRACING_FLUSH_INTERVAL = 2.0
+## the trace file is moved to FILE.1 when it grows past this
+TRACING_MAX_FILE_BYTES = 10 * 1024 * 1024
+## replaced by the process id in FILE - one file per worker, so workers never rotate each other's
+TRACING_FILE_PID = "{pid}"
+
+
+def tracing_config():
+    """ returns the tracing settings merged over the defaults """
+    config = {
+        "ENABLED": True,
+        "SAMPLE_RATE": TRACING_SAMPLE_RATE,
+        "FILE": None,
+        "RECENT": TRACING_RECENT,
+        "MAX_SPANS": TRACING_MAX_SPANS,
+        "FLUSH_INTERVAL": TRACING_FLUSH_INTERVAL,
+        "MAX_FILE_BYTES": TRACING_MAX_FILE_BYTES,
+    }
+    config.update(getattr(settings, "TRACING", {}))
+    return config
+
+
+## the trace of the running command - copied into tasks it starts
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+#######################
+##  class Trace
+#   \brief  - the timing of one command - named spans (phases) with their start
+#             & length relative to the start of the trace. Concurrent work (a batch,
+#             a scene, enumeration requests) adds overlapping spans
+class Trace():
+
+    def __init__(self, name: str, attrs: dict, max_spans: int):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attrs = attrs
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.spans = []
+        self.max_spans = max_spans
+        self.dropped = 0
+
+    def add_span(self, name: str, start: float, end: float):
+        if len(self.spans) < self.max_spans:
+            self.spans.append((name, start - self.start, end - start))
+        else:
+            self.dropped += 1
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.start
+
+    ''' total milliseconds spent in each phase, in first seen order '''
+    def phases(self):
+        totals = {}
+        for name, start, length in self.spans:
+            totals[name] = totals.get(name, 0.0) + length * 1000
+        return totals
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "attrs": self.attrs,
+            "started": self.started,
+            "ms": self.duration * 1000 if self.duration is not None else None,
+            "phases": self.phases(),
+            "spans": [{"name": n, "start_ms": s * 1000, "ms": l * 1000} for n, s, l in self.spans],
+            "dropped_spans": self.dropped,
+        }
+
+
+class SpanTimer():
+
+    def __init__(self, trace: Trace, name: str):
+        self.trace = trace
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.trace.add_span(self.name, self.start, time.perf_counter())
+
+
+class NullSpan():
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(name: str):
+    """ time a phase of the current trace - does nothing if the command isn't traced
+        with span("http"):
+            result, response = await ext_http_post(url, rq)
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return NULL_SPAN
+    return SpanTimer(trace, name)
+
+
+def set_trace_attr(key: str, value):
+    """ add an attribute to the current trace, if any """
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attrs[key] = value
+
+
+#######################
+##  class TraceRecorder
+#   \brief  - keeps the recent finished traces in memory & appends them to the
+#             json lines trace file from a flush task every FLUSH_INTERVAL
+#             the file is written in the default executor, off the event loop
+#             the flush task is started by the first trace & stopped (with a final
+#             flush) by the lifespan shutdown hook
+class TraceRecorder():
+
+    def __init__(self):
+        self.recent = deque(maxlen=TRACING_RECENT)
+        self.pending = []
+        self.lock = threading.Lock()
+        self.task = None
+
+    ''' start a trace if this command is sampled - returns the trace or None '''
+    def sample(self, name: str, attrs: dict):
+        config = tracing_config()
+        if not config["ENABLED"] or random.random() >= config["SAMPLE_RATE"]:
+            return None
+        return Trace(name, attrs, config["MAX_SPANS"])
+
+    def record(self, trace: Trace):
+        trace.finish()
+        config = tracing_config()
+        with self.lock:
+            if self.recent.maxlen != config["RECENT"]:
+                self.recent = deque(self.recent, maxlen=config["RECENT"])
+            self.recent.append(trace)
+            if config["FILE"]:
+                self.pending.append(trace)
+        if config["FILE"]:
+            self.start()
+
+    ''' the slowest recent traces, optionally of one name '''
+    def slowest(self, count: int = 20, name: str = None):
+        with self.lock:
+            traces = [t for t in self.recent if name is None or t.name == name]
+        return sorted(traces, key=lambda t: t.duration, reverse=True)[:count]
+
+    ''' append the pending traces to the trace file - blocking. returns traces written '''
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+        config = tracing_config()
+        if len(pending) == 0 or not config["FILE"]:
+            return 0
+
+        path = str(config["FILE"]).replace(TRACING_FILE_PID, str(os.getpid()))
+        lines = "".join(json.dumps(t.to_dict()) + "\n" for t in pending)
+        try:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            if os.path.exists(path) and os.path.getsize(path) > config["MAX_FILE_BYTES"]:
+                os.replace(path, path + ".1")
+            with open(path, "a") as f:
+                f.write(lines)
+        except OSError as e:
+            print(f"Writing traces failed: {e}")
+            return 0
+        debug_print(f"Wrote {len(pending)} traces")
+        return len(pending)
+
+    ''' start the flush task if it isn't running & there is a running event loop '''
+    def start(self):
+        if self.task is not None and not self.task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self.task = loop.create_task(self.run())
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(tracing_config()["FLUSH_INTERVAL"])
+            await loop.run_in_executor(None, self.flush)
+
+    ''' stop the flush task & write anything still pending '''
+    async def stop(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.task = None
+        await asyncio.get_event_loop().run_in_executor(None, self.flush)
+
+
+## the process-wide recorder
+tracer = TraceRecorder()
+
+
+@contextlib.contextmanager
+def traced(name: str, **attrs):
+    """ trace the block as one command, if sampled - spans inside it (& in tasks
+        it starts) are added to the trace. yields the trace or None
+    """
+    trace = tracer.sample(name, attrs)
+    if trace is None:
+        yield None
+        return
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        tracer.record(trace)
+
+
+async def close_tracing():
+    """ shutdown hook - stops the flush task & writes any pending traces """
+    await tracer.stop()
@@ -12,4 +12,6 @@ urlpatterns = [
     path('ledcontrol', views.LedControlView.as_view(), name="ledcontrol"),
     path('stream', views.StreamView.as_view(), name="stream"),
     path('commands', views.CommandsView.as_view(), name="commands"),
+    path('history/<int:pk>', views.parameter_history, name="history"),
+    path('traces', views.TracesView.as_view(), name="traces"),
 ]
\ No newline at end of file
@@ -2,16 +2,20 @@ from django.shortcuts import render, get_object_or_404
 
 # Create your views here.
 
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse, Http404
 from django.template import loader
 from .models import Device, Peripheral, Parameter
 from django.views.generic import TemplateView, DetailView, View
 from Hermes.settings import DATABASES
 
 import os
+import time
 import subprocess
 import json
 from . import command_api as CA
+from .history import query_history, history_config
+from .metrics import render_metrics, metrics_config, METRICS_CONTENT_TYPE
+from .tracing import tracer, tracing_config
 
 def get_uptime():
     p = subprocess.Popen(["uptime", "-p"], stdout=subprocess.PIPE)
@@ -144,4 +148,73 @@ class StreamView(View):
             "stream_periphs": stream_periphs,
         }
 
-        return HttpResponse(template.render(context, request))
\ No newline at end of file
+        return HttpResponse(template.render(context, request))
+
+
+def parameter_history(request, pk):
+    """ range query of a parameter's history
+        GET params: start & end (epoch seconds, default the last hour), points (max points returned)
+    """
+    param = get_object_or_404(Parameter.objects.select_related("peripheral__device"), pk=pk)
+    try:
+        end = float(request.GET.get("end", time.time()))
+        start = float(request.GET.get("start", end - 3600))
+        points = int(request.GET.get("points", history_config()["MAX_POINTS"]))
+    except ValueError:
+        return JsonResponse({"error": "start, end & points must be numbers"}, status=400)
+    if start >= end or points < 1:
+        return JsonResponse({"error": "Invalid range"}, status=400)
+
+    result = query_history(param, start, end, points)
+    result["param"] = param.pk
+    result["name"] = param.name
+    return JsonResponse(result)
+
+
+def metrics(request):
+    """ every metric of this worker in the prometheus text exposition format """
+    if not metrics_config()["ENABLED"]:
+        raise Http404("Metrics are disabled")
+    return HttpResponse(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
+
+class TracesView(View):
+    """ the slowest recently traced commands of this worker, with their phase breakdown
+        GET params: name (command, batch, scene, led, enumerate), count, format=json
+    """
+
+    def get(self, request):
+        name = request.GET.get("name") or None
+        try:
+            count = int(request.GET.get("count", 20))
+        except ValueError:
+            return JsonResponse({"error": "count must be a number"}, status=400)
+        traces = tracer.slowest(count, name)
+
+        if request.GET.get("format") == "json":
+            return JsonResponse({"traces": [t.to_dict() for t in traces]})
+
+        ## a column per phase seen, in first seen order
+        phase_names = []
+        for t in traces:
+            phase_names += [p for p in t.phases() if p not in phase_names]
+        rows = []
+        for t in traces:
+            phases = t.phases()
+            rows.append({
+                "trace": t,
+                "ms": t.duration * 1000,
+                "started": time.strftime("%H:%M:%S", time.localtime(t.started)),
+                "attrs": ", ".join(f"{k}={v}" for k, v in t.attrs.items() if v is not None),
+                "phases": [phases.get(p) for p in phase_names],
+            })
+
+        template = loader.get_template("CC/traces.html")
+        context = {
+            "devices": Device.objects.all(),
+            "rows": rows,
+            "phase_names": phase_names,
+            "name": name,
+            "config": tracing_config(),
+        }
+        return HttpResponse(template.render(context, request))
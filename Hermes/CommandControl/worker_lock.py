@@ -0,0 +1,66 @@
+
+import os
+import fcntl
+
+from django.conf import settings
+
+
+## directory for the worker lock files & the channel layer socket
+WORKER_LOCK_DIR = "/tmp/hermes"
+## seconds between attempts to take a lock held by another worker
+WORKER_LOCK_RETRY = 1.0
+
+
+def worker_config():
+    """ returns the worker settings merged over the defaults """
+    config = {
+        "LOCK_DIR": WORKER_LOCK_DIR,
+        "LOCK_RETRY": WORKER_LOCK_RETRY,
+    }
+    config.update(getattr(settings, "WORKERS", {}))
+    return config
+
+
+def worker_path(name: str):
+    """ path of a file in the lock directory, creating the directory if needed """
+    lock_dir = worker_config()["LOCK_DIR"]
+    os.makedirs(lock_dir, mode=0o700, exist_ok=True)
+    return os.path.join(lock_dir, name)
+
+
+#######################
+##  class WorkerLock
+#   \brief  - an exclusive lock shared by every worker process on the box, so a job
+#             (the poller, a device stream upstream) runs in exactly one of them
+#             an flock on a file in LOCK_DIR - the kernel drops it when the holding
+#             process exits, so another worker can take the job over
+#             one WorkerLock per name per process - a second would block the first
+class WorkerLock():
+
+    def __init__(self, name: str):
+        self.name = name
+        self.fd = None
+
+    @property
+    def held(self):
+        return self.fd is not None
+
+    ''' take the lock if free - never blocks, returns true if held '''
+    def try_acquire(self):
+        if self.fd is not None:
+            return True
+        fd = os.open(worker_path(f"{self.name}.lock"), os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self.fd = fd
+        return True
+
+    def release(self):
+        if self.fd is not None:
+            ## the file is left in place - removing it races with other workers' flock
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,126 @@
+
+import atexit
+import asyncio
+import threading
+
+from django.conf import settings
+from django.db import DatabaseError
+
+from .command_api import debug_print
+from .metrics import db_hop
+from . import models
+
+
+## seconds between flushes of buffered parameter values
+WRITE_BEHIND_INTERVAL = 1.0
+## fields written by a flush
+WRITE_BEHIND_FIELDS = ["last_value", "last_value_string"]
+
+
+def write_behind_config():
+    """ returns the write behind settings merged over the defaults """
+    config = {
+        "INTERVAL": WRITE_BEHIND_INTERVAL,
+    }
+    config.update(getattr(settings, "WRITE_BEHIND", {}))
+    return config
+
+
+#######################
+##  class ParameterWriteBehind
+#   \brief  - buffers parameter value updates in memory & writes them to the db
+#             in one bulk_update per interval. Repeated updates to a parameter
+#             between flushes are coalesced - only the latest value is written
+#             the flush task is started on the first update & stopped (with a
+#             final flush) by the lifespan shutdown hook. Servers without lifespan
+#             (runserver/daphne) get the final flush from an atexit handler
+class ParameterWriteBehind():
+
+    def __init__(self, interval: float = None):
+        self.interval = interval
+        ''' pk -> (last_value, last_value_string) waiting to be written '''
+        self.dirty = {}
+        self.lock = threading.Lock()
+        self.task = None
+
+    ''' buffer the current value of a parameter object '''
+    def record(self, param_object):
+        with self.lock:
+            self.dirty[param_object.pk] = (param_object.last_value, param_object.last_value_string)
+        self.start()
+
+    ''' copy buffered values onto freshly loaded parameter objects - {pk: Parameter} '''
+    def apply_pending(self, params: dict):
+        with self.lock:
+            pending = dict(self.dirty)
+        for pk, (value, value_string) in pending.items():
+            p = params.get(pk)
+            if p is not None:
+                p.last_value = value
+                p.last_value_string = value_string
+
+    ''' write the buffered values - blocking, run in the db thread. returns rows written '''
+    def flush(self):
+        with self.lock:
+            pending = self.dirty
+            self.dirty = {}
+        if len(pending) == 0:
+            return 0
+
+        objs = []
+        for pk, (value, value_string) in pending.items():
+            objs.append(models.Parameter(pk=pk, last_value=value, last_value_string=value_string))
+        try:
+            models.Parameter.objects.bulk_update(objs, fields=WRITE_BEHIND_FIELDS)
+        except DatabaseError as e:
+            print(f"Parameter write behind failed: {e}")
+            ## requeue anything which hasn't been updated again since
+            with self.lock:
+                for pk, values in pending.items():
+                    self.dirty.setdefault(pk, values)
+            return 0
+        debug_print(f"Wrote {len(objs)} buffered parameter values")
+        return len(objs)
+
+    ''' start the flush task if it isn't running & there is a running event loop '''
+    def start(self):
+        if self.task is not None and not self.task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self.task = loop.create_task(self.run())
+
+    async def run(self):
+        interval = self.interval or write_behind_config()["INTERVAL"]
+        while True:
+            await asyncio.sleep(interval)
+            await db_hop("write_behind_flush")(self.flush)()
+
+    ''' stop the flush task & write anything still buffered '''
+    async def stop(self):
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        self.task = None
+        await db_hop("write_behind_flush")(self.flush)()
+
+    ''' last chance flush at interpreter exit - a no-op if the shutdown hook already ran '''
+    def flush_at_exit(self):
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Parameter write behind exit flush failed: {e}")
+
+
+## the process-wide write behind buffer
+write_behind = ParameterWriteBehind()
+atexit.register(write_behind.flush_at_exit)
+
+
+async def close_write_behind():
+    await write_behind.stop()
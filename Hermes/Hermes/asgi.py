@@ -13,15 +13,17 @@ from channels.routing import ProtocolTypeRouter, URLRouter
 from django.core.asgi import get_asgi_application
 from channels.auth import AuthMiddlewareStack
 import CommandControl.routing
+from CommandControl.lifespan import LifespanApp, StartupOnConnect
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "Hermes.settings")
 
 application = ProtocolTypeRouter(
     {
-        "http": get_asgi_application(),
-        "websocket": AuthMiddlewareStack(
+        "http": StartupOnConnect(get_asgi_application()),
+        "websocket": StartupOnConnect(AuthMiddlewareStack(
             URLRouter(CommandControl.routing.websocket_urlpatterns)
-        ),
+        )),
+        "lifespan": LifespanApp(),
     }
 )
 
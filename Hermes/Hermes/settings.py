@@ -70,14 +70,138 @@ TEMPLATES = [
     },
 ]
 
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer"
-    }
+# Worker processes - LOCK_DIR holds the locks that keep the poller & each device stream
+# upstream in one worker, & the channel layer socket. LOCK_RETRY is the seconds between
+# attempts to take over a lock held by another worker
+WORKERS = {
+    "LOCK_DIR": os.environ.get("HERMES_LOCK_DIR", "/tmp/hermes"),
+    "LOCK_RETRY": 1.0,
 }
 
+# HERMES_CHANNEL_LAYER=unix shares channels & groups between worker processes through
+# a unix socket (no broker needed) - required when running more than one worker, see README
+if os.environ.get("HERMES_CHANNEL_LAYER", "memory") == "unix":
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "CommandControl.channel_layer.UnixSocketChannelLayer",
+            "CONFIG": {
+                "path": os.path.join(WORKERS["LOCK_DIR"], "layer.sock"),
+            },
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer"
+        }
+    }
+
 ASGI_APPLICATION = 'Hermes.asgi.application'
 
+# Shared http client used for device commands - see CommandControl/device_client.py
+# timeouts are in seconds, limits are pooled connection counts
+DEVICE_CLIENT = {
+    "TIMEOUT": 10,
+    "CONNECT_TIMEOUT": 3,
+    "LIMIT": 100,
+    "LIMIT_PER_HOST": 4,
+    "KEEPALIVE_TIMEOUT": 30,
+    "COALESCE": True,
+}
+
+# Device health - consecutive failures before a device is down, seconds a down device
+# fails fast before a probe (doubling to OPEN_SECONDS_MAX) & the probe timeout (seconds)
+DEVICE_HEALTH = {
+    "DOWN_AFTER": 3,
+    "OPEN_SECONDS": 10,
+    "OPEN_SECONDS_MAX": 300,
+    "PROBE_TIMEOUT": 2,
+}
+
+# Parameter GET cache - seconds a GET result is reused by default, per peripheral type
+# & per (dev_id, periph_id, param_id), plus the most results held. Requests can send
+# "max_age" (seconds) to override the ttl - 0 always reads the device
+GET_CACHE = {
+    "DEFAULT_TTL": 1.0,
+    "PERIPH_TYPE_TTLS": {},
+    "PARAMETER_TTLS": {},
+    "MAX_ENTRIES": 1024,
+}
+
+# Limits for BATCH messages on the peripheral command websocket
+COMMAND_BATCH = {
+    "MAX_COMMANDS": 100,
+    "DEVICE_CONCURRENCY": 2,
+}
+
+# Device discovery/enumeration - MAX_IN_FLIGHT is the info request limit per device
+# SWEEP_* limit network sweeps - probes in flight, max network size & probe timeout (seconds)
+DISCOVERY = {
+    "MAX_IN_FLIGHT": 4,
+    "SWEEP_MAX_IN_FLIGHT": 64,
+    "SWEEP_MAX_HOSTS": 1024,
+    "SWEEP_PROBE_TIMEOUT": 1.0,
+}
+
+# Parameter value writes - seconds between bulk writes of buffered values
+WRITE_BEHIND = {
+    "INTERVAL": 1.0,
+}
+
+# Background polling of getable parameters - intervals (seconds) by default & per
+# peripheral type (Parameter.poll_interval overrides both), concurrency limits,
+# +/- jitter fraction & the longest failure backoff (seconds)
+POLLING = {
+    "ENABLED": True,
+    "DEFAULT_INTERVAL": 60,
+    "PERIPH_TYPE_INTERVALS": {},
+    "MAX_IN_FLIGHT": 8,
+    "DEVICE_CONCURRENCY": 1,
+    "JITTER": 0.1,
+    "BACKOFF_MAX": 600,
+}
+
+# Led control - most colour sets sent to each strip per second
+LED_CONTROL = {
+    "MAX_UPDATE_HZ": 20,
+}
+
+# Parameter history - rollup TIERS (seconds), retention (seconds) for raw samples &
+# per rollup tier, seconds between sample writes & retention passes, points per query
+HISTORY = {
+    "TIERS": [60, 3600],
+    "RAW_RETENTION": 2 * 86400,
+    "ROLLUP_RETENTION": {60: 30 * 86400, 3600: 365 * 86400},
+    "FLUSH_INTERVAL": 5.0,
+    "PRUNE_INTERVAL": 3600,
+    "MAX_POINTS": 500,
+}
+
+# Device streaming - seconds of samples kept in memory per streamed parameter,
+# and the default seconds of those sent to a client when it starts streaming
+STREAMING = {
+    "BUFFER_SECONDS": 600,
+    "BACKFILL_SECONDS": 60,
+    "DECIMATION_INTERVAL": 0.5,
+    "BINARY_WINDOW_MS": 50,
+}
+
+# Metrics - serve the prometheus text format at /metrics
+METRICS = {
+    "ENABLED": True,
+}
+
+# Command tracing - fraction of commands traced, json lines FILE the traces are
+# appended to (None to keep them in memory only) & traces kept for the traces page
+# {pid} in FILE is replaced by the process id, so each worker writes & rotates its own
+# file, eg. os.path.join(WORKERS["LOCK_DIR"], "traces.{pid}.jsonl")
+TRACING = {
+    "ENABLED": True,
+    "SAMPLE_RATE": 0.1,
+    "FILE": None,
+    "RECENT": 500,
+}
+
 WSGI_APPLICATION = 'Hermes.wsgi.application'
 
 # Database
@@ -87,6 +211,10 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        ## seconds to wait for another worker's write to finish
+        'OPTIONS': {
+            'timeout': 20,
+        },
     }
 }
 
@@ -16,6 +16,7 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import include, path
 from . import settings
+from CommandControl.views import metrics
 from django.contrib.staticfiles.urls import static
 from django.contrib.staticfiles.urls import staticfiles_urlpatterns
 
@@ -23,6 +24,7 @@ from django.contrib.staticfiles.urls import staticfiles_urlpatterns
 urlpatterns = [
     path('CC/', include('CommandControl.urls')),
     path('admin/', admin.site.urls),
+    path('metrics', metrics, name="metrics"),
 ]
 
 urlpatterns += staticfiles_urlpatterns()